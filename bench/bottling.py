@@ -0,0 +1,73 @@
+"""
+Bottling planner microbenchmark. Needs no database.
+
+Compares src.bottling.plan_bottles with the unit-by-unit loop it replaced
+in bottler.make_potions (kept below as legacy_plan) on random recipe books:
+time per plan, potions bottled and total value (sum of prices).
+
+    python -m bench.bottling --recipes 10 100 500 --capacities 50 5000 500000
+"""
+import argparse
+import random
+import time
+from src import bottling
+
+
+def legacy_plan(ml, recipes, caps, values, max_potions):
+    """ The old loop: one potion per iteration, recipes in the given order. """
+    ml = list(ml)
+    quantities = []
+    total_potions = 0
+    for recipe, cap in zip(recipes, caps):
+        quantity = 0
+        while (all(ml[color] >= recipe[color] for color in range(4))
+               and quantity < cap and total_potions < max_potions):
+            quantity += 1
+            total_potions += 1
+            for color in range(4):
+                ml[color] -= recipe[color]
+        quantities.append(quantity)
+    return quantities
+
+
+def random_recipes(count, rng):
+    recipes = []
+    for _ in range(count):
+        cuts = sorted(rng.sample(range(0, 101, 5), 3))
+        recipe = [cuts[0], cuts[1] - cuts[0], cuts[2] - cuts[1], 100 - cuts[2]]
+        rng.shuffle(recipe)
+        recipes.append(recipe)
+    return recipes
+
+
+def timed(plan, *args):
+    start = time.perf_counter()
+    quantities = plan(*args)
+    return quantities, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipes", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--capacities", type=int, nargs="+", default=[50, 5000, 500000])
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'recipes':>7} {'capacity':>9} {'impl':>7} {'ms':>9} {'potions':>8} {'value':>10}")
+    for count in args.recipes:
+        for capacity in args.capacities:
+            recipes = random_recipes(count, rng)
+            values = [rng.randint(20, 80) for _ in recipes]
+            caps = [capacity // 20] * count
+            # Enough ml for roughly 60% of capacity, unevenly split across colors
+            ml = [rng.randint(0, capacity * 30) for _ in range(4)]
+
+            for name, plan in [("legacy", legacy_plan), ("planner", bottling.plan_bottles)]:
+                quantities, ms = timed(plan, ml, recipes, caps, values, capacity)
+                value = sum(q * v for q, v in zip(quantities, values))
+                print(f"{count:>7} {capacity:>9} {name:>7} {ms:>9.2f} {sum(quantities):>8} {value:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Checkout benchmark: statements issued and latency per checkout, by cart size.
+
+Compares the current set-based carts.checkout with the per-line loop it
+replaced (kept below as legacy_checkout so the "before" numbers can be
+reproduced). Writes carts, cart items and ledger rows, so point POSTGRES_URI
+at a scratch database:
+
+    python -m bench.checkout --sizes 1 5 10 20 --runs 100
+
+Carts hold one line per sku, so it adds BENCH_* recipes (see bench.deliveries)
+until there are as many potions as the largest cart has lines. It also times
+filling each cart one item per request against one carts.set_cart_items batch,
+which holds stock (src/reservations.py), so it stocks the potions first and
+releases the holds afterwards.
+"""
+import argparse
+import statistics
+import time
+import sqlalchemy
+from bench.deliveries import bench_recipes
+from src import database as db
+from src import ledger
+from src import reservations
+from src.api import carts
+
+statements = 0
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    # psycopg2's executemany is one round trip per parameter set; a batched
+    # multi-row INSERT (insertmanyvalues) arrives here as one dict of parameters
+    global statements
+    statements += len(parameters) if executemany and isinstance(parameters, (list, tuple)) else 1
+
+
+def legacy_checkout(cart_id):
+    """ The pre-set-based checkout: five statements per cart line. """
+    with db.engine.begin() as connection:
+        cart_contents = connection.execute(sqlalchemy.text(
+            "SELECT quantity, item_sku FROM cart_items WHERE cart_id = :cart_id"),
+            {"cart_id": cart_id}).fetchall()
+
+        for quantity, item_sku in cart_contents:
+            potion_data = connection.execute(sqlalchemy.text(
+                "SELECT id, price FROM potion_inventory WHERE sku = :item_sku"),
+                {"item_sku": item_sku}).first()
+
+            current_quantity = connection.execute(sqlalchemy.text(
+                "SELECT SUM(quantity) FROM potion_ledger WHERE potion_id = :potion_id"),
+                {"potion_id": potion_data.id}).scalar() or 0
+
+            if quantity <= current_quantity:
+                current_time = connection.execute(sqlalchemy.text(
+                    "SELECT day, hour FROM time_table ORDER BY created_at DESC LIMIT 1;")).first()
+
+                connection.execute(sqlalchemy.text("""
+                    INSERT INTO potion_ledger (potion_id, quantity, function, transaction, cost, day, hour)
+                    VALUES (:potion_id, - :quantity, 'sale', 'bench', :cost, :day, :hour);
+                    """), {"potion_id": potion_data.id, "quantity": quantity, "cost": quantity * potion_data.price,
+                           "day": current_time.day, "hour": current_time.hour})
+
+                connection.execute(sqlalchemy.text("""
+                    INSERT INTO gold_ledger (net_change, function, transaction, day, hour)
+                    VALUES (:net_change, 'checkout', 'bench', :day, :hour);
+                    """), {"net_change": quantity * potion_data.price,
+                           "day": current_time.day, "hour": current_time.hour})
+
+
+def set_based_checkout(cart_id):
+    with db.engine.begin() as connection:
+        carts.sell_cart(connection, cart_id)
+
+
+def seed(size, runs):
+    """ Stocks every potion and creates `runs` carts of `size` lines each. Returns the cart ids. """
+    with db.engine.begin() as connection:
+        potions = connection.execute(sqlalchemy.text(
+            "SELECT id, sku, price FROM potion_inventory ORDER BY id")).fetchall()
+
+        connection.execute(sqlalchemy.text(
+            "INSERT INTO time_table (day, hour) VALUES ('Hearthday', 12)"))
+
+        ledger.record_potions(connection, [{
+            'potion_id': potion.id,
+            'quantity': size * runs * 2,
+            'function': 'bench',
+            'transaction': 'bench stock',
+            'cost': 0
+        } for potion in potions])
+
+        cart_ids = []
+        for _ in range(runs):
+            cart_id = connection.execute(sqlalchemy.text(
+                "INSERT INTO carts (name, class, level) VALUES ('bench', 'bench', 1) RETURNING id")).scalar_one()
+            connection.execute(sqlalchemy.text("""
+                INSERT INTO cart_items (item_sku, quantity, cart_id, potion_id, price)
+                VALUES (:sku, 1, :cart_id, :potion_id, :price)
+                """), [{
+                    'sku': potions[i % len(potions)].sku,
+                    'cart_id': cart_id,
+                    'potion_id': potions[i % len(potions)].id,
+                    'price': potions[i % len(potions)].price
+                } for i in range(size)])
+            cart_ids.append(cart_id)
+
+    return cart_ids
+
+
+def fill_one_by_one(cart_id, items):
+    for item in items:
+        with db.engine.begin() as connection:
+            carts.set_cart_items(connection, cart_id, [item])
+
+
+def fill_batch(cart_id, items):
+    with db.engine.begin() as connection:
+        carts.set_cart_items(connection, cart_id, items)
+
+
+def measure_fill(fill_fn, size, runs):
+    """ Statements and latency to put `size` skus into each of `runs` new carts. """
+    global statements
+    with db.engine.begin() as connection:
+        stocked = connection.execute(sqlalchemy.text(
+            "SELECT id, sku FROM potion_inventory ORDER BY id LIMIT :size"), {"size": size}).fetchall()
+        ledger.record_potions(connection, [{
+            'potion_id': potion.id, 'quantity': runs, 'function': 'bench', 'transaction': 'bench stock', 'cost': 0
+        } for potion in stocked])
+        skus = [potion.sku for potion in stocked]
+        cart_ids = [connection.execute(sqlalchemy.text(
+            "INSERT INTO carts (name, class, level) VALUES ('bench', 'bench', 1) RETURNING id")).scalar_one()
+            for _ in range(runs)]
+
+    latencies = []
+    statements = 0
+    for cart_id in cart_ids:
+        start = time.perf_counter()
+        fill_fn(cart_id, [(sku, 1) for sku in skus])
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    with db.engine.begin() as connection:
+        for cart_id in cart_ids:
+            reservations.release(connection, cart_id)
+
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return statements / runs, statistics.median(latencies), p95
+
+
+def measure(checkout_fn, cart_ids):
+    global statements
+    latencies = []
+    statements = 0
+    for cart_id in cart_ids:
+        start = time.perf_counter()
+        checkout_fn(cart_id)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return statements / len(cart_ids), statistics.median(latencies), p95
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 5, 10, 20])
+    parser.add_argument("--runs", type=int, default=100)
+    args = parser.parse_args()
+
+    bench_recipes(max(args.sizes))
+    sqlalchemy.event.listen(db.engine, "before_cursor_execute", count_statement)
+
+    print(f"{'lines':>5} {'fill':>10} {'stmts/cart':>15} {'p50 ms':>8} {'p95 ms':>8}")
+    for size in args.sizes:
+        for name, fill_fn in [("per-item", fill_one_by_one), ("batch", fill_batch)]:
+            per_cart, p50, p95 = measure_fill(fill_fn, size, args.runs)
+            print(f"{size:>5} {name:>10} {per_cart:>15.1f} {p50:>8.2f} {p95:>8.2f}")
+
+    print(f"\n{'lines':>5} {'impl':>10} {'stmts/checkout':>15} {'p50 ms':>8} {'p95 ms':>8}")
+    for size in args.sizes:
+        for name, checkout_fn in [("legacy", legacy_checkout), ("set-based", set_based_checkout)]:
+            cart_ids = seed(size, args.runs)
+            per_checkout, p50, p95 = measure(checkout_fn, cart_ids)
+            print(f"{size:>5} {name:>10} {per_checkout:>15.1f} {p50:>8.2f} {p95:>8.2f}")
+
+    # legacy_checkout writes ledger rows without touching the balances
+    with db.engine.begin() as connection:
+        ledger.rebuild_balances(connection)
+
+
+if __name__ == "__main__":
+    main()
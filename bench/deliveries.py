@@ -0,0 +1,131 @@
+"""
+Delivery benchmark: statements (round trips) and latency of a bottle
+delivery, by the number of potion types delivered.
+
+Compares bottler.record_bottle_delivery with the per-potion loop it replaced
+(kept below as legacy_bottle_delivery). Adds BENCH_* recipes to
+potion_inventory and writes ledger rows, so point POSTGRES_URI at a scratch
+database:
+
+    python -m bench.deliveries --types 1 10 50 200 --runs 20
+
+It then times a delivery through idempotency.run_once against a retry of the
+same order_id, which only looks up the stored result.
+"""
+import argparse
+import statistics
+import time
+import sqlalchemy
+from src import database as db
+from src import idempotency
+from src import ledger
+from src.api import bottler
+
+statements = 0
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    # psycopg2's executemany is one round trip per parameter set; a batched
+    # multi-row INSERT (insertmanyvalues) arrives here as one dict of parameters
+    global statements
+    statements += len(parameters) if executemany and isinstance(parameters, (list, tuple)) else 1
+
+
+def legacy_bottle_delivery(connection, potions_delivered):
+    """ The old delivery: a recipe lookup, time lookup and ledger insert per potion, then per color. """
+    ml_changes = {'red': 0, 'green': 0, 'blue': 0, 'dark': 0}
+    for potion in potions_delivered:
+        potion_type_info = connection.execute(sqlalchemy.text("""
+            SELECT id, sku, price FROM potion_inventory
+            WHERE red_ml = :red AND green_ml = :green AND blue_ml = :blue AND dark_ml = :dark LIMIT 1;
+            """), dict(zip(['red', 'green', 'blue', 'dark'], potion.potion_type))).mappings().first()
+        current_time = connection.execute(sqlalchemy.text(
+            "SELECT day, hour FROM time_table ORDER BY created_at DESC LIMIT 1;")).first()
+
+        connection.execute(sqlalchemy.text("""
+            INSERT INTO potion_ledger (potion_id, quantity, function, transaction, cost, day, hour)
+            VALUES (:potion_id, :quantity, 'bench', 'delivery', :cost, :day, :hour);
+            """), {'potion_id': potion_type_info['id'], 'quantity': potion.quantity,
+                   'cost': potion_type_info['price'], 'day': current_time.day, 'hour': current_time.hour})
+
+        for color, ml in zip(ml_changes, potion.potion_type):
+            ml_changes[color] -= ml * potion.quantity
+
+    for color, change in ml_changes.items():
+        if change < 0:
+            current_time = connection.execute(sqlalchemy.text(
+                "SELECT day, hour FROM time_table ORDER BY created_at DESC LIMIT 1;")).first()
+            connection.execute(sqlalchemy.text("""
+                INSERT INTO ml_ledger (net_change, barrel_type, function, transaction, day, hour)
+                VALUES (:net_change, :barrel_type, 'bench', 'delivery', :day, :hour);
+                """), {'net_change': change, 'barrel_type': color, 'day': current_time.day, 'hour': current_time.hour})
+
+
+def bench_recipes(count):
+    """ Makes sure there are `count` BENCH_* recipes with distinct vectors and returns their vectors. """
+    vectors = [[red, green, 100 - red - green, 0] for red in range(101) for green in range(101 - red)][:count]
+
+    with db.engine.begin() as connection:
+        connection.execute(sqlalchemy.text(
+            "INSERT INTO time_table (day, hour) VALUES ('Hearthday', 12)"))
+        existing = {tuple(row) for row in connection.execute(sqlalchemy.text(
+            "SELECT red_ml, green_ml, blue_ml, dark_ml FROM potion_inventory"))}
+        missing = [vector for vector in vectors if tuple(vector) not in existing]
+        if missing:
+            connection.execute(db.potion_inventory.insert(), [{
+                'sku': f"BENCH_{'_'.join(map(str, vector))}", 'name': 'bench', 'price': 1,
+                'red_ml': vector[0], 'green_ml': vector[1], 'blue_ml': vector[2], 'dark_ml': vector[3]
+            } for vector in missing])
+    return vectors
+
+
+def measure(deliver, potions, runs):
+    global statements
+    latencies = []
+    statements = 0
+    for _ in range(runs):
+        start = time.perf_counter()
+        with db.engine.begin() as connection:
+            deliver(connection, potions)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return statements / runs, statistics.median(latencies), p95
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--types", type=int, nargs="+", default=[1, 10, 50, 200])
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    vectors = bench_recipes(max(args.types))
+    sqlalchemy.event.listen(db.engine, "before_cursor_execute", count_statement)
+
+    print(f"{'types':>5} {'impl':>8} {'stmts/delivery':>15} {'p50 ms':>8} {'p95 ms':>8}")
+    for count in args.types:
+        potions = [bottler.PotionInventory(potion_type=vector, quantity=1) for vector in vectors[:count]]
+        for name, deliver in [("legacy", legacy_bottle_delivery), ("bulk", bottler.record_bottle_delivery)]:
+            per_delivery, p50, p95 = measure(deliver, potions, args.runs)
+            print(f"{count:>5} {name:>8} {per_delivery:>15.1f} {p50:>8.2f} {p95:>8.2f}")
+
+    # First deliveries (fresh order ids) against retries of one order id
+    potions = [bottler.PotionInventory(potion_type=vector, quantity=1) for vector in vectors[:max(args.types)]]
+    order_ids = iter(range(-1, -args.runs - 1, -1))
+    first = measure(lambda connection, potions: idempotency.run_once(
+        connection, "bench/deliver", next(order_ids), bottler.record_bottle_delivery, potions), potions, args.runs)
+    retry = measure(lambda connection, potions: idempotency.run_once(
+        connection, "bench/deliver", -1, bottler.record_bottle_delivery, potions), potions, args.runs)
+    for name, (per_delivery, p50, p95) in [("first", first), ("retry", retry)]:
+        print(f"{max(args.types):>5} {name:>8} {per_delivery:>15.1f} {p50:>8.2f} {p95:>8.2f}")
+    with db.engine.begin() as connection:
+        connection.execute(sqlalchemy.text("DELETE FROM delivery_orders WHERE endpoint = 'bench/deliver'"))
+
+    # legacy_bottle_delivery writes ledger rows without touching the balances
+    with db.engine.begin() as connection:
+        ledger.rebuild_balances(connection)
+
+
+if __name__ == "__main__":
+    main()
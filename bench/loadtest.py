@@ -0,0 +1,101 @@
+"""
+Load test for the request path. Run the API first, e.g.
+
+    uvicorn src.api.server:app --workers 1                   # psycopg2 on the threadpool
+    DATABASE_ASYNC=1 uvicorn src.api.server:app --workers 1  # asyncpg engine
+
+then
+
+    python -m bench.loadtest --url http://127.0.0.1:8000 --api-key $API_KEY
+
+Each of --concurrency clients loops for --seconds over either GET /catalog/
+or a cart flow (POST /carts/, POST /carts/{id}/items/{sku}, POST
+/carts/{id}/checkout) and the script prints requests/second and latency
+percentiles per endpoint. Pass --catalog-only / --carts-only to isolate one.
+"""
+import argparse
+import asyncio
+import random
+import time
+import httpx
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+async def client_loop(client, deadline, flows, skus, timings, errors):
+    while time.perf_counter() < deadline:
+        flow = random.choice(flows)
+        if flow == "catalog":
+            await timed(client, "GET /catalog/", "GET", "/catalog/", None, timings, errors)
+            continue
+
+        cart = await timed(client, "POST /carts/", "POST", "/carts/",
+                           {"customer_name": "loadtest", "character_class": "Bard", "level": 1}, timings, errors)
+        if cart is None:
+            continue
+        cart_id = cart["cart_id"]
+        sku = random.choice(skus)
+        await timed(client, "POST /carts/{id}/items/{sku}", "POST", f"/carts/{cart_id}/items/{sku}",
+                    {"quantity": 1}, timings, errors)
+        await timed(client, "POST /carts/{id}/checkout", "POST", f"/carts/{cart_id}/checkout",
+                    {"payment": "gold"}, timings, errors)
+
+
+async def timed(client, name, method, path, body, timings, errors):
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, path, json=body)
+    except httpx.HTTPError:
+        errors[name] = errors.get(name, 0) + 1
+        return None
+    timings.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+    if response.status_code >= 400:
+        errors[name] = errors.get(name, 0) + 1
+        return None
+    return response.json() if response.status_code == 200 else None
+
+
+async def run(args):
+    flows = ["catalog"] if args.catalog_only else ["carts"] if args.carts_only else ["catalog", "carts"]
+    timings = {}
+    errors = {}
+    headers = {"access_token": args.api_key}
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, headers=headers, limits=limits, timeout=30) as client:
+        catalog = (await client.get("/catalog/")).json()
+        skus = [item["sku"] for item in catalog] or ["GREEN_POTION"]
+
+        start = time.perf_counter()
+        deadline = start + args.seconds
+        await asyncio.gather(*[
+            client_loop(client, deadline, flows, skus, timings, errors) for _ in range(args.concurrency)
+        ])
+        elapsed = time.perf_counter() - start
+
+    print(f"{'endpoint':<30} {'requests':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6}")
+    total = 0
+    for name, samples in sorted(timings.items()):
+        total += len(samples)
+        print(f"{name:<30} {len(samples):>8} {len(samples) / elapsed:>8.1f} {percentile(samples, 0.5):>8.1f} "
+              f"{percentile(samples, 0.95):>8.1f} {percentile(samples, 0.99):>8.1f} {errors.get(name, 0):>6}")
+    print(f"{'total':<30} {total:>8} {total / elapsed:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--api-key", default="")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--catalog-only", action="store_true")
+    parser.add_argument("--carts-only", action="store_true")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
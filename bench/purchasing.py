@@ -0,0 +1,98 @@
+"""
+Barrel purchase planner microbenchmark. Needs no database.
+
+Compares src.purchasing.plan_barrels with the LARGE/MEDIUM scan it replaced
+in barrels.get_wholesale_purchase_plan (kept below as legacy_plan) on random
+wholesale catalogs: time per plan, ml bought and gold spent.
+
+    python -m bench.purchasing --skus 8 100 500 --gold 500 5000 50000
+"""
+import argparse
+import random
+import time
+from types import SimpleNamespace
+from src import purchasing
+
+SIZES = {'MINI': 200, 'SMALL': 500, 'MEDIUM': 2500, 'LARGE': 10000}
+
+
+def legacy_plan(offers, ml_counts, gold, ml_capacity):
+    """ The old scan: red, green, blue in order, one LARGE or else two of the cheapest MEDIUM. """
+    available = ml_capacity - sum(ml_counts.values())
+    plan = []
+    for color in ['red', 'green', 'blue']:
+        index = purchasing.COLORS.index(color)
+        catalog = sorted(
+            (offer for offer in offers
+             if ("LARGE" in offer.sku or "MEDIUM" in offer.sku) and purchasing.barrel_color(offer.potion_type) == index),
+            key=lambda offer: offer.price / offer.ml_per_barrel)
+
+        large = next((offer for offer in catalog if "LARGE" in offer.sku), None)
+        if large:
+            if gold >= large.price and available >= large.ml_per_barrel and large.quantity >= 1:
+                plan.append((large, 1))
+                gold -= large.price
+                available -= large.ml_per_barrel
+            continue
+
+        mediums = [offer for offer in catalog if "MEDIUM" in offer.sku]
+        if mediums:
+            medium = mediums[0]
+            if gold >= medium.price * 2 and available >= medium.ml_per_barrel * 2 and medium.quantity >= 2:
+                plan.append((medium, 2))
+                gold -= medium.price * 2
+                available -= medium.ml_per_barrel * 2
+    return plan
+
+
+def random_catalog(count, rng):
+    offers = []
+    for i in range(count):
+        size = rng.choice(list(SIZES))
+        color = rng.randrange(4)
+        potion_type = [0, 0, 0, 0]
+        potion_type[color] = 1
+        ml = SIZES[size]
+        offers.append(SimpleNamespace(
+            sku=f"{size}_{purchasing.COLORS[color].upper()}_BARREL_{i}",
+            ml_per_barrel=ml,
+            potion_type=potion_type,
+            price=max(1, int(ml * rng.uniform(0.05, 0.4))),
+            quantity=rng.randint(1, 30),
+        ))
+    return offers
+
+
+def timed(plan, *args):
+    start = time.perf_counter()
+    result = plan(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--skus", type=int, nargs="+", default=[8, 100, 500])
+    parser.add_argument("--gold", type=int, nargs="+", default=[500, 5000, 50000])
+    parser.add_argument("--capacity", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    mix = {color: 0.25 for color in purchasing.COLORS}
+    print(f"{'skus':>5} {'gold':>7} {'impl':>7} {'ms':>9} {'ml':>8} {'spent':>7}")
+    for count in args.skus:
+        for gold in args.gold:
+            offers = random_catalog(count, rng)
+            ml_counts = {color: rng.randint(0, args.capacity // 8) for color in purchasing.COLORS}
+            runs = [
+                ("legacy", timed(legacy_plan, offers, ml_counts, gold, args.capacity)),
+                ("dp", timed(purchasing.plan_barrels, offers, ml_counts, gold, args.capacity, mix)),
+            ]
+            for name, (plan, ms) in runs:
+                ml = sum(offer.ml_per_barrel * quantity for offer, quantity in plan)
+                spent = sum(offer.price * quantity for offer, quantity in plan)
+                print(f"{count:>5} {gold:>7} {name:>7} {ms:>9.2f} {ml:>8} {spent:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""
+Potion Exchange tick simulator. Plays the game server's side of APISpec.md
+against the shop for --days game days and reports throughput, latency
+percentiles per endpoint and where the shop ended up.
+
+Every tick (two game hours) it sends the time, fetches the catalog, sends a
+visit and runs --customers customers through create cart / add item /
+checkout, --concurrency at a time. Every tick it also asks for a bottle plan
+and delivers it; on barrel ticks (hours 2, 6, ..., 22) it offers a wholesale
+catalog and delivers what the shop asked for, and once a day it asks for a
+capacity plan.
+
+By default the app runs in-process (httpx over ASGI, same event loop), so
+only POSTGRES_URI is needed; --url points it at a running server instead.
+The run starts with POST /admin/reset, so use a scratch database:
+
+    python -m bench.simulator --bootstrap --days 7 --customers 20 --concurrency 8
+    python -m bench.simulator --url http://127.0.0.1:8000 --api-key $API_KEY --days 7
+
+--bootstrap applies any pending schema migrations (src/migrate.py) and seeds
+the eight starter recipes into an empty potion_inventory. --starter-ml gives the
+shop free barrels of every color at the start, so there is something to
+bottle and sell while purchasing is paused.
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+import httpx
+
+DAYS = ["Hearthday", "Crownday", "Blesseday", "Soulday", "Edgeday", "Bloomday", "Arcanaday"]
+BARREL_HOURS = {2, 6, 10, 14, 18, 22}
+CLASSES = ["Warrior", "Mage", "Rogue", "Bard", "Druid", "Cleric", "Paladin", "Monk"]
+
+STARTER_RECIPES = [
+    ("RED_POTION", "red", 50, [100, 0, 0, 0]),
+    ("GREEN_POTION", "green", 50, [0, 100, 0, 0]),
+    ("BLUE_POTION", "blue", 50, [0, 0, 100, 0]),
+    ("BLACK_POTION", "black", 60, [0, 0, 0, 100]),
+    ("YELLOW_POTION", "yellow", 55, [50, 50, 0, 0]),
+    ("PURPLE_POTION", "purple", 55, [50, 0, 50, 0]),
+    ("WHITE_POTION", "white", 55, [0, 50, 50, 0]),
+    ("ORANGE_POTION", "orange", 40, [75, 25, 0, 0]),
+]
+
+# (size, ml per barrel, price by color) offered on every barrel tick
+WHOLESALE = [
+    ("SMALL", 500, [100, 100, 120, None]),
+    ("MEDIUM", 2500, [250, 250, 300, None]),
+    ("LARGE", 10000, [500, 400, 600, 750]),
+]
+COLORS = ["RED", "GREEN", "BLUE", "DARK"]
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def bootstrap():
+    """ Migrates the schema and seeds the starter recipes into an empty potion_inventory. """
+    import sqlalchemy
+    from src import database as db
+    from src import migrate
+    from src import potions
+
+    migrate.upgrade()
+    with db.engine.begin() as connection:
+        if connection.execute(sqlalchemy.text("SELECT 1 FROM potion_inventory LIMIT 1")).first() is None:
+            connection.execute(db.potion_inventory.insert(), [{
+                'sku': sku, 'name': name, 'price': price,
+                'red_ml': recipe[0], 'green_ml': recipe[1], 'blue_ml': recipe[2], 'dark_ml': recipe[3]
+            } for sku, name, price, recipe in STARTER_RECIPES])
+    potions.invalidate()
+
+
+def wholesale_catalog(rng):
+    offers = []
+    for size, ml, prices in WHOLESALE:
+        for color, (name, price) in enumerate(zip(COLORS, prices)):
+            if price is None:
+                continue
+            potion_type = [0, 0, 0, 0]
+            potion_type[color] = 1
+            offers.append({"sku": f"{size}_{name}_BARREL", "ml_per_barrel": ml, "potion_type": potion_type,
+                           "price": price, "quantity": rng.randint(1, 10)})
+    return offers
+
+
+class Simulator:
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.timings = {}
+        self.errors = {}
+        self.order_id = 0
+        self.visit_id = 0
+        self.carts_checked_out = 0
+        self.potions_sold = 0
+
+    async def call(self, name, method, path, body=None):
+        """ Sends one request, timing it under the endpoint's name. Returns the JSON body, or None on failure. """
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, json=body)
+        except httpx.HTTPError:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return None
+        self.timings.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+        if response.status_code >= 400:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return None
+        return response.json()
+
+    def next_order_id(self):
+        self.order_id += 1
+        return self.order_id
+
+    async def start(self):
+        await self.call("POST /admin/reset", "POST", "/admin/reset")
+        if self.args.starter_ml:
+            # Free barrels, so the shop has ml to bottle even while purchasing is paused
+            starter = [{"sku": f"STARTER_{name}_BARREL", "ml_per_barrel": self.args.starter_ml,
+                        "potion_type": [int(color == index) for index in range(4)], "price": 0, "quantity": 1}
+                       for color, name in enumerate(COLORS)]
+            await self.call("POST /barrels/deliver/{order_id}", "POST", f"/barrels/deliver/{self.next_order_id()}",
+                            starter)
+
+    async def tick(self, day, hour):
+        await self.call("POST /info/current_time", "POST", "/info/current_time", {"day": day, "hour": hour})
+
+        catalog = await self.call("GET /catalog/", "GET", "/catalog/") or []
+        customers = [{"customer_name": f"customer-{self.visit_id}-{number}",
+                      "character_class": self.rng.choice(CLASSES),
+                      "level": self.rng.randint(1, 20)} for number in range(self.args.customers)]
+        self.visit_id += 1
+        await self.call("POST /carts/visits/{visit_id}", "POST", f"/carts/visits/{self.visit_id}", customers)
+
+        # Decide up front who buys what, so the run doesn't depend on scheduling
+        orders = []
+        for customer in customers:
+            if catalog and self.rng.random() < self.args.buy_rate:
+                item = self.rng.choice(catalog)
+                orders.append((customer, item["sku"], self.rng.randint(1, min(3, item["quantity"]))))
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        await asyncio.gather(*[self.shop(semaphore, *order) for order in orders])
+
+        bottle_plan = await self.call("POST /bottler/plan", "POST", "/bottler/plan")
+        if bottle_plan:
+            await self.call("POST /bottler/deliver/{order_id}", "POST", f"/bottler/deliver/{self.next_order_id()}",
+                            bottle_plan)
+
+        if hour in BARREL_HOURS:
+            offers = wholesale_catalog(self.rng)
+            barrel_plan = await self.call("POST /barrels/plan", "POST", "/barrels/plan", offers)
+            if barrel_plan:
+                by_sku = {offer["sku"]: offer for offer in offers}
+                delivered = [{**by_sku[item["sku"]], "quantity": item["quantity"]}
+                             for item in barrel_plan if item["sku"] in by_sku]
+                await self.call("POST /barrels/deliver/{order_id}", "POST",
+                                f"/barrels/deliver/{self.next_order_id()}", delivered)
+
+        if hour == 0:
+            capacity = await self.call("POST /inventory/plan", "POST", "/inventory/plan")
+            if capacity and (capacity["potion_capacity"] or capacity["ml_capacity"]):
+                await self.call("POST /inventory/deliver/{order_id}", "POST",
+                                f"/inventory/deliver/{self.next_order_id()}", capacity)
+
+    async def shop(self, semaphore, customer, sku, quantity):
+        async with semaphore:
+            cart = await self.call("POST /carts/", "POST", "/carts/", customer)
+            if cart is None:
+                return
+            cart_id = cart["cart_id"]
+            if await self.call("POST /carts/{cart_id}/items/{item_sku}", "POST",
+                               f"/carts/{cart_id}/items/{sku}", {"quantity": quantity}) is None:
+                return
+            receipt = await self.call("POST /carts/{cart_id}/checkout", "POST", f"/carts/{cart_id}/checkout",
+                                      {"payment": "gold"})
+            if receipt is not None:
+                self.carts_checked_out += 1
+                self.potions_sold += receipt["total_potions_bought"]
+
+    async def run(self):
+        await self.start()
+        start = time.perf_counter()
+        for day_number in range(self.args.days):
+            for hour in range(0, 24, 2):
+                await self.tick(DAYS[day_number % len(DAYS)], hour)
+        elapsed = time.perf_counter() - start
+        audit = await self.call("GET /inventory/audit", "GET", "/inventory/audit")
+        return elapsed, audit
+
+    def report(self, elapsed, audit):
+        print(f"{'endpoint':<40} {'requests':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6}")
+        total = 0
+        for name, samples in sorted(self.timings.items()):
+            total += len(samples)
+            print(f"{name:<40} {len(samples):>8} {percentile(samples, 0.5):>8.1f} "
+                  f"{percentile(samples, 0.95):>8.1f} {percentile(samples, 0.99):>8.1f} {self.errors.get(name, 0):>6}")
+        print(f"\n{total} requests over {self.args.days * 12} ticks in {elapsed:.1f}s: {total / elapsed:.1f} req/s, "
+              f"{self.args.days * 12 / elapsed:.2f} ticks/s")
+        print(f"{self.carts_checked_out} carts checked out, {self.potions_sold} potions sold")
+        if audit:
+            print(f"final: gold {audit['gold']}, {audit['number_of_potions']} potions, "
+                  f"{audit['ml_in_barrels']} ml in barrels")
+
+
+async def simulate(args):
+    if args.url:
+        transport = None
+        base_url = args.url
+        api_key = args.api_key
+    else:
+        from src.api.server import app
+
+        transport = httpx.ASGITransport(app=app)
+        base_url = "http://simulator"
+        api_key = args.api_key or os.environ.get("API_KEY", "")
+
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, headers={"access_token": api_key},
+                                 limits=httpx.Limits(max_connections=args.concurrency), timeout=60) as client:
+        simulator = Simulator(client, args)
+        elapsed, audit = await simulator.run()
+    simulator.report(elapsed, audit)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="a running server; the app runs in-process if omitted")
+    parser.add_argument("--api-key", default="")
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--customers", type=int, default=20, help="customers visiting per tick")
+    parser.add_argument("--buy-rate", type=float, default=0.6, help="share of visitors who buy something")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--starter-ml", type=int, default=5000, help="free ml of every color at the start")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bootstrap", action="store_true", help="migrate the schema and add starter recipes first")
+    args = parser.parse_args()
+
+    if args.bootstrap:
+        bootstrap()
+    asyncio.run(simulate(args))
+
+
+if __name__ == "__main__":
+    main()
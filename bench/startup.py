@@ -0,0 +1,53 @@
+"""
+Cold start benchmark. Needs POSTGRES_URI for the first-request timing.
+
+Starts a fresh interpreter --runs times, like a serverless cold start, and
+measures how long `import src.api.server` takes and how long the first
+request (GET /catalog/ through the ASGI app) takes after that.
+
+    python -m bench.startup --runs 10
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+CHILD = """
+import json, time
+start = time.perf_counter()
+from src.api.server import app
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+client = TestClient(app)
+ready = time.perf_counter()
+response = client.get("/catalog/")
+done = time.perf_counter()
+print(json.dumps({"import": imported - start, "first_request": done - ready, "status": response.status_code}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    imports = []
+    first_requests = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, "-c", CHILD], capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if result["status"] != 200:
+            sys.exit(f"GET /catalog/ returned {result['status']}")
+        imports.append(result["import"] * 1000)
+        first_requests.append(result["first_request"] * 1000)
+
+    print(f"{'phase':<14} {'median ms':>10} {'max ms':>10}")
+    for name, samples in [("import", imports), ("first request", first_requests)]:
+        print(f"{name:<14} {statistics.median(samples):>10.1f} {max(samples):>10.1f}")
+    totals = [a + b for a, b in zip(imports, first_requests)]
+    print(f"{'total':<14} {statistics.median(totals):>10.1f} {max(totals):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+What-if simulator for the bottling and barrel rules. Loads a run's sales
+history and the shop's current state from the database, then replays
+--policies candidate policies side by side over --days game days, every
+policy a row of the same NumPy arrays, and reports the gold and stock-outs
+each one ends up with. The first row is the shop's current rules.
+
+A policy is three numbers:
+
+    bottle_share  most of one potion to bottle per tick, as a share of potion
+                  capacity (bottler.make_potions: capacity // 20)
+    stock_share   skip a potion once its stock reaches this share of potion
+                  capacity (capacity // 8)
+    ml_target     on barrel ticks, buy ml up to this share of ml capacity,
+                  split by barrels.TARGET_ML_MIX (0 = don't buy, which is what
+                  barrels.PURCHASING_PAUSED does)
+
+The model is deliberately simple:
+- Demand per potion and tick is the run's average sales at that game weekday
+  and hour (potion_sales_rollup over the ticks seen in time_table). Every
+  trial draws Poisson demand around it, and all policies see the same draws.
+- The catalog offers the six in-stock potions with the most expected demand.
+- Bottling fills potions greedily, most expensive first, within the ml and
+  capacity left.
+- Barrels are bought as plain ml at the run's average gold per ml and color
+  (--ml-price when the run bought none). Capacity stays fixed.
+
+Observed sales only count what was in stock, so demand for potions that
+sold out is underestimated.
+
+    pip install -r bench/requirements.txt
+    python -m bench.whatif --policies 5000 --days 7 --trials 4 --workers 4
+"""
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+import numpy as np
+import sqlalchemy
+
+DAYS = ["Hearthday", "Crownday", "Blesseday", "Soulday", "Edgeday", "Bloomday", "Arcanaday"]
+HOURS = list(range(0, 24, 2))
+BARREL_HOURS = {2, 6, 10, 14, 18, 22}
+COLORS = ["red", "green", "blue", "dark"]
+CATALOG_SIZE = 6
+
+# bottler.make_potions' constants: capacity // 20 per potion, none past capacity // 8
+CURRENT_BOTTLE_SHARE = 1 / 20
+CURRENT_STOCK_SHARE = 1 / 8
+
+
+class History(NamedTuple):
+    recipes: np.ndarray      # (potions, 4) ml of each color per potion
+    prices: np.ndarray       # (potions,)
+    demand: np.ndarray       # (len(DAYS) * len(HOURS), potions) expected sales per tick
+    ml_price: np.ndarray     # (4,) gold per ml of each color
+    start_slot: int          # index into demand of the tick after the current one
+    gold: float
+    ml: np.ndarray           # (4,)
+    stock: np.ndarray        # (potions,)
+    ml_capacity: float
+    potion_capacity: float
+    target_mix: np.ndarray   # (4,) barrels.TARGET_ML_MIX
+
+
+def load_history(connection, run_id=None, default_ml_price=0.1):
+    """ Sales rates, prices and the shop's current balances, from one run (the current one by default). """
+    from src import ledger
+    from src import potions
+    from src.api import barrels
+
+    registry = potions.all_potions(connection)
+    index = {potion.id: position for position, potion in enumerate(registry)}
+    slots = {(day, hour): DAYS.index(day) * len(HOURS) + HOURS.index(hour) for day in DAYS for hour in HOURS}
+    params = {"run_id": run_id}
+
+    # How many times each (day, hour) tick happened in the run, and what sold during them
+    seen = np.zeros(len(slots))
+    for row in connection.execute(sqlalchemy.text("""
+        SELECT day, hour, COUNT(*) AS ticks
+        FROM time_table
+        WHERE run_id = COALESCE(CAST(:run_id AS integer), current_run_id())
+        GROUP BY day, hour
+    """), params):
+        if (row.day, row.hour) in slots:
+            seen[slots[(row.day, row.hour)]] = row.ticks
+
+    sold = np.zeros((len(slots), len(registry)))
+    for row in connection.execute(sqlalchemy.text("""
+        SELECT potion_id, day, hour, quantity
+        FROM potion_sales_rollup
+        WHERE run_id = COALESCE(CAST(:run_id AS integer), current_run_id())
+    """), params):
+        if (row.day, row.hour) in slots and row.potion_id in index:
+            sold[slots[(row.day, row.hour)], index[row.potion_id]] += row.quantity
+
+    demand = np.zeros_like(sold)
+    observed = seen > 0
+    demand[observed] = sold[observed] / seen[observed, None]
+    # Ticks the run never reached get the potion's average over the ones it did
+    if observed.any():
+        demand[~observed] = demand[observed].mean(axis=0)
+
+    # Average gold per ml of the barrels bought in the run (free starter barrels don't count)
+    ml_price = np.full(len(COLORS), default_ml_price)
+    for row in connection.execute(sqlalchemy.text("""
+        WITH deliveries AS MATERIALIZED (
+            SELECT barrel_type, transaction
+            FROM ml_ledger
+            WHERE run_id = COALESCE(CAST(:run_id AS integer), current_run_id()) AND function = 'deliver_barrels'
+        )
+        SELECT d.barrel_type,
+               SUM(CAST(b->>'price' AS numeric) * CAST(b->>'quantity' AS numeric)) AS gold,
+               SUM(CAST(b->>'ml_per_barrel' AS numeric) * CAST(b->>'quantity' AS numeric)) AS ml
+        FROM deliveries d, jsonb_array_elements(CAST(d.transaction AS jsonb)) AS b
+        WHERE CAST(b->>'price' AS numeric) > 0
+        GROUP BY d.barrel_type
+    """), params):
+        if row.barrel_type in COLORS and row.ml:
+            ml_price[COLORS.index(row.barrel_type)] = float(row.gold / row.ml)
+
+    latest = connection.execute(sqlalchemy.text("""
+        SELECT day, hour FROM time_table
+        WHERE run_id = COALESCE(CAST(:run_id AS integer), current_run_id())
+        ORDER BY created_at DESC LIMIT 1
+    """), params).first()
+    start_slot = (slots.get((latest.day, latest.hour), -1) + 1) % len(slots) if latest else 0
+
+    gold, ml_capacity, potion_capacity = ledger.get_shop_balance(connection)
+    ml = ledger.get_ml(connection)
+    stock = ledger.get_potions(connection)
+
+    return History(
+        recipes=np.array([potion.recipe for potion in registry], dtype=float).reshape(-1, 4),
+        prices=np.array([potion.price for potion in registry], dtype=float),
+        demand=demand,
+        ml_price=ml_price,
+        start_slot=start_slot,
+        gold=float(gold),
+        ml=np.array([ml[color] for color in COLORS], dtype=float),
+        stock=np.array([stock.get(potion.id, 0) for potion in registry], dtype=float),
+        ml_capacity=float(ml_capacity),
+        potion_capacity=float(potion_capacity),
+        target_mix=np.array([barrels.TARGET_ML_MIX.get(color, 0) for color in COLORS], dtype=float),
+    )
+
+
+def candidate_policies(count, rng, current_ml_target):
+    """ (count, 3) array of [bottle_share, stock_share, ml_target]; row 0 is the current rules. """
+    policies = np.column_stack([
+        rng.uniform(0.01, 0.25, count),
+        rng.uniform(0.05, 0.6, count),
+        rng.uniform(0.0, 1.0, count),
+    ])
+    policies[0] = [CURRENT_BOTTLE_SHARE, CURRENT_STOCK_SHARE, current_ml_target]
+    return policies
+
+
+def simulate(history, policies, days, trials, seed):
+    """
+    Plays every policy over `days` game days, `trials` times. Returns (gold,
+    potions sold, stock-out rate), each of shape (policies,), averaged over trials.
+    """
+    count = len(policies)
+    bottle_share, stock_share, ml_target = policies.T
+    potion_cap = np.floor(bottle_share * history.potion_capacity)[:, None]
+    stock_cap = (stock_share * history.potion_capacity)[:, None]
+    ml_goal = ml_target[:, None] * history.ml_capacity * history.target_mix
+    by_price = np.argsort(-history.prices, kind="stable")
+    needs = history.recipes > 0
+
+    # Same demand draws for every policy (and every chunk of policies), so they're compared on equal terms
+    rng = np.random.default_rng(seed)
+    ticks = days * len(HOURS)
+    slots = (history.start_slot + np.arange(ticks)) % len(history.demand)
+    draws = rng.poisson(history.demand[slots], size=(trials, ticks, len(history.prices)))
+
+    totals = np.zeros((3, count))
+    for trial in range(trials):
+        gold = np.full(count, history.gold)
+        ml = np.tile(history.ml, (count, 1))
+        stock = np.tile(history.stock, (count, 1))
+        sold_total = np.zeros(count)
+        wanted_total = np.zeros(count)
+        missed_total = np.zeros(count)
+
+        for tick, slot in enumerate(slots):
+            hour = HOURS[slot % len(HOURS)]
+
+            # Customers: the six in-stock potions with the most expected demand are on offer
+            order = np.argsort(-history.demand[slot], kind="stable")
+            in_stock = stock[:, order] > 0
+            offered = np.zeros_like(in_stock)
+            offered[:, order] = in_stock & (np.cumsum(in_stock, axis=1) <= CATALOG_SIZE)
+            wanted = draws[trial, tick]
+            sold = np.where(offered, np.minimum(stock, wanted), 0)
+            stock -= sold
+            gold += sold @ history.prices
+            sold_total += sold.sum(axis=1)
+            wanted_total += wanted.sum()
+            missed_total += (wanted - sold).sum(axis=1)
+
+            # Bottling, most expensive potion first
+            room = np.maximum(0, history.potion_capacity - stock.sum(axis=1))
+            for potion in by_price:
+                recipe = history.recipes[potion]
+                if not needs[potion].any():
+                    continue
+                makeable = np.min(ml[:, needs[potion]] // recipe[needs[potion]], axis=1)
+                quantity = np.minimum(np.minimum(potion_cap[:, 0], room), makeable)
+                quantity = np.where(stock[:, potion] >= stock_cap[:, 0], 0, np.maximum(quantity, 0))
+                stock[:, potion] += quantity
+                ml -= quantity[:, None] * recipe
+                room -= quantity
+
+            # Barrels, as ml at the average price, scaled down to the gold we have
+            if hour in BARREL_HOURS:
+                deficit = np.maximum(0, ml_goal - ml)
+                cost = deficit @ history.ml_price
+                affordable = np.clip(gold / np.maximum(cost, 1e-9), 0, 1)
+                bought = np.floor(deficit * affordable[:, None])
+                ml += bought
+                gold -= bought @ history.ml_price
+
+        totals += [gold, sold_total, np.where(wanted_total > 0, missed_total / np.maximum(wanted_total, 1), 0)]
+
+    return tuple(totals / trials)
+
+
+def _simulate_chunk(arguments):
+    return simulate(*arguments)
+
+
+def run(history, policies, days, trials, seed, workers):
+    """ simulate() over all policies, split across `workers` processes when there's more than one. """
+    if workers <= 1:
+        return simulate(history, policies, days, trials, seed)
+
+    chunks = np.array_split(policies, workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_simulate_chunk, [(history, chunk, days, trials, seed) for chunk in chunks]))
+    return tuple(np.concatenate([result[part] for result in results]) for part in range(3))
+
+
+def report(history, policies, results, top):
+    gold, sold, stockouts = results
+    print(f"start: gold {history.gold:.0f}, {history.stock.sum():.0f} potions, {history.ml.sum():.0f} ml, "
+          f"capacity {history.potion_capacity:.0f} potions / {history.ml_capacity:.0f} ml")
+    print(f"ml price per color: {', '.join(f'{color} {price:.3f}' for color, price in zip(COLORS, history.ml_price))}")
+    print(f"expected demand: {history.demand.sum() / len(history.demand):.1f} potions per tick\n")
+
+    print(f"{'rank':>5} {'bottle':>7} {'stock':>7} {'ml':>6} {'gold':>10} {'sold':>8} {'stock-outs':>10}")
+    ranking = np.argsort(-gold, kind="stable")
+    rank_of = np.empty(len(ranking), dtype=int)
+    rank_of[ranking] = np.arange(1, len(ranking) + 1)
+    for index in list(ranking[:top]) + ([0] if rank_of[0] > top else []):
+        label = " (current)" if index == 0 else ""
+        bottle_share, stock_share, ml_target = policies[index]
+        print(f"{rank_of[index]:>5} {bottle_share:>7.3f} {stock_share:>7.3f} {ml_target:>6.2f} {gold[index]:>10.0f} "
+              f"{sold[index]:>8.0f} {stockouts[index]:>9.1%}{label}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--policies", type=int, default=2000, help="candidate policies, including the current one")
+    parser.add_argument("--days", type=int, default=7, help="game days to play")
+    parser.add_argument("--trials", type=int, default=4, help="demand draws to average over")
+    parser.add_argument("--run-id", type=int, help="run to learn from; the current one by default")
+    parser.add_argument("--ml-price", type=float, default=0.1, help="gold per ml when the run bought no barrels")
+    parser.add_argument("--workers", type=int, default=1, help="processes to split the policies across")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from src import database as db
+    from src.api import barrels
+
+    with db.engine.begin() as connection:
+        history = load_history(connection, args.run_id, args.ml_price)
+
+    current_ml_target = 0.0 if barrels.PURCHASING_PAUSED else float(history.target_mix.sum())
+    policies = candidate_policies(max(1, args.policies), np.random.default_rng(args.seed), current_ml_target)
+
+    start = time.perf_counter()
+    results = run(history, policies, args.days, args.trials, args.seed, args.workers)
+    elapsed = time.perf_counter() - start
+
+    report(history, policies, results, args.top)
+    print(f"\n{len(policies)} policies x {args.trials} trials x {args.days * len(HOURS)} ticks "
+          f"in {elapsed:.2f}s ({len(policies) * args.trials / elapsed:.0f} policy-seasons/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+-- The tables the shop started with, as they were created by hand in Supabase.
+-- Later migrations partition the run tables and add everything else.
+
+CREATE TABLE IF NOT EXISTS potion_inventory (
+    id serial PRIMARY KEY,
+    sku text,
+    name text,
+    price integer,
+    red_ml integer,
+    green_ml integer,
+    blue_ml integer,
+    dark_ml integer
+);
+
+CREATE TABLE IF NOT EXISTS carts (
+    id serial PRIMARY KEY,
+    name text,
+    class text,
+    level integer,
+    created_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS cart_items (
+    id serial PRIMARY KEY,
+    cart_id integer,
+    potion_id integer,
+    item_sku text,
+    quantity integer,
+    price integer,
+    day text,
+    hour integer,
+    created_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS gold_ledger (
+    id serial PRIMARY KEY,
+    net_change integer,
+    function text,
+    transaction text,
+    day text,
+    hour integer,
+    created_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS ml_ledger (
+    id serial PRIMARY KEY,
+    net_change integer,
+    barrel_type text,
+    function text,
+    transaction text,
+    day text,
+    hour integer,
+    created_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS potion_ledger (
+    id serial PRIMARY KEY,
+    potion_id integer,
+    quantity integer,
+    function text,
+    transaction text,
+    cost integer,
+    day text,
+    hour integer,
+    created_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS capacity_ledger (
+    id serial PRIMARY KEY,
+    ml_capacity integer,
+    potion_capacity integer,
+    created_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS time_table (
+    id serial PRIMARY KEY,
+    day text,
+    hour integer,
+    created_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS dark_order_tracker (
+    id serial PRIMARY KEY,
+    day text,
+    hour integer,
+    created_at timestamp with time zone NOT NULL DEFAULT now()
+);
@@ -0,0 +1,98 @@
+"""
+Partitions the ledgers, carts, cart_items and time_table by run (see
+src/runs.py). The rows already there become run 1. Tables that are already
+partitioned are left alone.
+"""
+import sqlalchemy
+
+TABLES = ['gold_ledger', 'ml_ledger', 'potion_ledger', 'capacity_ledger', 'carts', 'cart_items', 'time_table']
+
+
+def upgrade(connection):
+    connection.execute(sqlalchemy.text("""
+        CREATE TABLE IF NOT EXISTS runs (
+            id serial PRIMARY KEY,
+            started_at timestamptz NOT NULL DEFAULT now()
+        )
+    """))
+    connection.execute(sqlalchemy.text("""
+        INSERT INTO runs (id) SELECT 1 WHERE NOT EXISTS (SELECT 1 FROM runs)
+    """))
+    connection.execute(sqlalchemy.text("""
+        SELECT setval('runs_id_seq', (SELECT max(id) FROM runs))
+    """))
+
+    # STABLE, so it is evaluated once per statement and partition pruning can use it
+    connection.execute(sqlalchemy.text("""
+        CREATE OR REPLACE FUNCTION current_run_id() RETURNS integer
+        LANGUAGE sql STABLE AS $$ SELECT max(id) FROM runs $$
+    """))
+
+    for table in TABLES:
+        partitioned = connection.execute(sqlalchemy.text("""
+            SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table)
+        """), {"table": table}).scalar()
+        if not partitioned:
+            _partition(connection, table)
+
+
+def _partition(connection, table):
+    """ Moves `table` under a new partitioned parent of the same name, as the partition for run 1. """
+    history = f"{table}_run_1"
+
+    has_run_id = connection.execute(sqlalchemy.text("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = :table AND column_name = 'run_id'
+    """), {"table": table}).first() is not None
+    if has_run_id:
+        connection.execute(sqlalchemy.text(f"UPDATE {table} SET run_id = 1 WHERE run_id IS NULL"))
+        connection.execute(sqlalchemy.text(f"ALTER TABLE {table} ALTER COLUMN run_id SET NOT NULL"))
+    else:
+        # A constant default, so Postgres doesn't rewrite the table to add the column
+        connection.execute(sqlalchemy.text(f"ALTER TABLE {table} ADD COLUMN run_id integer NOT NULL DEFAULT 1"))
+
+    # Plain indexes are recreated on the parent later under their old names, which makes
+    # Postgres adopt the existing index on the history partition instead of building a new one.
+    # Unique indexes can't be on the parent unless they include run_id, so they stay put.
+    indexes = connection.execute(sqlalchemy.text("""
+        SELECT i.relname AS name, pg_get_indexdef(i.oid) AS definition
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE x.indrelid = to_regclass(:table) AND NOT x.indisunique
+    """), {"table": table}).fetchall()
+    for index in indexes:
+        connection.execute(sqlalchemy.text(f"ALTER INDEX {index.name} RENAME TO {index.name}_run_1"))
+
+    # The parent's primary key is (run_id, id), which the history partition gets when it is
+    # attached, so its old primary key on id alone has to go. If a foreign key still refers to
+    # it this fails and the whole migration rolls back.
+    primary_key = connection.execute(sqlalchemy.text("""
+        SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(:table) AND contype = 'p'
+    """), {"table": table}).scalar()
+    if primary_key is not None:
+        connection.execute(sqlalchemy.text(f"ALTER TABLE {table} DROP CONSTRAINT {primary_key}"))
+
+    connection.execute(sqlalchemy.text(f"ALTER TABLE {table} RENAME TO {history}"))
+    connection.execute(sqlalchemy.text(f"""
+        CREATE TABLE {table} (LIKE {history} INCLUDING DEFAULTS INCLUDING IDENTITY) PARTITION BY LIST (run_id)
+    """))
+    connection.execute(sqlalchemy.text(f"ALTER TABLE {table} ALTER COLUMN run_id SET DEFAULT current_run_id()"))
+    connection.execute(sqlalchemy.text(f"ALTER TABLE {table} ADD CONSTRAINT {table}_run_id_id_pkey PRIMARY KEY (run_id, id)"))
+
+    # Keep ids growing from where the old table left off. A serial id's sequence moves to the
+    # parent (so dropping old partitions can't take it along); an identity id gets a new
+    # sequence on the parent, which is started past the existing ids.
+    history_sequence, parent_sequence = connection.execute(sqlalchemy.text("""
+        SELECT pg_get_serial_sequence(:history, 'id'), pg_get_serial_sequence(:table, 'id')
+    """), {"history": history, "table": table}).one()
+    if parent_sequence is not None:
+        connection.execute(sqlalchemy.text(f"""
+            SELECT setval(:sequence, COALESCE(MAX(id), 0) + 1, false) FROM {history}
+        """), {"sequence": parent_sequence})
+    elif history_sequence is not None:
+        connection.execute(sqlalchemy.text(f"ALTER SEQUENCE {history_sequence} OWNED BY {table}.id"))
+
+    connection.execute(sqlalchemy.text(f"ALTER TABLE {table} ATTACH PARTITION {history} FOR VALUES IN (1)"))
+
+    for index in indexes:
+        connection.execute(sqlalchemy.text(index.definition))
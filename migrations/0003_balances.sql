@@ -0,0 +1,46 @@
+-- Running balances next to the ledgers (see src/ledger.py), filled from the
+-- current run's ledgers.
+
+CREATE TABLE IF NOT EXISTS shop_balance (
+    id integer PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    gold bigint NOT NULL DEFAULT 0,
+    ml_capacity bigint NOT NULL DEFAULT 0,
+    potion_capacity bigint NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS ml_balance (
+    barrel_type text PRIMARY KEY,
+    ml bigint NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS potion_balance (
+    potion_id integer PRIMARY KEY,
+    quantity bigint NOT NULL DEFAULT 0
+);
+
+-- Block ledger writers for the rest of the transaction so nothing lands between the sums
+LOCK TABLE gold_ledger, ml_ledger, potion_ledger, capacity_ledger IN SHARE MODE;
+
+DELETE FROM shop_balance;
+DELETE FROM ml_balance;
+DELETE FROM potion_balance;
+
+INSERT INTO shop_balance (id, gold, ml_capacity, potion_capacity)
+SELECT 1,
+       (SELECT COALESCE(SUM(net_change), 0) FROM gold_ledger WHERE run_id = current_run_id()),
+       COALESCE(SUM(ml_capacity), 0),
+       COALESCE(SUM(potion_capacity), 0)
+FROM capacity_ledger
+WHERE run_id = current_run_id();
+
+INSERT INTO ml_balance (barrel_type, ml)
+SELECT barrel_type, SUM(net_change)
+FROM ml_ledger
+WHERE run_id = current_run_id()
+GROUP BY barrel_type;
+
+INSERT INTO potion_balance (potion_id, quantity)
+SELECT potion_id, SUM(quantity)
+FROM potion_ledger
+WHERE run_id = current_run_id()
+GROUP BY potion_id;
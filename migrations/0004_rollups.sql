@@ -0,0 +1,38 @@
+-- Sales and daily gold rollups behind /analytics (see src/analytics.py),
+-- filled from the current run's ledgers. Sales without a game time are filed
+-- under day '' and hour -1.
+
+CREATE TABLE IF NOT EXISTS potion_sales_rollup (
+    run_id integer NOT NULL DEFAULT current_run_id(),
+    potion_id integer NOT NULL,
+    day text NOT NULL,
+    hour integer NOT NULL,
+    quantity bigint NOT NULL DEFAULT 0,
+    gold bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (run_id, potion_id, day, hour)
+);
+
+CREATE TABLE IF NOT EXISTS daily_gold_rollup (
+    run_id integer NOT NULL DEFAULT current_run_id(),
+    real_day date NOT NULL,
+    day text NOT NULL,
+    gold bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (run_id, real_day, day)
+);
+
+LOCK TABLE gold_ledger, potion_ledger IN SHARE MODE;
+
+DELETE FROM potion_sales_rollup WHERE run_id = current_run_id();
+INSERT INTO potion_sales_rollup (potion_id, day, hour, quantity, gold)
+SELECT potion_id, COALESCE(day, ''), COALESCE(hour, -1), -SUM(quantity), SUM(cost)
+FROM potion_ledger
+WHERE run_id = current_run_id() AND function = 'sale'
+GROUP BY 1, 2, 3;
+
+-- A "real day" starts at 18:00 UTC
+DELETE FROM daily_gold_rollup WHERE run_id = current_run_id();
+INSERT INTO daily_gold_rollup (real_day, day, gold)
+SELECT CAST(created_at - interval '18 hours' AS date), day, SUM(net_change)
+FROM gold_ledger
+WHERE run_id = current_run_id() AND day IS NOT NULL
+GROUP BY 1, 2;
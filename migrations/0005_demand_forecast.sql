@@ -0,0 +1,20 @@
+-- demand_forecast and catalog_offers (see src/forecast.py).
+
+CREATE TABLE IF NOT EXISTS demand_forecast (
+    potion_id integer NOT NULL,
+    day text NOT NULL,
+    hour integer NOT NULL,
+    expected double precision NOT NULL,
+    observations integer NOT NULL,
+    run_id integer NOT NULL,
+    run_quantity bigint NOT NULL,
+    PRIMARY KEY (potion_id, day, hour)
+);
+
+-- The last tick each potion was shown in the catalog
+CREATE TABLE IF NOT EXISTS catalog_offers (
+    potion_id integer PRIMARY KEY,
+    run_id integer NOT NULL,
+    day text NOT NULL,
+    hour integer NOT NULL
+);
@@ -0,0 +1,10 @@
+-- Idempotency keys for the delivery endpoints (see src/idempotency.py).
+
+CREATE TABLE IF NOT EXISTS delivery_orders (
+    run_id integer NOT NULL DEFAULT current_run_id(),
+    endpoint text NOT NULL,
+    order_id bigint NOT NULL,
+    result jsonb,
+    created_at timestamp with time zone NOT NULL DEFAULT now(),
+    PRIMARY KEY (run_id, endpoint, order_id)
+);
@@ -0,0 +1,23 @@
+-- One line per sku in a cart: the unique index set_cart_items upserts on. It
+-- has to include run_id, the partition key. Carts that already have several
+-- lines for a sku are merged first into the latest line, with the quantities
+-- added up, which is how checkout counted them.
+
+WITH merged AS (
+    SELECT run_id, cart_id, item_sku, MAX(id) AS keep_id, SUM(quantity) AS quantity
+    FROM cart_items
+    GROUP BY run_id, cart_id, item_sku
+    HAVING COUNT(*) > 1
+),
+dropped AS (
+    DELETE FROM cart_items ci
+    USING merged
+    WHERE ci.run_id = merged.run_id AND ci.cart_id = merged.cart_id
+      AND ci.item_sku = merged.item_sku AND ci.id <> merged.keep_id
+)
+UPDATE cart_items ci
+SET quantity = merged.quantity
+FROM merged
+WHERE ci.run_id = merged.run_id AND ci.id = merged.keep_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS cart_items_run_id_cart_id_item_sku_key ON cart_items (run_id, cart_id, item_sku);
@@ -0,0 +1,10 @@
+-- Indexes for each sort order of /carts/search, so each sort order (and each
+-- keyset page) is an index range scan instead of a sort of every line item.
+-- Search moved to order_search in 0012, and 0013 drops all of these except
+-- cart_items_cart_id_id_idx, which checkout reads a cart's lines with.
+
+CREATE INDEX IF NOT EXISTS cart_items_created_at_id_idx ON cart_items (created_at, id);
+CREATE INDEX IF NOT EXISTS cart_items_item_sku_id_idx ON cart_items (item_sku, id);
+CREATE INDEX IF NOT EXISTS cart_items_line_total_id_idx ON cart_items ((quantity * price), id);
+CREATE INDEX IF NOT EXISTS cart_items_cart_id_id_idx ON cart_items (cart_id, id);
+CREATE INDEX IF NOT EXISTS carts_name_id_idx ON carts (name, id);
@@ -0,0 +1,15 @@
+-- NOTIFY on potion_inventory changes, for the potion registry's listener
+-- (see src/potions.py, which LISTENs on the same channel).
+
+CREATE OR REPLACE FUNCTION notify_potion_inventory_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('potion_inventory_changed', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS potion_inventory_changed ON potion_inventory;
+
+CREATE TRIGGER potion_inventory_changed
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON potion_inventory
+FOR EACH STATEMENT EXECUTE FUNCTION notify_potion_inventory_changed();
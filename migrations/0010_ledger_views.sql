@@ -0,0 +1,41 @@
+-- The ledger total views, as inventory.create_views defined them when this
+-- migration was written. They read the current run only.
+
+CREATE OR REPLACE VIEW ml_totals_view AS
+SELECT barrel_type, SUM(net_change) AS total_ml
+FROM ml_ledger
+WHERE run_id = current_run_id()
+GROUP BY barrel_type;
+
+CREATE OR REPLACE VIEW total_gold_view AS
+SELECT SUM(net_change) AS total_gold
+FROM gold_ledger
+WHERE run_id = current_run_id();
+
+CREATE OR REPLACE VIEW potion_view AS
+SELECT potion_id, SUM(quantity) AS total_potions
+FROM potion_ledger
+WHERE run_id = current_run_id()
+GROUP BY potion_id;
+
+CREATE OR REPLACE VIEW capacity_view AS
+SELECT SUM(ml_capacity) AS ml_cap, SUM(potion_capacity) AS pot_cap
+FROM capacity_ledger
+WHERE run_id = current_run_id();
+
+CREATE OR REPLACE VIEW potion_quantities_sold AS
+SELECT item_sku, SUM(quantity) AS total_quantity
+FROM cart_items
+WHERE run_id = current_run_id()
+GROUP BY item_sku
+ORDER BY SUM(quantity) ASC;
+
+CREATE OR REPLACE VIEW total_ml_view AS
+SELECT SUM(net_change) AS total_ml
+FROM ml_ledger
+WHERE run_id = current_run_id();
+
+CREATE OR REPLACE VIEW total_potions_view AS
+SELECT SUM(quantity) AS total_potions
+FROM potion_ledger
+WHERE run_id = current_run_id();
@@ -0,0 +1,20 @@
+-- Indexes for the predicates the endpoints and the maintenance commands filter
+-- and sort on. The ledger, cart and time tables are partitioned by run_id and
+-- queries prune to the current run's partition, so the indexes lead with the
+-- column inside the partition; creating them on the parent creates them on
+-- every partition, now and later.
+--
+-- cart_items(cart_id) is covered by cart_items_cart_id_id_idx (0008) and the
+-- (run_id, cart_id, item_sku) key (0007).
+
+-- the latest tick (game_clock.now): ORDER BY created_at DESC LIMIT 1
+CREATE INDEX IF NOT EXISTS time_table_created_at_idx ON time_table (created_at);
+
+-- per potion and per color sums (ledger.rebuild_balances, reconcile, the ledger views)
+CREATE INDEX IF NOT EXISTS potion_ledger_potion_id_idx ON potion_ledger (potion_id);
+CREATE INDEX IF NOT EXISTS ml_ledger_barrel_type_idx ON ml_ledger (barrel_type);
+
+-- potion lookups by sku and by recipe. Not unique, since older databases may
+-- hold duplicate skus.
+CREATE INDEX IF NOT EXISTS potion_inventory_sku_idx ON potion_inventory (sku);
+CREATE INDEX IF NOT EXISTS potion_inventory_recipe_idx ON potion_inventory (red_ml, green_ml, blue_ml, dark_ml);
@@ -0,0 +1,75 @@
+"""
+The denormalized search table behind /carts/search/ (see
+src/order_search.py), partitioned by run, filled from the sales already in
+the ledger, with trigram indexes where pg_trgm is available.
+"""
+import logging
+import sqlalchemy
+
+logger = logging.getLogger(__name__)
+
+
+def upgrade(connection):
+    connection.execute(sqlalchemy.text("""
+        CREATE TABLE IF NOT EXISTS order_search (
+            run_id integer NOT NULL DEFAULT current_run_id(),
+            line_item_id integer NOT NULL,
+            cart_id integer NOT NULL,
+            customer_name text,
+            item_sku text,
+            line_item_total bigint,
+            created_at timestamp with time zone NOT NULL,
+            PRIMARY KEY (run_id, line_item_id)
+        ) PARTITION BY LIST (run_id)
+    """))
+
+    # A partition for every run that still has its cart partitions
+    run_ids = connection.execute(sqlalchemy.text("""
+        SELECT id FROM runs WHERE to_regclass('cart_items_run_' || id) IS NOT NULL ORDER BY id
+    """)).scalars().all()
+    for run_id in run_ids:
+        connection.execute(sqlalchemy.text(f"""
+            CREATE TABLE IF NOT EXISTS order_search_run_{run_id} PARTITION OF order_search FOR VALUES IN ({run_id})
+        """))
+
+    # The line items of every cart with a sale in the ledger
+    connection.execute(sqlalchemy.text(r"""
+        WITH sales AS (
+            SELECT DISTINCT run_id, potion_id,
+                   CAST(substring(transaction from '"cart_id"\s*:\s*(\d+)') AS integer) AS cart_id
+            FROM potion_ledger
+            WHERE function = 'sale'
+        )
+        INSERT INTO order_search (run_id, line_item_id, cart_id, customer_name, item_sku, line_item_total, created_at)
+        SELECT ci.run_id, ci.id, ci.cart_id, c.name, ci.item_sku, ci.quantity * ci.price, ci.created_at
+        FROM sales
+        JOIN cart_items ci ON ci.run_id = sales.run_id AND ci.cart_id = sales.cart_id AND ci.potion_id = sales.potion_id
+        JOIN carts c ON c.run_id = ci.run_id AND c.id = ci.cart_id
+        WHERE to_regclass('order_search_run_' || ci.run_id) IS NOT NULL
+        ON CONFLICT (run_id, line_item_id) DO NOTHING
+    """))
+
+    connection.execute(sqlalchemy.text(
+        "CREATE INDEX IF NOT EXISTS order_search_created_at_idx ON order_search (created_at, line_item_id)"))
+    connection.execute(sqlalchemy.text(
+        "CREATE INDEX IF NOT EXISTS order_search_customer_name_idx ON order_search (customer_name, cart_id, line_item_id)"))
+    connection.execute(sqlalchemy.text(
+        "CREATE INDEX IF NOT EXISTS order_search_item_sku_idx ON order_search (item_sku, line_item_id)"))
+    connection.execute(sqlalchemy.text(
+        "CREATE INDEX IF NOT EXISTS order_search_line_item_total_idx ON order_search (line_item_total, line_item_id)"))
+
+    # Substring search (ILIKE '%...%') needs pg_trgm, which isn't always available
+    if connection.execute(sqlalchemy.text(
+            "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).first() is None:
+        logger.warning("pg_trgm isn't available on this server; substring search won't be indexed")
+        return
+    try:
+        with connection.begin_nested():
+            connection.execute(sqlalchemy.text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except sqlalchemy.exc.DBAPIError as error:
+        logger.warning("Couldn't install pg_trgm (%s); substring search won't be indexed", error.orig)
+        return
+    connection.execute(sqlalchemy.text(
+        "CREATE INDEX IF NOT EXISTS order_search_customer_name_trgm_idx ON order_search USING gin (customer_name gin_trgm_ops)"))
+    connection.execute(sqlalchemy.text(
+        "CREATE INDEX IF NOT EXISTS order_search_item_sku_trgm_idx ON order_search USING gin (item_sku gin_trgm_ops)"))
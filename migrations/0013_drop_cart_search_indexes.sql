@@ -0,0 +1,8 @@
+-- /carts/search/ reads order_search now (0012), so the sort indexes 0008 put on
+-- cart_items and carts only slow down adding items and creating carts.
+-- cart_items_cart_id_id_idx stays: checkout reads a cart's lines with it.
+
+DROP INDEX IF EXISTS cart_items_created_at_id_idx;
+DROP INDEX IF EXISTS cart_items_item_sku_id_idx;
+DROP INDEX IF EXISTS cart_items_line_total_id_idx;
+DROP INDEX IF EXISTS carts_name_id_idx;
@@ -0,0 +1,21 @@
+-- Stock held for carts, and potion_balance.reserved, the total held per potion
+-- (see src/reservations.py).
+
+CREATE TABLE IF NOT EXISTS stock_holds (
+    run_id integer NOT NULL DEFAULT current_run_id(),
+    cart_id integer NOT NULL,
+    potion_id integer NOT NULL,
+    quantity bigint NOT NULL,
+    expires_at timestamp with time zone NOT NULL,
+    PRIMARY KEY (run_id, cart_id, potion_id)
+);
+
+CREATE INDEX IF NOT EXISTS stock_holds_expires_at_idx ON stock_holds (expires_at);
+
+ALTER TABLE potion_balance ADD COLUMN IF NOT EXISTS reserved bigint NOT NULL DEFAULT 0;
+
+UPDATE potion_balance pb
+SET reserved = COALESCE((
+    SELECT SUM(h.quantity) FROM stock_holds h
+    WHERE h.run_id = current_run_id() AND h.potion_id = pb.potion_id
+), 0);
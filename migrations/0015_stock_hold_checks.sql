@@ -0,0 +1,15 @@
+-- Holds and reserved totals can't go negative. Before 0015 a negative cart
+-- quantity made a negative hold, which freed stock other carts were holding,
+-- and reserved was clamped at zero instead of failing, so drop those holds
+-- and recount reserved from the rest first.
+
+DELETE FROM stock_holds WHERE quantity < 0;
+
+UPDATE potion_balance pb
+SET reserved = COALESCE((
+    SELECT SUM(h.quantity) FROM stock_holds h
+    WHERE h.run_id = current_run_id() AND h.potion_id = pb.potion_id
+), 0);
+
+ALTER TABLE stock_holds ADD CONSTRAINT stock_holds_quantity_check CHECK (quantity >= 0);
+ALTER TABLE potion_balance ADD CONSTRAINT potion_balance_reserved_check CHECK (reserved >= 0);
@@ -0,0 +1,125 @@
+import sqlalchemy
+
+# Rollups behind the /analytics endpoints, kept up to date by the same
+# statements that write the ledgers (ledger.record_gold and the checkout in
+# carts.sell_cart), so reading them never touches cart_items or the ledgers:
+#
+#   potion_sales_rollup  potions sold and gold taken, per run, potion, game day and hour
+#   daily_gold_rollup    net gold change per run, real day and game day
+#
+# Both used to be sketched as views over the full ledgers (potions_sales_summary
+# and daily_gold). Like those views, daily gold only counts ledger rows that
+# have a game day, and a "real day" starts at 18:00 UTC.
+
+WEEKDAYS = ['Hearthday', 'Crownday', 'Blesseday', 'Soulday', 'Edgeday', 'Bloomday', 'Arcanaday']
+
+# Sales recorded before the first tick have no game time; they are filed under these
+NO_DAY = ''
+NO_HOUR = -1
+
+
+def rebuild_rollups(connection):
+    """ Recomputes the current run's rollups from its ledgers. Only needed for repairs (src.ledger rebuild). """
+    connection.execute(sqlalchemy.text(
+        "LOCK TABLE gold_ledger, potion_ledger IN SHARE MODE"))
+
+    connection.execute(sqlalchemy.text(
+        "DELETE FROM potion_sales_rollup WHERE run_id = current_run_id()"))
+    connection.execute(sqlalchemy.text(f"""
+        INSERT INTO potion_sales_rollup (potion_id, day, hour, quantity, gold)
+        SELECT potion_id, COALESCE(day, '{NO_DAY}'), COALESCE(hour, {NO_HOUR}), -SUM(quantity), SUM(cost)
+        FROM potion_ledger
+        WHERE run_id = current_run_id() AND function = 'sale'
+        GROUP BY 1, 2, 3
+    """))
+
+    connection.execute(sqlalchemy.text(
+        "DELETE FROM daily_gold_rollup WHERE run_id = current_run_id()"))
+    connection.execute(sqlalchemy.text("""
+        INSERT INTO daily_gold_rollup (real_day, day, gold)
+        SELECT CAST(created_at - interval '18 hours' AS date), day, SUM(net_change)
+        FROM gold_ledger
+        WHERE run_id = current_run_id() AND day IS NOT NULL
+        GROUP BY 1, 2
+    """))
+
+
+# SQL that adds the sold potions in a `sold` CTE (potion_id, quantity,
+# total_cost) to potion_sales_rollup, for use inside the checkout statement
+RECORD_SALES_SQL = f"""
+    INSERT INTO potion_sales_rollup (potion_id, day, hour, quantity, gold)
+    SELECT sold.potion_id, COALESCE(CAST(:day AS text), '{NO_DAY}'), COALESCE(CAST(:hour AS integer), {NO_HOUR}),
+           sold.quantity, sold.total_cost
+    FROM sold
+    ON CONFLICT (run_id, potion_id, day, hour) DO UPDATE SET
+        quantity = potion_sales_rollup.quantity + EXCLUDED.quantity,
+        gold = potion_sales_rollup.gold + EXCLUDED.gold
+"""
+
+# Same for the gold those potions brought in
+RECORD_SALES_GOLD_SQL = """
+    INSERT INTO daily_gold_rollup (real_day, day, gold)
+    SELECT CAST(now() - interval '18 hours' AS date), CAST(:day AS text), SUM(sold.total_cost)
+    FROM sold
+    WHERE CAST(:day AS text) IS NOT NULL
+    HAVING COUNT(*) > 0
+    ON CONFLICT (run_id, real_day, day) DO UPDATE SET gold = daily_gold_rollup.gold + EXCLUDED.gold
+"""
+
+
+def daily_gold_changes(rows):
+    """ gold_ledger rows -> (game days, net changes) for the daily_gold_rollup upsert in ledger.record_gold. """
+    changes = {}
+    for row in rows:
+        if row.get('day') is not None:
+            changes[row['day']] = changes.get(row['day'], 0) + row['net_change']
+    return list(changes), list(changes.values())
+
+
+def sales_by_weekday(connection, run_id=None):
+    """ Potions sold per potion and game weekday in a run (the current one by default). """
+    rows = connection.execute(sqlalchemy.text("""
+        SELECT r.potion_id, pi.sku, r.day, SUM(r.quantity) AS quantity, SUM(r.gold) AS gold
+        FROM potion_sales_rollup r
+        JOIN potion_inventory pi ON pi.id = r.potion_id
+        WHERE r.run_id = COALESCE(CAST(:run_id AS integer), current_run_id())
+        GROUP BY r.potion_id, pi.sku, r.day
+        ORDER BY r.potion_id
+    """), {"run_id": run_id}).fetchall()
+
+    summary = {}
+    for row in rows:
+        entry = summary.setdefault(row.potion_id, {
+            "potion_id": row.potion_id,
+            "sku": row.sku,
+            **{day: 0 for day in WEEKDAYS},
+            "total_quantity": 0,
+            "total_gold": 0,
+        })
+        if row.day in WEEKDAYS:
+            entry[row.day] += row.quantity
+        entry["total_quantity"] += row.quantity
+        entry["total_gold"] += row.gold
+    return list(summary.values())
+
+
+def sales_by_hour(connection, day, run_id=None):
+    """ Potions sold per potion and hour on one game weekday of a run. """
+    return [row._asdict() for row in connection.execute(sqlalchemy.text("""
+        SELECT r.potion_id, pi.sku, r.hour, r.quantity, r.gold
+        FROM potion_sales_rollup r
+        JOIN potion_inventory pi ON pi.id = r.potion_id
+        WHERE r.run_id = COALESCE(CAST(:run_id AS integer), current_run_id()) AND r.day = :day
+        ORDER BY r.hour, r.potion_id
+    """), {"run_id": run_id, "day": day})]
+
+
+def daily_gold(connection, run_id=None):
+    """ Net gold change per real day and game day in a run, oldest first. """
+    return [row._asdict() for row in connection.execute(sqlalchemy.text("""
+        SELECT real_day, day, gold
+        FROM daily_gold_rollup
+        WHERE run_id = COALESCE(CAST(:run_id AS integer), current_run_id())
+        ORDER BY real_day, day
+    """), {"run_id": run_id})]
+
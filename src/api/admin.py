@@ -1,8 +1,14 @@
 from fastapi import APIRouter, Depends, Request
 from pydantic import BaseModel
 from src.api import auth
-import sqlalchemy
+import logging
 from src import database as db
+from src.api import catalog
+from src import game_clock
+from src import ledger
+from src import potions
+from src import reservations
+from src import runs
 
 router = APIRouter(
     prefix="/admin",
@@ -10,43 +16,70 @@ router = APIRouter(
     dependencies=[Depends(auth.get_api_key)],
 )
 
+logger = logging.getLogger(__name__)
+
 @router.post("/reset")
-def reset():
+async def reset():
     """
     Reset the game state. Gold goes to 100, all potions are removed from
     inventory, and all barrels are removed from inventory. Carts are all reset.
     """
-    with db.engine.begin() as connection:
-        # reset/clear potion_inventory, carts, cart_items
-        # set carts / cart items to nonactive for this run, but still save results
-        connection.execute(sqlalchemy.text("DELETE FROM carts;"))
-        connection.execute(sqlalchemy.text("DELETE FROM cart_items;"))
-        connection.execute(sqlalchemy.text("DELETE FROM gold_ledger;"))
-        connection.execute(sqlalchemy.text("DELETE FROM ml_ledger;"))
-        connection.execute(sqlalchemy.text("DELETE FROM potion_ledger;"))
-        connection.execute(sqlalchemy.text("DELETE FROM time_table;"))
-        connection.execute(sqlalchemy.text("DELETE FROM capacity_ledger;"))
-
-        # Reset the ID sequences for all tables with auto-incremented IDs
-        connection.execute(sqlalchemy.text("ALTER SEQUENCE carts_id_seq RESTART WITH 1;"))
-        connection.execute(sqlalchemy.text("ALTER SEQUENCE cart_items_id_seq RESTART WITH 1;"))
-        connection.execute(sqlalchemy.text("ALTER SEQUENCE gold_ledger_id_seq RESTART WITH 1;"))
-        connection.execute(sqlalchemy.text("ALTER SEQUENCE ml_ledger_id_seq RESTART WITH 1;"))
-        connection.execute(sqlalchemy.text("ALTER SEQUENCE potion_ledger_id_seq RESTART WITH 1;"))
-        connection.execute(sqlalchemy.text("ALTER SEQUENCE time_table_id_seq RESTART WITH 1;"))
-
-
-
-        # Reinitialize the gold to 100
-        connection.execute(sqlalchemy.text("""
-            INSERT INTO gold_ledger (net_change, function, transaction)
-            VALUES (100, 'reset', 'Initial gold set to 100 upon reset');
-            """))
-        
-        connection.execute(sqlalchemy.text("INSERT INTO capacity_ledger (ml_capacity, potion_capacity) VALUES (10000, 50)"))
-
-
-    print("Game state has been reset. All ledgers cleared and gold set to 100.")
+    run_id = await db.run_in_transaction(reset_ledgers)
+
+    game_clock.invalidate()
+    catalog.invalidate()
+
+    logger.info("Game state has been reset. Started run %s with gold set to 100.", run_id)
 
     return "OK"
 
+
+def reset_ledgers(connection):
+    # Start a new run instead of deleting the old one: carts, cart_items, the
+    # ledgers and time_table are partitioned by run, so the new run starts out
+    # empty and the old runs stay around for analysis (see src/runs.py)
+    run_id = runs.start_run(connection)
+
+    # The running balances mirror the ledgers, so they start over too, and with them the holds on stock
+    ledger.clear_balances(connection)
+    reservations.clear(connection)
+
+    # Reinitialize the gold to 100
+    ledger.record_gold(connection, [{
+        'net_change': 100,
+        'function': 'reset',
+        'transaction': 'Initial gold set to 100 upon reset'
+    }])
+
+    ledger.record_capacity(connection, 10000, 50)
+
+    return run_id
+
+
+@router.get("/reconcile")
+async def reconcile():
+    """
+    Checks that every running balance (gold, capacity, ml per color and
+    quantity per potion) still equals the sum of its ledger.
+    """
+    mismatches = await db.run_in_transaction(ledger.reconcile)
+
+    return {
+        "ok": not mismatches,
+        "mismatches": [
+            {"account": account, "ledger_total": ledger_total, "balance": balance}
+            for account, ledger_total, balance in mismatches
+        ]
+    }
+
+
+@router.post("/potions/refresh")
+async def refresh_potions():
+    """
+    Reloads the in-memory potion registry from potion_inventory. Call after
+    changing recipes, names or prices if the change listener isn't running.
+    """
+    loaded = await db.run_in_transaction(potions.refresh)
+    catalog.invalidate()
+
+    return {"potions": len(loaded)}
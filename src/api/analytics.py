@@ -0,0 +1,29 @@
+from typing import Optional
+from fastapi import APIRouter, Depends
+from src.api import auth
+from src import analytics
+from src import database as db
+
+
+router = APIRouter(
+    prefix="/analytics",
+    tags=["analytics"],
+    dependencies=[Depends(auth.get_api_key)],
+)
+
+@router.get("/sales")
+async def get_sales(day: Optional[str] = None, run_id: Optional[int] = None):
+    """
+    Potions sold per potion, pivoted by game weekday, in a run (the current
+    one by default). With a day, the sales on that weekday per hour instead.
+    Read from the sales rollup, so the cost doesn't depend on how many
+    orders there have been.
+    """
+    if day is not None:
+        return await db.run_in_transaction(analytics.sales_by_hour, day, run_id)
+    return await db.run_in_transaction(analytics.sales_by_weekday, run_id)
+
+@router.get("/daily_gold")
+async def get_daily_gold(run_id: Optional[int] = None):
+    """ Net gold change per real day and game day in a run (the current one by default). """
+    return await db.run_in_transaction(analytics.daily_gold, run_id)
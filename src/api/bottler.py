@@ -2,9 +2,18 @@ from fastapi import APIRouter, Depends
 from enum import Enum
 from pydantic import BaseModel
 from src.api import auth
-import sqlalchemy
 from src import database as db
-import json
+from src.api import catalog
+from src import forecast
+from src import game_clock
+from src import idempotency
+from src import ledger
+from src import bottling
+from src import potions
+from src import shop_state
+import logging
+import math
+import asyncio
 
 router = APIRouter(
     prefix="/bottler",
@@ -12,332 +21,258 @@ router = APIRouter(
     dependencies=[Depends(auth.get_api_key)],
 )
 
+logger = logging.getLogger(__name__)
+
 class PotionInventory(BaseModel):
     potion_type: list[int]
     quantity: int
 
 @router.post("/deliver/{order_id}")
-def post_deliver_bottles(potions_delivered: list[PotionInventory], order_id: int):
-    print(f"potions delivered: {potions_delivered} order_id: {order_id}")
+async def post_deliver_bottles(potions_delivered: list[PotionInventory], order_id: int):
+    logger.debug("potions delivered: %s order_id: %s", potions_delivered, order_id)
 
-    ml_changes = {'red': 0, 'green': 0, 'blue': 0, 'dark': 0}
-
-    with db.engine.begin() as connection:
-        for potion in potions_delivered:
-            potion_type_info = connection.execute(sqlalchemy.text("""
-                SELECT id, sku, price FROM potion_inventory
-                WHERE red_ml = :red AND green_ml = :green AND blue_ml = :blue AND dark_ml = :dark LIMIT 1;
-                """), {
-                'red': potion.potion_type[0],
-                'green': potion.potion_type[1],
-                'blue': potion.potion_type[2],
-                'dark': potion.potion_type[3]
-            }).mappings().first()
-
-            if potion_type_info:
-                potion_id = potion_type_info['id']
-                sku = potion_type_info['sku']
-                price_per_unit = potion_type_info['price']
-
-                current_time = connection.execute(sqlalchemy.text("""
-                            SELECT day, hour FROM time_table ORDER BY created_at DESC LIMIT 1;
-                        """)).first()  # Use first() to fetch the first result directly
-
-                if current_time:  # Check if a result was returned
-                    # Record transaction in potion_ledger
-                    connection.execute(sqlalchemy.text("""
-                        INSERT INTO potion_ledger (potion_id, quantity, transaction, cost, function, day, hour)
-                        VALUES (:potion_id, :quantity, 'delivery', :cost, :function, :day, :hour);
-                        """), {
-                        'potion_id': potion_id,
-                        'quantity': potion.quantity,
-                        'cost': price_per_unit,
-                        'transaction': json.dumps({'order_id': order_id, 'ml_per_type': potion.potion_type}),
-                        'function': "post_deliver_bottles",
-                        'day': current_time.day,
-                        'hour': current_time.hour
-                    })
-                else:
-                    connection.execute(sqlalchemy.text("""
-                        INSERT INTO potion_ledger (potion_id, quantity, transaction, cost, function)
-                        VALUES (:potion_id, :quantity, 'delivery', :cost, :function);
-                        """), {
-                        'potion_id': potion_id,
-                        'quantity': potion.quantity,
-                        'cost': price_per_unit,
-                        'transaction': json.dumps({'order_id': order_id, 'ml_per_type': potion.potion_type}),
-                        'function': "post_deliver_bottles"
-                    })
-
-                # Aggregate ml changes for each color
-                ml_changes['red'] -= potion.potion_type[0] * potion.quantity
-                ml_changes['green'] -= potion.potion_type[1] * potion.quantity
-                ml_changes['blue'] -= potion.potion_type[2] * potion.quantity
-                ml_changes['dark'] -= potion.potion_type[3] * potion.quantity
-            else:
-                print(f"Error: Potion with components {potion.potion_type} not found in inventory.")
-
-        # Record aggregated volume changes in ml_ledger for each potion type
-        for color, change in ml_changes.items():
-            if change < 0:
-                current_time = connection.execute(sqlalchemy.text("""
-                            SELECT day, hour FROM time_table ORDER BY created_at DESC LIMIT 1;
-                        """)).first()  # Use first() to fetch the first result directly
-
-                if current_time:  # Check if a result was returned
-                    connection.execute(sqlalchemy.text("""
-                        INSERT INTO ml_ledger (barrel_type, net_change, transaction, function, day, hour)
-                        VALUES (:barrel_type, :net_change, 'delivery', :function, :day, :hour);
-                        """), {
-                        'barrel_type': color,
-                        'net_change': change,
-                        'transaction': json.dumps({'order_id': order_id}),
-                        'function': "post_deliver_bottles",
-                        'day': current_time.day,
-                        'hour': current_time.hour
-                    })   
-                else:  
-                    connection.execute(sqlalchemy.text("""
-                        INSERT INTO ml_ledger (barrel_type, net_change, transaction, function)
-                        VALUES (:barrel_type, :net_change, 'delivery', :function);
-                        """), {
-                        'barrel_type': color,
-                        'net_change': change,
-                        'transaction': json.dumps({'order_id': order_id}),
-                        'function': "post_deliver_bottles"
-                    })    
-    return "OK"
+    await db.run_in_transaction(idempotency.run_once, "bottler/deliver", order_id,
+                                record_bottle_delivery, potions_delivered)
 
+    catalog.invalidate()
 
+    return "OK"
 
+def record_bottle_delivery(connection, potions_delivered):
+    ml_changes = {'red': 0, 'green': 0, 'blue': 0, 'dark': 0}
 
-@router.post("/plan")
-def get_bottle_plan():
-    """
-    Dynamically computes the plan to bottle potions from barrels based on the transaction records in ml_ledger and potion_ledger.
-    """
-    with db.engine.begin() as connection:
+    current_time = game_clock.now(connection)
 
-        print_time = connection.execute(sqlalchemy.text("""
-                SELECT CONCAT(day, ' ', hour) FROM time_table ORDER BY created_at DESC LIMIT 1;
-            """)).first()  # Use first() to fetch the first result directly
-        
-        print(f"******************************\n******************************\n******************************\nThe Day and Time is: {print_time}")
+    potion_rows = []
+    for potion in potions_delivered:
+        potion_type_info = potions.by_recipe(connection, potion.potion_type)
 
-        # Calculate total number of potions already bottled
-        total_existing_potions = connection.execute(sqlalchemy.text(
-            "SELECT COALESCE(SUM(quantity), 0) AS total_potions FROM potion_ledger;"
-        )).scalar()
+        if potion_type_info:
+            # Record transaction in potion_ledger
+            potion_rows.append({
+                'potion_id': potion_type_info.id,
+                'quantity': potion.quantity,
+                'function': "post_deliver_bottles",
+                'transaction': 'delivery',
+                'cost': potion_type_info.price,
+                'day': current_time.day if current_time else None,
+                'hour': current_time.hour if current_time else None
+            })
 
-        potion_capacity = connection.execute(sqlalchemy.text(
-            "SELECT SUM(potion_capacity) FROM capacity_ledger"
-        )).scalar()
+            # Aggregate ml changes for each color
+            ml_changes['red'] -= potion.potion_type[0] * potion.quantity
+            ml_changes['green'] -= potion.potion_type[1] * potion.quantity
+            ml_changes['blue'] -= potion.potion_type[2] * potion.quantity
+            ml_changes['dark'] -= potion.potion_type[3] * potion.quantity
+        else:
+            logger.error("Potion with components %s not found in inventory", potion.potion_type)
 
-        print(f"Potion Capacity: {potion_capacity}")
+    ledger.record_potions(connection, potion_rows)
 
-        # Determine the maximum number of potions that can be added
-        max_potions_to_bottle = max(0, potion_capacity - total_existing_potions)
+    # Record aggregated volume changes in ml_ledger for each potion type
+    ledger.record_ml(connection, [{
+        'net_change': change,
+        'barrel_type': color,
+        'function': "post_deliver_bottles",
+        'transaction': 'delivery',
+        'day': current_time.day if current_time else None,
+        'hour': current_time.hour if current_time else None
+    } for color, change in ml_changes.items() if change < 0])
 
-        # Retrieve all records from ml_ledger
-        ml_ledger_entries = connection.execute(sqlalchemy.text(
-            "SELECT barrel_type, net_change FROM ml_ledger;"
-        )).mappings().all()
 
-        # Initialize ml counts for each color
-        ml_totals = {'red': 0, 'green': 0, 'blue': 0, 'dark': 0}
-        for entry in ml_ledger_entries:
-            color = entry['barrel_type']
-            if color in ml_totals:
-                ml_totals[color] += entry['net_change']
 
-        print(f"Current ml levels: {ml_totals}")
 
-        # print(f"{ml_totals}\n\n")
+@router.post("/plan")
+async def get_bottle_plan():
+    """
+    Dynamically computes the plan to bottle potions from barrels based on the running ml and potion balances.
+    """
+    return await db.run_in_transaction(compute_bottle_plan)
 
-        # Fetch potion inventory without relying on quantity column
-        potion_inventory = connection.execute(
-            sqlalchemy.text("SELECT id, sku, name, price, red_ml, green_ml, blue_ml, dark_ml FROM potion_inventory ORDER BY id;")
-        ).mappings().all()
+def compute_bottle_plan(connection):
 
-        # Calculate available quantities from potion_ledger
-        potion_quantities = {recipe['id']: 0 for recipe in potion_inventory}  # Initialize quantities to 0
-        potion_ledger_entries = connection.execute(sqlalchemy.text(
-            "SELECT potion_id, SUM(quantity) AS total_quantity FROM potion_ledger GROUP BY potion_id;"
-        )).mappings().all()
+    print_time = game_clock.now(connection)
+    
+    logger.debug("The Day and Time is: %s", print_time)
 
-        # print(f"Potion Ledger Entries: {potion_ledger_entries}\n\n")
+    # Read current stock and capacity from the shop state
+    state = shop_state.get(connection)
+    potion_capacity = state.potion_capacity
+    ml_totals = state.ml_counts()
+    potion_quantities = state.potion_quantities()
 
-        for entry in potion_ledger_entries:
-            potion_quantities[entry['potion_id']] = entry['total_quantity']
+    # Calculate total number of potions already bottled
+    total_existing_potions = sum(potion_quantities.values())
 
-        merged_potion_inventory = [{
-            **potion,
-            'quantity': potion_quantities.get(potion['id'], 0)
-        } for potion in potion_inventory]
+    logger.debug("Potion Capacity: %s", potion_capacity)
 
-        # Sort potion inventory by quantity
-        sorted_potion_inventory = sorted(merged_potion_inventory, key=lambda x: x['quantity'])
+    # Determine the maximum number of potions that can be added
+    max_potions_to_bottle = max(0, potion_capacity - total_existing_potions)
 
-        # print(f"sorted potion inventory: {sorted_potion_inventory}")
+    logger.debug("Current ml levels: %s", ml_totals)
 
-        # Calculate how many potions can be made from the current ml totals
-        bottle_plan = make_potions(ml_totals['red'], ml_totals['green'], ml_totals['blue'], ml_totals['dark'], sorted_potion_inventory, potion_quantities,max_potions_to_bottle, potion_capacity)
+    # print(f"{ml_totals}\n\n")
 
-    return bottle_plan
+    # Recipes come from the potion registry, quantities from the running balances
+    merged_potion_inventory = [{
+        **potion._asdict(),
+        'quantity': potion_quantities.get(potion.id, 0)
+    } for potion in potions.all_potions(connection)]
 
-def make_potions(red_ml, green_ml, blue_ml, dark_ml, potion_inventory, potion_quantities,max_potions, capacity):
+    # Sort potion inventory by quantity
+    sorted_potion_inventory = sorted(merged_potion_inventory, key=lambda x: x['quantity'])
 
-    with db.engine.begin() as connection:
+    # print(f"sorted potion inventory: {sorted_potion_inventory}")
 
-        current_time = connection.execute(sqlalchemy.text("""
-                            SELECT day, hour FROM time_table ORDER BY created_at DESC LIMIT 1;
-                        """)).first()  # Use first() to fetch the first result directly
+    # Expected sales over the next game day, once the forecast has seen enough ticks
+    expected_demand = (forecast.upcoming_demand(connection, print_time.day, print_time.hour)
+                       if print_time else None)
 
-        print(f"The max number of potions I can make is: {max_potions}\n")
-        for recipe in potion_inventory:
-            current_quantity = potion_quantities.get(recipe['id'], 0)  # Default to 0 if no entry exists
-            print(f"id: {recipe['id']} sku: {recipe['sku']} name: {recipe['name']} r: {recipe['red_ml']} g: {recipe['green_ml']} b: {recipe['blue_ml']} d: {recipe['dark_ml']} quantity: {current_quantity} price: {recipe['price']}")
+    # Calculate how many potions can be made from the current ml totals
+    bottle_plan = make_potions(ml_totals['red'], ml_totals['green'], ml_totals['blue'], ml_totals['dark'], sorted_potion_inventory, potion_quantities,max_potions_to_bottle, potion_capacity, print_time, expected_demand)
 
-        bottle_plan = []
-        total_potions = 0  # Track the total number of potions created
-
-        num_recipes = len(potion_inventory)
+    return bottle_plan
 
+def make_potions(red_ml, green_ml, blue_ml, dark_ml, potion_inventory, potion_quantities,max_potions, capacity, current_time, expected_demand=None):
 
+    logger.debug("The max number of potions I can make is: %s", max_potions)
+    if logger.isEnabledFor(logging.DEBUG):
         for recipe in potion_inventory:
-            # print(f"recipe: {recipe}")
-
-
-            # if recipe['green_ml'] == 100:
-            #     quantity = max_potions // 2
-            #     total_potions += quantity
-            #     bottle_plan.append({
-            #         "potion_type": [recipe['red_ml'], recipe['green_ml'], recipe['blue_ml'], recipe['dark_ml']],
-            #         "quantity": quantity
-            #     })
-            # elif recipe['red_ml'] == 100:
-            #     quantity = (max_potions // 8) * 3
-            #     total_potions += quantity
-            #     bottle_plan.append({
-            #         "potion_type": [recipe['red_ml'], recipe['green_ml'], recipe['blue_ml'], recipe['dark_ml']],
-            #         "quantity": quantity
-            #     })
-            # elif recipe['dark_ml'] == 100:
-            #     quantity = (max_potions // 8)
-            #     total_potions += quantity
-            #     bottle_plan.append({
-            #         "potion_type": [recipe['red_ml'], recipe['green_ml'], recipe['blue_ml'], recipe['dark_ml']],
-            #         "quantity": quantity
-            #     })
-            # else:
-            #     continue
-
-            max_to_make = 0
-
-            # I DONT WANT ANY MORE ORANGE
-            if recipe['red_ml'] == 75:
-                continue
-            else:
-                max_to_make = (capacity // 20)
-            
-            # If it's day-time, don't try to make any dark potions. Start making them right before night starts, and until it ends.
-            # if current_time.hour >= 6 and current_time.hour <= 16 and recipe['dark_ml'] == 100:
-            #     continue
-
-            if (current_time.day == "Edgeday" and current_time.hour < 18) or (current_time.day == "Soulday" and current_time.hour >= 18): 
-                if recipe['red_ml'] == 100:
-                    print("It's Edgeday! Don't make any RED POTIONS TODAY!!!")
-                    continue
-                elif recipe['dark_ml'] == 100:
-                    print("It's Edgeday! Don't make any BLACK POTIONS TODAY!!!")
-                    continue
-                elif recipe['red_ml'] == 50 and recipe['green_ml'] == 50:
-                    print("It's Edgeday! Don't make any YELLOW POTIONS TODAY!!!")
-                    continue
-
-            if (current_time.day == "Bloomday" and current_time.hour < 18) or (current_time.day == "Edgeday" and current_time.hour >= 18):
-                if recipe['green_ml'] == 100:
-                    print("It's Bloomday! Don't make any GREEN POTIONS TODAY!!!")
-                    continue
-
-            if (current_time.day == "Arcanaday" and current_time.hour < 18) or (current_time.day == "Bloomday" and current_time.hour >= 18):
-                if recipe['blue_ml'] == 100:
-                    print("It's Arcanaday! Don't make any BLUE POTIONS TODAY!!!")
+            current_quantity = potion_quantities.get(recipe['id'], 0)  # Default to 0 if no entry exists
+            logger.debug("id: %s sku: %s name: %s r: %s g: %s b: %s d: %s quantity: %s price: %s",
+                         recipe['id'], recipe['sku'], recipe['name'], recipe['red_ml'], recipe['green_ml'],
+                         recipe['blue_ml'], recipe['dark_ml'], current_quantity, recipe['price'])
+
+    bottle_plan = []
+    total_potions = 0  # Track the total number of potions created
+
+    # Recipes allowed right now, and the most we'd bottle of each
+    candidates = []
+    caps = []
+
+
+    for recipe in potion_inventory:
+        # print(f"recipe: {recipe}")
+
+
+        # if recipe['green_ml'] == 100:
+        #     quantity = max_potions // 2
+        #     total_potions += quantity
+        #     bottle_plan.append({
+        #         "potion_type": [recipe['red_ml'], recipe['green_ml'], recipe['blue_ml'], recipe['dark_ml']],
+        #         "quantity": quantity
+        #     })
+        # elif recipe['red_ml'] == 100:
+        #     quantity = (max_potions // 8) * 3
+        #     total_potions += quantity
+        #     bottle_plan.append({
+        #         "potion_type": [recipe['red_ml'], recipe['green_ml'], recipe['blue_ml'], recipe['dark_ml']],
+        #         "quantity": quantity
+        #     })
+        # elif recipe['dark_ml'] == 100:
+        #     quantity = (max_potions // 8)
+        #     total_potions += quantity
+        #     bottle_plan.append({
+        #         "potion_type": [recipe['red_ml'], recipe['green_ml'], recipe['blue_ml'], recipe['dark_ml']],
+        #         "quantity": quantity
+        #     })
+        # else:
+        #     continue
+
+        max_to_make = 0
+
+        # I DONT WANT ANY MORE ORANGE
+        if recipe['red_ml'] == 75:
+            continue
+        else:
+            max_to_make = (capacity // 20)
+        
+        # If it's day-time, don't try to make any dark potions. Start making them right before night starts, and until it ends.
+        # if current_time.hour >= 6 and current_time.hour <= 16 and recipe['dark_ml'] == 100:
+        #     continue
+
+        current_quantity = potion_quantities.get(recipe['id'], 0)
+
+        # With a forecast, bottle up to what's expected to sell over the next day instead of
+        # following the day rules below. Potions it knows nothing about yet keep the default cap.
+        if expected_demand is not None:
+            if recipe['id'] in expected_demand:
+                max_to_make = max(0, math.ceil(expected_demand[recipe['id']]) - current_quantity)
+                if max_to_make == 0:
                     continue
+            elif current_quantity >= (capacity // 8):
+                continue
+            candidates.append(recipe)
+            caps.append(max_to_make)
+            continue
 
+        if (current_time.day == "Edgeday" and current_time.hour < 18) or (current_time.day == "Soulday" and current_time.hour >= 18): 
+            if recipe['red_ml'] == 100:
+                logger.debug("It's Edgeday! Don't make any RED POTIONS TODAY!!!")
+                continue
+            elif recipe['dark_ml'] == 100:
+                logger.debug("It's Edgeday! Don't make any BLACK POTIONS TODAY!!!")
+                continue
+            elif recipe['red_ml'] == 50 and recipe['green_ml'] == 50:
+                logger.debug("It's Edgeday! Don't make any YELLOW POTIONS TODAY!!!")
+                continue
 
-            # Don't make any potions other than dark for now
-            # if recipe['dark_ml'] != 100:
-            #     continue
-
-            current_quantity = potion_quantities.get(recipe['id'], 0)
-
-            print(f"The CURRENT QUANTITY of potion {recipe['id']} is: {current_quantity}")
+        if (current_time.day == "Bloomday" and current_time.hour < 18) or (current_time.day == "Edgeday" and current_time.hour >= 18):
+            if recipe['green_ml'] == 100:
+                logger.debug("It's Bloomday! Don't make any GREEN POTIONS TODAY!!!")
+                continue
 
-            if total_potions >= max_potions or current_quantity >= (capacity // 8):
-                continue  # Stop processing if max potion limit is reached
-            
-            quantity = 0
+        if (current_time.day == "Arcanaday" and current_time.hour < 18) or (current_time.day == "Bloomday" and current_time.hour >= 18):
+            if recipe['blue_ml'] == 100:
+                logger.debug("It's Arcanaday! Don't make any BLUE POTIONS TODAY!!!")
+                continue
 
-            # diff_filler = max(0, (capacity // num_recipes) - current_quantity)
 
-            # if diff_filler <= 0:
-            #     continue
-            # print(f"I need {diff_filler} potions to fill up the set amount that I want")
+        # Don't make any potions other than dark for now
+        # if recipe['dark_ml'] != 100:
+        #     continue
 
-            # Dark Bottler Plan
-            # while (dark_ml >= recipe['dark_ml'] and
-            #     current_quantity < 30):
-            #     current_quantity += 1
-            #     quantity += 1
-            #     total_potions += 1
-            #     dark_ml -= recipe['dark_ml']
+        logger.debug("The CURRENT QUANTITY of potion %s is: %s", recipe['id'], current_quantity)
 
-            # Default bottler plan  
-            # while (red_ml >= recipe['red_ml'] and green_ml >= recipe['green_ml'] and
-            #     blue_ml >= recipe['blue_ml'] and dark_ml >= recipe['dark_ml'] and
-            #     quantity < diff_filler and total_potions < max_potions and
-            #     current_quantity + quantity < (capacity / 5)):
+        if current_quantity >= (capacity // 8):
+            continue  # Already well stocked on this one
 
-            while (red_ml >= recipe['red_ml'] and green_ml >= recipe['green_ml'] and
-                blue_ml >= recipe['blue_ml'] and dark_ml >= recipe['dark_ml'] and
-                quantity < max_to_make and total_potions < max_potions):
+        candidates.append(recipe)
+        caps.append(max_to_make)
 
-                quantity += 1
-                total_potions += 1
-                red_ml -= recipe['red_ml']
-                green_ml -= recipe['green_ml']
-                blue_ml -= recipe['blue_ml']
-                dark_ml -= recipe['dark_ml']
+    # Choose all quantities at once instead of bottling one potion at a time:
+    # maximize the value bottled over the four ml pools and max_potions
+    quantities = bottling.plan_bottles(
+        [red_ml, green_ml, blue_ml, dark_ml],
+        [[recipe['red_ml'], recipe['green_ml'], recipe['blue_ml'], recipe['dark_ml']] for recipe in candidates],
+        caps,
+        [recipe['price'] for recipe in candidates],
+        max_potions)
 
+    for recipe, quantity in zip(candidates, quantities):
+        if quantity > 0:
+            total_potions += quantity
+            bottle_plan.append({
+                "potion_type": [recipe['red_ml'], recipe['green_ml'], recipe['blue_ml'], recipe['dark_ml']],
+                "quantity": quantity
+            })
 
+    logger.info("Bottle plan: %s potions of %s types", total_potions, len(bottle_plan))
+    logger.debug("Bottle Plan: %s", bottle_plan)
 
-            if quantity > 0:
+    if not bottle_plan:
+        if current_time:
+            hour = current_time.hour
+            if hour in {2, 6, 10, 14, 18, 22}:
                 bottle_plan.append({
-                    "potion_type": [recipe['red_ml'], recipe['green_ml'], recipe['blue_ml'], recipe['dark_ml']],
-                    "quantity": quantity
-                })
-
-
-        print(f"The total number of potions we bottled was {total_potions}")
-        print("Bottle Plan:", bottle_plan, "\n******************************\n******************************\n******************************\n\n")
-
-        if not bottle_plan:
-            current_time = connection.execute(sqlalchemy.text("""
-                SELECT hour FROM time_table ORDER BY created_at DESC LIMIT 1;
-                """)).first()  # Use first() to fetch the first result directly
-            if current_time:
-                hour = current_time[0]  # Extract the hour from the tuple
-                if hour in {2, 6, 10, 14, 18, 22}:
-                    bottle_plan.append({
-                                        "potion_type": [0, 100, 0, 0],
-                                        "quantity": 20
-                                    })
-                    print("It's a Barrel Order Tick! Trying to predict making some green potions...")                
-            else:
-                print("No time data was retrieved.")
-    
+                                    "potion_type": [0, 100, 0, 0],
+                                    "quantity": 20
+                                })
+                logger.info("It's a Barrel Order Tick! Trying to predict making some green potions...")
+        else:
+            logger.warning("No time data was retrieved.")
+
     return bottle_plan
 
 if __name__ == "__main__":
-    print(get_bottle_plan())
\ No newline at end of file
+    print(asyncio.run(get_bottle_plan()))
\ No newline at end of file
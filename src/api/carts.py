@@ -1,12 +1,21 @@
-from fastapi import APIRouter, Depends, Request
-from pydantic import BaseModel
+from fastapi import APIRouter, Depends, HTTPException, status
+from pydantic import BaseModel, conint
 from src.api import auth
 from enum import Enum
+from datetime import datetime
+from typing import NamedTuple
+import base64
+import json
+import logging
 import sqlalchemy
+from src import analytics
 from src import database as db
-import json
-from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String
-from sqlalchemy.ext.declarative import declarative_base
+from src.api import catalog
+from src import game_clock
+from src import order_search
+from src import potions
+from src import reservations
+from src import shop_state
 
 router = APIRouter(
     prefix="/carts",
@@ -14,6 +23,8 @@ router = APIRouter(
     dependencies=[Depends(auth.get_api_key)],
 )
 
+logger = logging.getLogger(__name__)
+
 class search_sort_options(str, Enum):
     customer_name = "customer_name"
     item_sku = "item_sku"
@@ -24,8 +35,10 @@ class search_sort_order(str, Enum):
     asc = "asc"
     desc = "desc"   
 
+SEARCH_PAGE_SIZE = 5
+
 @router.get("/search/", tags=["search"])
-def search_orders(
+async def search_orders(
     customer_name: str = "",
     potion_sku: str = "",
     search_page: str = "",
@@ -56,259 +69,351 @@ def search_orders(
     Your results must be paginated, the max results you can return at any
     time is 5 total line items.
     """
-    
-
-
-    with db.engine.begin() as connection:
-
-        # Decide sort column type
-        if sort_col == search_sort_options.timestamp:
-            sort_by = db.cart_items.c.created_at
-        elif sort_col == search_sort_options.customer_name:
-            sort_by = db.carts.c.name
-        elif sort_col == search_sort_options.item_sku:
-            sort_by = db.cart_items.c.item_sku
-        elif sort_col == search_sort_options.line_item_total:
-            sort_by = db.cart_items.c.quantity
-        else:
-            assert False
-
-        if sort_order == search_sort_order.desc:
-            order_by = sqlalchemy.desc(sort_by)
-        else:
-            order_by = sqlalchemy.asc(sort_by)
-
-        filter_conditions = []
-        if customer_name:
-            filter_conditions.append(db.carts.c.name.ilike(f"%{customer_name}%"))
-        if potion_sku:
-            filter_conditions.append(db.cart_items.c.item_sku.ilike(f"%{potion_sku}%"))
-
-        total_carts = connection.execute(sqlalchemy.text("SELECT COUNT(*) FROM cart_items")).scalar_one()
-
-        current_page = int(search_page) if search_page else 0
-
-        # Calculate the offset based on the current page
-        offset = current_page * 5
-
-        # Determine the tokens for previous and next pages
-        prev_token = str(current_page - 1) if current_page > 0 else ""
-        next_token = str(current_page + 1) if (current_page + 1) * 5 < total_carts else ""
-
-        stmt = (
-            sqlalchemy.select(
-                db.cart_items.c.cart_id,
-                db.cart_items.c.potion_id,
-                db.cart_items.c.quantity,
-                db.cart_items.c.item_sku,
-                db.cart_items.c.price,
-                (db.cart_items.c.quantity * db.potion_inventory.c.price).label("line_item_total"),
-                db.carts.c.id,
-                db.carts.c.name,
-                db.potion_inventory.c.name,
-                db.carts.c.created_at.label("timestamp"),
-                db.potion_inventory.c.sku,
-            )
-            .order_by(order_by)
-            .limit(5)
-            .offset(offset)
-            .select_from(
-                db.cart_items
-                .join(db.carts, db.cart_items.c.cart_id == db.carts.c.id)
-                .join(db.potion_inventory, db.cart_items.c.potion_id == db.potion_inventory.c.id)
-            )
+    sort_keys = search_sort_keys(sort_col)
+
+    # Walking "previous" means reading backwards from the cursor and flipping the rows afterwards
+    direction, cursor_values = decode_search_cursor(search_page, len(sort_keys))
+    backwards = direction == "prev"
+    ascending = (sort_order == search_sort_order.asc) != backwards
+
+    # One table, filled at checkout (src/order_search.py): no join, and the
+    # substring filters can use its trigram indexes
+    search = db.order_search
+    stmt = (
+        sqlalchemy.select(
+            search.c.line_item_id,
+            search.c.item_sku,
+            search.c.customer_name,
+            search.c.line_item_total,
+            search.c.created_at,
+            *[key.label(f"sort_key_{i}") for i, key in enumerate(sort_keys)],
         )
+        .where(search.c.run_id == sqlalchemy.func.current_run_id())
+        .order_by(*[key.asc() if ascending else key.desc() for key in sort_keys])
+        .limit(SEARCH_PAGE_SIZE + 1)
+    )
 
-        if customer_name != "":
+    if customer_name != "":
         # filter for similar names
-            stmt = stmt.where(db.carts.c.name.ilike(f"%{customer_name}%"))
-
-        if potion_sku != "":
-            # filter for sku
-            stmt = stmt.where(db.potion_inventory.c.sku.ilike(f"%{potion_sku}%"))
-
-
-        result = connection.execute(stmt)
+        stmt = stmt.where(search.c.customer_name.ilike(f"%{customer_name}%"))
+
+    if potion_sku != "":
+        # filter for sku
+        stmt = stmt.where(search.c.item_sku.ilike(f"%{potion_sku}%"))
+
+    if cursor_values is not None:
+        # Keyset condition: only rows strictly past the cursor in the direction we read
+        row_key = sqlalchemy.tuple_(*sort_keys)
+        cursor_key = sqlalchemy.tuple_(*[sqlalchemy.literal(value) for value in cursor_values])
+        stmt = stmt.where(row_key > cursor_key if ascending else row_key < cursor_key)
+
+    rows = await db.run_in_transaction(fetch_rows, stmt)
+
+    has_more = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    if backwards:
+        rows.reverse()
+
+    def key_of(row):
+        return [getattr(row, f"sort_key_{i}") for i in range(len(sort_keys))]
+
+    prev_token = ""
+    next_token = ""
+    if rows:
+        # There is a previous page if we read back and found more, or came forward from a cursor
+        if (backwards and has_more) or (not backwards and cursor_values is not None):
+            prev_token = encode_search_cursor("prev", key_of(rows[0]))
+        if (not backwards and has_more) or backwards:
+            next_token = encode_search_cursor("next", key_of(rows[-1]))
+
+    json_result = []
+    for row in rows:
+        json_result.append({
+            "line_item_id": row.line_item_id,
+            "item_sku": row.item_sku,
+            "customer_name": row.customer_name,
+            "line_item_total": row.line_item_total,
+            "timestamp": row.created_at.strftime("%Y-%m-%dT%H:%M:%SZ")  # ISO 8601
+        })
 
-        json_result = []
-        for row in result:
-            json_result.append({
-                "line_item_id": row.cart_id,
-                "item_sku": row.item_sku,
-                "customer_name": row.name,
-                "line_item_total": row.line_item_total,
-                "timestamp": row.timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")  # ISO 8601
-            })
-
-        print(json_result)
-
-    
     return {
         "previous": prev_token,
         "next": next_token,
         "results": json_result
     }
 
+def fetch_rows(connection, stmt):
+    return connection.execute(stmt).fetchall()
+
+def search_sort_keys(sort_col):
+    """
+    The columns a search is ordered by. Each ends with a unique id so the
+    order is total, which is what lets a (key..., id) cursor pick up exactly
+    where the previous page stopped.
+    """
+    search = db.order_search
+    if sort_col == search_sort_options.timestamp:
+        return [search.c.created_at, search.c.line_item_id]
+    elif sort_col == search_sort_options.customer_name:
+        return [search.c.customer_name, search.c.cart_id, search.c.line_item_id]
+    elif sort_col == search_sort_options.item_sku:
+        return [search.c.item_sku, search.c.line_item_id]
+    elif sort_col == search_sort_options.line_item_total:
+        return [search.c.line_item_total, search.c.line_item_id]
+    else:
+        assert False
+
+
+def encode_search_cursor(direction, values):
+    """ Packs a direction and the sort key of the boundary row into an opaque page token. """
+    payload = [direction] + [
+        {"ts": value.isoformat()} if isinstance(value, datetime) else value
+        for value in values
+    ]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+
+def decode_search_cursor(token, key_length):
+    """ Returns (direction, sort key values) for a page token, or ("next", None) for the first page. """
+    if not token:
+        return "next", None
+
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        direction, values = payload[0], payload[1:]
+        values = [
+            datetime.fromisoformat(value["ts"]) if isinstance(value, dict) else value
+            for value in values
+        ]
+    except (ValueError, TypeError, KeyError, IndexError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid search_page token")
+
+    if direction not in ("next", "prev") or len(values) != key_length:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid search_page token")
+
+    return direction, values
+
+
 class Customer(BaseModel):
     customer_name: str
     character_class: str
     level: int
 
 @router.post("/visits/{visit_id}")
-def post_visits(visit_id: int, customers: list[Customer]):
+async def post_visits(visit_id: int, customers: list[Customer]):
     """
     Which customers visited the shop today?
     """
-    print(customers)
+    logger.debug("Visit %s customers: %s", visit_id, customers)
 
     return "OK"
 
 
 @router.post("/")
-def create_cart(new_cart: Customer):
+async def create_cart(new_cart: Customer):
     """ """
 
-    with db.engine.begin() as connection:
-        
-        id = connection.execute(sqlalchemy.text("INSERT INTO carts (name, class, level) VALUES (:name, :class, :level) returning id;"),
-                                    {
-                                        'name': new_cart.customer_name,
-                                        'class': new_cart.character_class,
-                                        'level': new_cart.level
-                                    }).fetchone()[0]
+    id = await db.run_in_transaction(insert_cart, new_cart)
 
-        print("Cart: " + str(id) + " " + new_cart.customer_name + " " + new_cart.character_class + " " + str(new_cart.level))
+    logger.debug("Cart: %s %s %s %s", id, new_cart.customer_name, new_cart.character_class, new_cart.level)
 
     return {"cart_id": id} # trying to return cart_id as an int instead to hopefully resolve an error?
 
+def insert_cart(connection, new_cart):
+    return connection.execute(sqlalchemy.text("INSERT INTO carts (name, class, level) VALUES (:name, :class, :level) returning id;"),
+                                {
+                                    'name': new_cart.customer_name,
+                                    'class': new_cart.character_class,
+                                    'level': new_cart.level
+                                }).fetchone()[0]
+
 
 class CartItem(BaseModel):
-    quantity: int
+    quantity: conint(ge=0)
+
+
+class CartLine(BaseModel):
+    item_sku: str
+    quantity: conint(ge=0)
 
 
 @router.post("/{cart_id}/items/{item_sku}")
-def set_item_quantity(cart_id: int, item_sku: str, cart_item: CartItem):
+async def set_item_quantity(cart_id: int, item_sku: str, cart_item: CartItem):
     """ """
-    with db.engine.begin() as connection:
-        potion_info = connection.execute(sqlalchemy.text("SELECT id, price FROM potion_inventory WHERE sku = :sku"), {"sku": item_sku}).first()
-        potion_id = potion_info.id
-        item_price = potion_info.price        
+    await db.run_in_transaction(set_cart_items, cart_id, [(item_sku, cart_item.quantity)])
+    catalog.invalidate()
 
-        current_time = connection.execute(sqlalchemy.text("""
-                SELECT day, hour FROM time_table ORDER BY created_at DESC LIMIT 1;
-            """)).first()  # Use first() to fetch the first result directly
-
-        if current_time:  # Check if a result was returned
-            day = current_time.day  # Access columns directly via the result
-            hour = current_time.hour
-            connection.execute(sqlalchemy.text("INSERT INTO cart_items (item_sku, quantity, cart_id, potion_id, day, hour, price) VALUES (:sku , :quantity, :cart_id, :potion_id, :day, :hour, :price)"), {"sku": item_sku, "quantity": cart_item.quantity, "cart_id": cart_id, "potion_id": potion_id, "day": day, "hour": hour, "price": item_price})
-        else:
-            print("error retrieving the time...\n")
-            connection.execute(sqlalchemy.text("INSERT INTO cart_items (item_sku, quantity, cart_id, potion_id, price) VALUES (:sku , :quantity, :cart_id, :potion_id, :price)"), {"sku": item_sku, "quantity": cart_item.quantity, "cart_id": cart_id, "potion_id": potion_id, "price": item_price})
+    return "OK"
 
+@router.post("/{cart_id}/items")
+async def set_item_quantities(cart_id: int, cart_lines: list[CartLine]):
+    """
+    Sets the quantity of several skus in a cart at once. Like the single-item
+    endpoint, each sku's quantity replaces whatever the cart had for it.
+    """
+    await db.run_in_transaction(set_cart_items, cart_id, [(line.item_sku, line.quantity) for line in cart_lines])
+    catalog.invalidate()
 
     return "OK"
 
+def set_cart_items(connection, cart_id, items):
+    """
+    Upserts (sku, quantity) pairs into a cart in one statement: a cart has one
+    line per sku, so setting a sku again replaces its quantity (and price and
+    game time) instead of adding a second line. When a sku is listed twice,
+    the last quantity wins.
+
+    Each line's quantity is held for the cart (src/reservations.py) until it
+    checks out or the hold expires. If there isn't enough free stock for a
+    line, nothing is set and the response is a 409.
+    """
+    lines = {}
+    for item_sku, quantity in items:
+        potion_info = potions.by_sku(connection, item_sku)
+        if potion_info is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Unknown sku {item_sku}")
+        lines[item_sku] = (potion_info, quantity)
+
+    if not lines:
+        return
+
+    # Locking the cart serializes changes to its holds
+    if connection.execute(sqlalchemy.text(
+            "SELECT id FROM carts WHERE run_id = current_run_id() AND id = :cart_id FOR UPDATE"),
+            {"cart_id": cart_id}).first() is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Unknown cart {cart_id}")
+
+    short = reservations.hold(connection, cart_id,
+                              {potion_info.id: quantity for potion_info, quantity in lines.values()})
+    if short:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Not enough stock: " + ", ".join(
+            f"{potion_info.sku} has {short[potion_info.id]} available"
+            for potion_info, _ in lines.values() if potion_info.id in short))
+
+    current_time = game_clock.now(connection)
+    if current_time is None:
+        logger.warning("No time data was retrieved for cart %s", cart_id)
+
+    connection.execute(sqlalchemy.text("""
+        INSERT INTO cart_items (cart_id, item_sku, potion_id, quantity, price, day, hour)
+        SELECT :cart_id, line.item_sku, line.potion_id, line.quantity, line.price,
+               CAST(:day AS text), CAST(:hour AS integer)
+        FROM unnest(CAST(:skus AS text[]), CAST(:potion_ids AS integer[]),
+                    CAST(:quantities AS integer[]), CAST(:prices AS integer[]))
+             AS line(item_sku, potion_id, quantity, price)
+        ON CONFLICT (run_id, cart_id, item_sku) DO UPDATE SET
+            potion_id = EXCLUDED.potion_id,
+            quantity = EXCLUDED.quantity,
+            price = EXCLUDED.price,
+            day = EXCLUDED.day,
+            hour = EXCLUDED.hour
+    """), {
+        "cart_id": cart_id,
+        "skus": list(lines),
+        "potion_ids": [potion_info.id for potion_info, _ in lines.values()],
+        "quantities": [quantity for _, quantity in lines.values()],
+        "prices": [potion_info.price for potion_info, _ in lines.values()],
+        "day": current_time.day if current_time else None,
+        "hour": current_time.hour if current_time else None
+    })
+
 
 class CartCheckout(BaseModel):
     payment: str
 
 @router.post("/{cart_id}/checkout")
-def checkout(cart_id: int, cart_checkout: CartCheckout):
-    """ Process checkout, updating financial and inventory records using ledgers """
-    gold_spent = 0
-    potions_bought = 0
-    # print("Initating Checkout")
-    with db.engine.begin() as connection:
-        # Fetch all items in the cart
-        cart_contents = connection.execute(sqlalchemy.text(
-            "SELECT quantity, item_sku FROM cart_items WHERE cart_id = :cart_id"), 
-            {"cart_id": cart_id}).fetchall()
-
-        for item in cart_contents:
-            quantity, item_sku = item
-            # Retrieve price from the potion inventory
-            potion_data = connection.execute(sqlalchemy.text(
-                "SELECT id, price FROM potion_inventory WHERE sku = :item_sku"), 
-                {"item_sku": item_sku}).first()
-
-            # Calculate the current inventory of this potion from the ledger
-            current_quantity = connection.execute(sqlalchemy.text(
-                """
-                SELECT SUM(quantity) as total_quantity 
-                FROM potion_ledger 
-                WHERE potion_id = :potion_id
-                """), 
-                {"potion_id": potion_data.id}).scalar() or 0
-
-            if potion_data and quantity <= current_quantity:
-                potion_id, price = potion_data
-                total_cost = quantity * price
-                potions_bought += quantity
-                gold_spent += total_cost
-
-                current_time = connection.execute(sqlalchemy.text("""
-                SELECT day, hour FROM time_table ORDER BY created_at DESC LIMIT 1;
-                """)).first()  # Use first() to fetch the first result directly
-
-                # print(f"The current time is {current_time.day} {current_time.hour}")
-
-                if current_time:
-                    # Record potion transaction in potion_ledger
-                    connection.execute(sqlalchemy.text(
-                        """
-                        INSERT INTO potion_ledger (potion_id, quantity, function, transaction, cost, day, hour)
-                        VALUES (:potion_id, - :quantity, 'sale', :transaction, :cost, :day, :hour);
-                        """),
-                        {
-                            "potion_id": potion_id,
-                            "quantity": quantity,  # Negative because it's a sale
-                            "function": "checkout",
-                            "transaction": json.dumps({"cart_id": cart_id, "item_sku": item_sku}),
-                            "cost": total_cost, 
-                            "day": current_time.day,
-                            "hour": current_time.hour
-                        }
-                    )
-                else:
-                    # Record potion transaction in potion_ledger
-                    connection.execute(sqlalchemy.text(
-                        """
-                        INSERT INTO potion_ledger (potion_id, quantity, function, transaction, cost)
-                        VALUES (:potion_id, - :quantity, 'sale', :transaction, :cost);
-                        """),
-                        {
-                            "potion_id": potion_id,
-                            "quantity": quantity,  # Negative because it's a sale
-                            "function": "checkout",
-                            "transaction": json.dumps({"cart_id": cart_id, "item_sku": item_sku}),
-                            "cost": total_cost
-                        }
-                    )
-            
-                if current_time:
-                    connection.execute(sqlalchemy.text(
-                                            """
-                                            INSERT INTO gold_ledger (net_change, function, transaction, day, hour)
-                                            VALUES (:net_change, 'checkout', :transaction, :day, :hour);
-                                            """),   {'net_change': total_cost,  # Negative because it is an expenditure
-                                                    'transaction': json.dumps({"cart_id": cart_id, "item_sku": item_sku, "quantity": quantity}),
-                                                    'day': current_time.day,
-                                                    'hour': current_time.hour
-                                            })
-                else:
-                    # Update the gold ledger for tracking money spent
-                    connection.execute(sqlalchemy.text(
-                        """
-                        INSERT INTO gold_ledger (net_change, function, transaction)
-                        VALUES (:net_change, 'checkout', :transaction);
-                        """),
-                        {
-                            'net_change': total_cost,  # Negative because it is an expenditure
-                            'transaction': json.dumps({"cart_id": cart_id, "item_sku": item_sku, "quantity": quantity})
-                        }
-                    )
-            else:
-                quantity = 0  # Reset quantity if not enough stock
-
-    return {"total_potions_bought": potions_bought, "total_gold_paid": gold_spent}
+async def checkout(cart_id: int, cart_checkout: CartCheckout):
+    """
+    Process checkout, updating financial and inventory records using ledgers.
+
+    The whole checkout is a single set-based statement, so its cost doesn't
+    grow with the number of lines in the cart. The cart lines are summed per
+    potion (at the price recorded on each line when it was added), every potion with enough stock is taken out of potion_balance in
+    one conditional UPDATE (which row-locks the balances, so two concurrent
+    checkouts can't both sell the last potions), and the potion_ledger,
+    gold_ledger and gold balance writes, the analytics rollups and the
+    search table are all fed from what that UPDATE sold. Potions without
+    enough stock are skipped, as before.
+
+    The cart's stock holds (src/reservations.py) are released first, in the
+    same transaction, so the held potions count as free stock for this cart
+    and nobody else can take them in between.
+    """
+    result = await db.run_in_transaction(sell_cart, cart_id)
+
+    if result.potions_bought or result.released:
+        catalog.invalidate()
+
+    return {"total_potions_bought": result.potions_bought, "total_gold_paid": result.gold_spent}
+
+
+class CheckoutResult(NamedTuple):
+    potions_bought: int
+    gold_spent: int
+    released: dict
+
+
+def sell_cart(connection, cart_id):
+    current_time = game_clock.now(connection)
+
+    # Give the cart's holds, and any expired ones on its potions, back first. Its potions' balances
+    # are locked (in order) until commit, so nobody else can take that stock before the sale below
+    potion_ids = reservations.lock_stock(connection, cart_id=cart_id)
+    released = reservations.reclaim(connection, potion_ids)
+    for potion_id, quantity in reservations.release(connection, cart_id).items():
+        released[potion_id] = released.get(potion_id, 0) + quantity
+
+    result = connection.execute(sqlalchemy.text("""
+        WITH lines AS (
+            SELECT ci.potion_id, MIN(ci.item_sku) AS sku, SUM(ci.quantity) AS quantity,
+                   SUM(ci.quantity * ci.price) AS total_cost
+            FROM cart_items ci
+            WHERE ci.run_id = current_run_id() AND ci.cart_id = :cart_id
+            GROUP BY ci.potion_id
+        ),
+        sold AS (
+            UPDATE potion_balance pb
+            SET quantity = pb.quantity - lines.quantity
+            FROM lines
+            WHERE pb.potion_id = lines.potion_id
+              AND lines.quantity > 0
+              AND pb.quantity - pb.reserved >= lines.quantity
+            RETURNING lines.potion_id, lines.sku, lines.quantity, lines.total_cost
+        ),
+        potion_rows AS (
+            INSERT INTO potion_ledger (potion_id, quantity, function, transaction, cost, day, hour)
+            SELECT sold.potion_id, -sold.quantity, 'sale',
+                   json_build_object('cart_id', CAST(:cart_id AS integer), 'item_sku', sold.sku),
+                   sold.total_cost, CAST(:day AS text), CAST(:hour AS integer)
+            FROM sold
+        ),
+        gold_rows AS (
+            INSERT INTO gold_ledger (net_change, function, transaction, day, hour)
+            SELECT sold.total_cost, 'checkout',
+                   json_build_object('cart_id', CAST(:cart_id AS integer), 'item_sku', sold.sku, 'quantity', sold.quantity),
+                   CAST(:day AS text), CAST(:hour AS integer)
+            FROM sold
+        ),
+        gold_balance AS (
+            INSERT INTO shop_balance (id, gold)
+            SELECT 1, SUM(sold.total_cost) FROM sold HAVING COUNT(*) > 0
+            ON CONFLICT (id) DO UPDATE SET gold = shop_balance.gold + EXCLUDED.gold
+        ),
+        search_rows AS (""" + order_search.RECORD_LINES_SQL + """),
+        sales_rollup AS (""" + analytics.RECORD_SALES_SQL + """),
+        gold_rollup AS (""" + analytics.RECORD_SALES_GOLD_SQL + """)
+        SELECT CAST(COALESCE(SUM(quantity), 0) AS bigint) AS potions_bought,
+               CAST(COALESCE(SUM(total_cost), 0) AS bigint) AS gold_spent,
+               array_agg(potion_id) AS potion_ids,
+               array_agg(quantity) AS quantities
+        FROM sold
+    """), {
+        "cart_id": cart_id,
+        "day": current_time.day if current_time else None,
+        "hour": current_time.hour if current_time else None
+    }).one()
+
+    if result.potions_bought:
+        shop_state.stage(connection, gold=result.gold_spent,
+                         potions={potion_id: -quantity for potion_id, quantity in zip(result.potion_ids, result.quantities)})
+    return CheckoutResult(result.potions_bought, result.gold_spent, released)
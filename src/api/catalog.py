@@ -1,132 +1,209 @@
-from fastapi import APIRouter
-import sqlalchemy
+from fastapi import APIRouter, Request, Response
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
 from src import database as db
+from src import forecast
+from src import game_clock
+from src import potions
+from src import shop_state
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
+# The catalog only changes when potion stock or the game hour changes, so the
+# computed catalog is kept in memory and reused until one of them moves. Every
+# endpoint that changes stock (or holds it for a cart) calls invalidate(), the
+# hour is part of the cache key, and CATALOG_CACHE_TTL bounds how long a change
+# made by another worker process can go unnoticed.
+CACHE_TTL_SECONDS = float(os.environ.get("CATALOG_CACHE_TTL", "5"))
+
+_cache_lock = threading.Lock()
+_stock_version = 0
+_cached = None  # (stock_version, game time, built_at, etag, catalog)
+
+
+def invalidate():
+    """ Marks the cached catalog stale. Call after committing any change to potion stock. """
+    global _stock_version
+    with _cache_lock:
+        _stock_version += 1
+
 
 @router.get("/catalog/", tags=["catalog"])
-def get_catalog():
+async def get_catalog(request: Request, response: Response):
+    """
+    Serves the catalog of available potions, rebuilding it only when potion
+    stock or the game hour has changed. Responses carry an ETag, and a
+    request whose If-None-Match still matches gets an empty 304.
+    """
+    global _cached
+
+    with _cache_lock:
+        version = _stock_version
+        cached = _cached
+
+    current_time = game_clock.cached()
+
+    if (cached is not None and current_time is not None
+            and cached[0] == version and cached[1] == current_time
+            and time.monotonic() - cached[2] < CACHE_TTL_SECONDS):
+        etag, catalog = cached[3], cached[4]
+    else:
+        current_time, catalog = await db.run_in_transaction(load_catalog)
+
+        etag = '"' + hashlib.sha1(json.dumps(catalog, sort_keys=True).encode()).hexdigest() + '"'
+
+        with _cache_lock:
+            # If stock changed while we were building, leave it for the next request to rebuild
+            if _stock_version == version:
+                _cached = (version, current_time, time.monotonic(), etag, catalog)
+
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return catalog
+
+
+def load_catalog(connection):
+    """ Returns (current game time, catalog) read in one transaction. """
+    current_time = game_clock.now(connection)
+    return current_time, build_catalog(connection, current_time)
+
+
+def build_catalog(connection, current_time):
     """
-    Generates a catalog of available potions by aggregating changes from the potion_ledger.
+    Generates a catalog of available potions from the running potion balances.
     """
 
     catalog = []
-    with db.engine.begin() as connection:
-        # Aggregate current quantities from the potion_ledger
-        current_inventory = connection.execute(sqlalchemy.text(
-            """
-            SELECT pi.id, pi.sku, pi.name, pi.price, 
-                   pi.red_ml, pi.green_ml, pi.blue_ml, pi.dark_ml,
-                   COALESCE(SUM(pl.quantity), 0) AS total_quantity
-            FROM potion_inventory pi
-            LEFT JOIN potion_ledger pl ON pi.id = pl.potion_id
-            GROUP BY pi.id
-            HAVING COALESCE(SUM(pl.quantity), 0) > 0
-            ORDER BY CASE 
-                WHEN pi.sku LIKE '%RED%' THEN 1
-                WHEN pi.sku LIKE '%BLACK%' THEN 2
-                WHEN pi.sku LIKE '%GREEN%' THEN 3
-                WHEN pi.sku LIKE '%PURPLE%' THEN 4
-                WHEN pi.sku LIKE '%YELLOW%' THEN 5
-                WHEN pi.sku LIKE '%WHITE%' THEN 6
-                WHEN pi.sku LIKE '%BLUE%' THEN 7
-                ELSE 8
-            END, pi.sku
-            """
-        ))
-
-        inventory_list = list(current_inventory.mappings())
-
-        # print("CURRENT INVENTORY LIST:")
-        # for row in inventory_list:
-        #     print(f"ID: {row['id']}, SKU: {row['sku']}, Name: {row['name']}, Price: {row['price']}, "
-        #           f"Red ML: {row['red_ml']}, Green ML: {row['green_ml']}, Blue ML: {row['blue_ml']}, "
-        #           f"Dark ML: {row['dark_ml']}, Total Quantity: {row['total_quantity']}")
-
-        # current_inventory = connection.execute(sqlalchemy.text(
-        #     """
-        #     SELECT pi.id, pi.sku, pi.name, pi.price, 
-        #            pi.red_ml, pi.green_ml, pi.blue_ml, pi.dark_ml,
-        #            COALESCE(SUM(pl.quantity), 0) AS stock_quantity,
-        #            pqs.total_quantity
-        #     FROM potion_inventory pi
-        #     LEFT JOIN potion_ledger pl ON pi.id = pl.potion_id
-        #     LEFT JOIN (
-        #         SELECT item_sku, SUM(quantity) AS total_quantity
-        #         FROM cart_items
-        #         GROUP BY item_sku
-        #     ) pqs ON pi.sku = pqs.item_sku
-        #     GROUP BY pi.id, pqs.total_quantity
-        #     ORDER BY pqs.total_quantity DESC NULLS LAST
-        #     """
-        # ))
-
-        current_time = connection.execute(sqlalchemy.text("""
-                            SELECT day, hour FROM time_table ORDER BY created_at DESC LIMIT 1;
-                        """)).first()  # Use first() to fetch the first result directly
+    # Potions in stock and not held for carts, from the registry and the shop state, less the
+    # ones the shop never lists
+    state = shop_state.get(connection)
+    inventory_list = sorted(
+        ((potion, state.available(potion.id)) for potion in potions.all_potions(connection)
+         if state.available(potion.id) > 0 and not never_listed(list(potion.recipe))),
+        key=lambda item: (catalog_rank(item[0].sku), item[0].sku))
+
+    # Once there is sales history for this hour, the six slots go to the potions expected to
+    # sell the most instead of following the day rules below. Potions without an estimate
+    # yet come first, so each one gets tried.
+    expected = forecast.demand(connection, current_time.day, current_time.hour) if current_time else None
+    if expected is not None:
+        ranked = sorted(inventory_list, key=lambda item: -expected.get(item[0].id, math.inf))[:6]
+        catalog = [{
+            "sku": potion.sku,
+            "name": potion.name,
+            "quantity": quantity,
+            "price": potion.price,
+            "potion_type": list(potion.recipe),
+        } for potion, quantity in ranked]
+        logger.debug("Forecast catalog for %s %s: %s", current_time.day, current_time.hour, catalog)
+        return catalog
+
+    # print("CURRENT INVENTORY LIST:")
+    # for row in inventory_list:
+    #     print(f"ID: {row['id']}, SKU: {row['sku']}, Name: {row['name']}, Price: {row['price']}, "
+    #           f"Red ML: {row['red_ml']}, Green ML: {row['green_ml']}, Blue ML: {row['blue_ml']}, "
+    #           f"Dark ML: {row['dark_ml']}, Total Quantity: {row['total_quantity']}")
+
+    # current_inventory = connection.execute(sqlalchemy.text(
+    #     """
+    #     SELECT pi.id, pi.sku, pi.name, pi.price, 
+    #            pi.red_ml, pi.green_ml, pi.blue_ml, pi.dark_ml,
+    #            COALESCE(SUM(pl.quantity), 0) AS stock_quantity,
+    #            pqs.total_quantity
+    #     FROM potion_inventory pi
+    #     LEFT JOIN potion_ledger pl ON pi.id = pl.potion_id
+    #     LEFT JOIN (
+    #         SELECT item_sku, SUM(quantity) AS total_quantity
+    #         FROM cart_items
+    #         GROUP BY item_sku
+    #     ) pqs ON pi.sku = pqs.item_sku
+    #     GROUP BY pi.id, pqs.total_quantity
+    #     ORDER BY pqs.total_quantity DESC NULLS LAST
+    #     """
+    # ))
+
+    logger.debug("The current time is %s %s", current_time.day, current_time.hour)
+
+    dark_blue = None
+
+    # # Find the inventory item with id 10
+    # for item in inventory_list:
+    #     if item['id'] == 10:
+    #         dark_blue = item
+    #         break
+
+    # if dark_blue:
+    #     current_time = connection.execute(sqlalchemy.text("""
+    #                         SELECT day, hour FROM time_table ORDER BY created_at DESC LIMIT 1;
+    #                     """)).first()  # Use first() to fetch the first result directly
+        
+    #     logger.debug("The current time is %s %s", current_time.day, current_time.hour)
         
-        print(f"\nThe current time is {current_time.day}  {current_time.hour}")
-
-        dark_blue = None
-
-        # # Find the inventory item with id 10
-        # for item in inventory_list:
-        #     if item['id'] == 10:
-        #         dark_blue = item
-        #         break
-
-        # if dark_blue:
-        #     current_time = connection.execute(sqlalchemy.text("""
-        #                         SELECT day, hour FROM time_table ORDER BY created_at DESC LIMIT 1;
-        #                     """)).first()  # Use first() to fetch the first result directly
-            
-        #     print(f"\nThe current time is {current_time.day}  {current_time.hour}")
-            
-        #     sku = dark_blue['sku']
-        #     potion_type = [dark_blue['red_ml'], dark_blue['green_ml'], dark_blue['blue_ml'], dark_blue['dark_ml']]
-        #     quantity = dark_blue['total_quantity']
-        #     name = dark_blue['name']
-        #     price = dark_blue['price']
-        #     catalog.append({
-        #             "sku": sku,
-        #             "name": name,
-        #             "quantity": quantity,
-        #             "price": price,
-        #             "potion_type": potion_type,
-        #         })
-
-        for row in inventory_list:
-            # print("Adding to catalog: " + str(row))
-            sku = row.sku
-            potion_type = [row.red_ml, row.green_ml, row.blue_ml, row.dark_ml]
-            quantity = row.total_quantity
-            name = row.name
-            price = row.price
-            print("Number of " + str(potion_type) + " potions offered: " + str(quantity))
-
-            if any([(current_time.day == "Edgeday" and current_time.hour <= 22) and potion_type[0] == 100, #RED
-                    (current_time.day == "Bloomday" and current_time.hour <= 22) and potion_type[1] == 100, #GREEN
-                    (current_time.day == "Arcanaday" and current_time.hour <= 22) and potion_type[2] == 100, #BLUE
-                    (current_time.day == "Edgeday" and current_time.hour <= 22) and potion_type[3] == 100, #BLACK 
-                    (current_time.day == "Edgeday" and current_time.hour <= 22) and (potion_type[0] == 50 and potion_type[1] == 50), #YELLOW
-                    (current_time.day == "Soulday" and current_time.hour <= 22) and (potion_type[0] == 50 and potion_type[2] == 50), #PURPLE POTIONS
-                    (potion_type[0] == 50 and potion_type[3] == 50)]): #DARK RED
-                print(f"Not adding {name} to catalog because it's {current_time.day} {current_time.hour}")
-                continue
-
-            catalog.append({
-                "sku": sku,
-                "name": name,
-                "quantity": quantity,
-                "price": price,
-                "potion_type": potion_type,
-            })
-        print("\n")
+    #     sku = dark_blue['sku']
+    #     potion_type = [dark_blue['red_ml'], dark_blue['green_ml'], dark_blue['blue_ml'], dark_blue['dark_ml']]
+    #     quantity = dark_blue['total_quantity']
+    #     name = dark_blue['name']
+    #     price = dark_blue['price']
+    #     catalog.append({
+    #             "sku": sku,
+    #             "name": name,
+    #             "quantity": quantity,
+    #             "price": price,
+    #             "potion_type": potion_type,
+    #         })
+
+    for row, quantity in inventory_list:
+        # print("Adding to catalog: " + str(row))
+        sku = row.sku
+        potion_type = list(row.recipe)
+        name = row.name
+        price = row.price
+        logger.debug("Number of %s potions offered: %s", potion_type, quantity)
+
+        if any([(current_time.day == "Edgeday" and current_time.hour <= 22) and potion_type[0] == 100, #RED
+                (current_time.day == "Bloomday" and current_time.hour <= 22) and potion_type[1] == 100, #GREEN
+                (current_time.day == "Arcanaday" and current_time.hour <= 22) and potion_type[2] == 100, #BLUE
+                (current_time.day == "Edgeday" and current_time.hour <= 22) and potion_type[3] == 100, #BLACK 
+                (current_time.day == "Edgeday" and current_time.hour <= 22) and (potion_type[0] == 50 and potion_type[1] == 50), #YELLOW
+                (current_time.day == "Soulday" and current_time.hour <= 22) and (potion_type[0] == 50 and potion_type[2] == 50)]): #PURPLE POTIONS
+            logger.debug("Not adding %s to catalog because it's %s %s", name, current_time.day, current_time.hour)
+            continue
+
+        catalog.append({
+            "sku": sku,
+            "name": name,
+            "quantity": quantity,
+            "price": price,
+            "potion_type": potion_type,
+        })
 
     catalog = catalog[:6]
-    print("Final Catalog:")
-    for item in catalog:
-        print(f"SKU: {item['sku']}, Name: {item['name']}, Quantity: {item['quantity']}, Price: {item['price']}, Potion Types: {item['potion_type']}")
-        
+    logger.debug("Final Catalog: %s", catalog)
+
     return catalog
+
+
+def never_listed(potion_type):
+    """ Potions left out of the catalog whatever the day, hour or forecast. """
+    return potion_type[0] == 50 and potion_type[3] == 50  # DARK RED
+
+
+# Display order: the first keyword in the sku decides the potion's place
+CATALOG_ORDER = ['RED', 'BLACK', 'GREEN', 'PURPLE', 'YELLOW', 'WHITE', 'BLUE']
+
+
+def catalog_rank(sku):
+    for rank, keyword in enumerate(CATALOG_ORDER):
+        if keyword in sku:
+            return rank
+    return len(CATALOG_ORDER)
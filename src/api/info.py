@@ -2,7 +2,13 @@ from fastapi import APIRouter, Depends, Request
 from pydantic import BaseModel
 from src.api import auth
 import sqlalchemy
+import logging
 from src import database as db
+from src.api import catalog
+from src import forecast
+from src import game_clock
+from src import potions
+from src import reservations
 
 
 router = APIRouter(
@@ -11,23 +17,45 @@ router = APIRouter(
     dependencies=[Depends(auth.get_api_key)],
 )
 
+logger = logging.getLogger(__name__)
+
 class Timestamp(BaseModel):
     day: str
     hour: int
 
 @router.post("/current_time")
-def post_time(timestamp: Timestamp):
+async def post_time(timestamp: Timestamp):
     """
     Share current time, and store it in our time_table
     """
 
-    with db.engine.begin() as connection:
-        connection.execute(sqlalchemy.text("""
-                INSERT INTO time_table (day, hour)
-                VALUES (:day, :hour);
-                """), {'day': timestamp.day, 'hour': timestamp.hour})
+    await db.run_in_transaction(record_time, timestamp.day, timestamp.hour)
+
+    # Every router reads the hour from the shared clock rather than time_table
+    game_clock.set_time(timestamp.day, timestamp.hour)
+    forecast.invalidate()
+    catalog.invalidate()
 
-    print("Day: ", timestamp.day, "\nHour: ", str(timestamp.hour), "\n")
+    logger.debug("Day: %s Hour: %s", timestamp.day, timestamp.hour)
 
     return "OK"
 
+
+def record_time(connection, day, hour):
+    # The tick that just ended goes into the demand forecast. What the catalog lists with the
+    # stock left at its end stands in for what was offered during it; potions that sold out
+    # meanwhile still count through their sales.
+    previous = game_clock.now(connection)
+    if previous is not None and previous != (day, hour):
+        offered = catalog.build_catalog(connection, previous)
+        forecast.record_offers(connection, previous.day, previous.hour,
+                               [potions.by_sku(connection, item['sku']).id for item in offered])
+        forecast.observe_tick(connection, previous.day, previous.hour)
+
+    # Hand back the stock of abandoned carts' expired holds, so the next tick's catalog lists it again
+    reservations.reclaim(connection)
+
+    connection.execute(sqlalchemy.text("""
+            INSERT INTO time_table (day, hour)
+            VALUES (:day, :hour);
+            """), {'day': day, 'hour': hour})
@@ -1,12 +1,19 @@
 from fastapi import FastAPI, exceptions
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import ValidationError
-from src.api import carts, catalog, bottler, barrels, admin, info, inventory
+from src.api import carts, catalog, bottler, barrels, admin, info, inventory, analytics
+from src import potions
+from src import reservations
+from src import metrics
+from src import logs
 import json
 import logging
 import sys
 from starlette.middleware.cors import CORSMiddleware
 
+logs.configure()
+logger = logging.getLogger(__name__)
+
 description = """
 Discover the art of our Mustang Mixers with Learn By Brewing - Where Every Sip Starts an Adventure!"""
 
@@ -31,6 +38,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per-route latency, request/error counts and SQL statements per request, served at /metrics
+app.middleware("http")(metrics.middleware)
+
 app.include_router(inventory.router)
 app.include_router(carts.router)
 app.include_router(catalog.router)
@@ -38,11 +48,28 @@ app.include_router(bottler.router)
 app.include_router(barrels.router)
 app.include_router(admin.router)
 app.include_router(info.router)
+app.include_router(analytics.router)
+
+@app.on_event("startup")
+async def start_potion_listener():
+    # Reload the potion registry whenever potion_inventory changes (needs migration 0009)
+    if potions.listener_enabled():
+        potions.start_listener(on_change=catalog.invalidate)
+
+@app.on_event("startup")
+async def start_stock_reclaimer():
+    # Optionally also sweep expired cart holds every RESERVATION_RECLAIM_SECONDS (off by default;
+    # requests reclaim the holds they run into, and every tick reclaims the rest)
+    reservations.start_reclaimer(on_reclaim=catalog.invalidate)
+
+@app.on_event("shutdown")
+async def stop_stock_reclaimer():
+    reservations.stop_reclaimer()
 
 @app.exception_handler(exceptions.RequestValidationError)
 @app.exception_handler(ValidationError)
 async def validation_exception_handler(request, exc):
-    logging.error(f"The client sent invalid data!: {exc}")
+    logger.error("The client sent invalid data!: %s", exc)
     exc_json = json.loads(exc.json())
     response = {"message": [], "data": None}
     for error in exc_json:
@@ -53,3 +80,7 @@ async def validation_exception_handler(request, exc):
 @app.get("/")
 async def root():
     return {"message": "Welcome to the Central Coast Cauldrons."}
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,170 @@
+import math
+
+# Bottling planner. Chooses how many of each recipe to bottle so that the total
+# value is as high as possible without using more ml of any color than we
+# have, more potions than max_potions, or more of a recipe than its cap:
+#
+#     maximize    sum(values[j] * x[j])
+#     subject to  sum(recipes[j][c] * x[j]) <= ml[c]     for each of the 4 colors
+#                 sum(x[j])                 <= max_potions
+#                 0 <= x[j] <= caps[j], x[j] integer
+#
+# It solves the LP relaxation with a bounded-variable simplex (only 5 rows, so
+# each pivot is O(number of recipes)), rounds the result down, which keeps it
+# feasible, and then tops recipes up greedily with whatever ml is left over.
+
+EPSILON = 1e-9
+
+
+def plan_bottles(ml, recipes, caps, values, max_potions):
+    """
+    ml: available [red, green, blue, dark] ml.
+    recipes: [r, g, b, d] ml per potion for each candidate recipe.
+    caps: the most of each recipe we are willing to bottle.
+    values: how much one potion of each recipe is worth to us (e.g. its price).
+    max_potions: how many potions we can bottle in total.
+
+    Returns the number of potions to bottle for each recipe, in input order.
+    """
+    n = len(recipes)
+    quantities = [0] * n
+    if n == 0 or max_potions <= 0:
+        return quantities
+
+    # Tighten every cap to what the ml pools could make on their own
+    bounds = []
+    for recipe, cap in zip(recipes, caps):
+        bound = min(cap, max_potions)
+        for color in range(4):
+            if recipe[color] > 0:
+                bound = min(bound, ml[color] // recipe[color])
+        bounds.append(max(0, bound))
+
+    relaxed = _solve_relaxation(ml, recipes, bounds, values, max_potions)
+
+    remaining_ml = list(ml)
+    remaining_potions = max_potions
+    for j in range(n):
+        quantities[j] = min(bounds[j], math.floor(relaxed[j] + EPSILON))
+        for color in range(4):
+            remaining_ml[color] -= recipes[j][color] * quantities[j]
+        remaining_potions -= quantities[j]
+
+    # Spend the leftovers from rounding, most valuable recipe first, in closed form per recipe
+    for j in sorted(range(n), key=lambda j: -values[j]):
+        if values[j] <= 0 or remaining_potions <= 0:
+            continue
+        extra = min(bounds[j] - quantities[j], remaining_potions)
+        for color in range(4):
+            if recipes[j][color] > 0:
+                extra = min(extra, remaining_ml[color] // recipes[j][color])
+        if extra > 0:
+            quantities[j] += extra
+            for color in range(4):
+                remaining_ml[color] -= recipes[j][color] * extra
+            remaining_potions -= extra
+
+    return quantities
+
+
+def _solve_relaxation(ml, recipes, bounds, values, max_potions):
+    """
+    Bounded-variable primal simplex for the LP above. Columns 0..n-1 are the
+    recipes, n..n+4 the slacks of the five rows; the slack basis is feasible
+    because every right-hand side is non-negative. Returns fractional x.
+    """
+    n = len(recipes)
+    m = 5
+    width = n + m
+
+    rows = []
+    for color in range(4):
+        row = [float(recipe[color]) for recipe in recipes] + [0.0] * m
+        row[n + color] = 1.0
+        rows.append(row)
+    rows.append([1.0] * n + [0.0] * m)
+    rows[4][n + 4] = 1.0
+
+    rhs = [float(ml[color]) for color in range(4)] + [float(max_potions)]
+    upper = [float(bound) for bound in bounds] + [math.inf] * m
+    reduced = [float(value) for value in values] + [0.0] * m
+    basis = [n + i for i in range(m)]
+    at_upper = [False] * width
+    is_basic = [False] * n + [True] * m
+
+    # Dantzig's rule converges fastest in practice; Bland's rule afterwards rules out cycling
+    bland_after = 50 * width
+    for iteration in range(500 * width):
+        entering = -1
+        best = EPSILON
+        for j in range(width):
+            if is_basic[j] or upper[j] == 0:
+                continue
+            gain = -reduced[j] if at_upper[j] else reduced[j]
+            if gain > best:
+                entering = j
+                best = gain
+                if iteration >= bland_after:
+                    break
+        if entering < 0:
+            break
+
+        direction = -1.0 if at_upper[entering] else 1.0
+
+        # Ratio test: how far can the entering variable move before something hits a bound
+        step = upper[entering]
+        leaving_row = -1
+        leaving_to_upper = False
+        for i in range(m):
+            coefficient = direction * rows[i][entering]
+            if coefficient > EPSILON:
+                limit = rhs[i] / coefficient
+                to_upper = False
+            elif coefficient < -EPSILON and upper[basis[i]] != math.inf:
+                limit = (upper[basis[i]] - rhs[i]) / -coefficient
+                to_upper = True
+            else:
+                continue
+            if limit < step - EPSILON:
+                step = limit
+                leaving_row = i
+                leaving_to_upper = to_upper
+
+        for i in range(m):
+            rhs[i] -= direction * rows[i][entering] * step
+
+        if leaving_row < 0:
+            # The entering variable reached its own bound first: flip it, no pivot needed
+            at_upper[entering] = not at_upper[entering]
+            continue
+
+        leaving = basis[leaving_row]
+        entering_value = (upper[entering] if at_upper[entering] else 0.0) + direction * step
+        is_basic[leaving] = False
+        at_upper[leaving] = leaving_to_upper
+        is_basic[entering] = True
+        at_upper[entering] = False
+        basis[leaving_row] = entering
+        rhs[leaving_row] = entering_value
+
+        pivot_row = rows[leaving_row]
+        pivot = pivot_row[entering]
+        for k in range(width):
+            pivot_row[k] /= pivot
+        for i in range(m):
+            if i != leaving_row:
+                factor = rows[i][entering]
+                if factor != 0.0:
+                    row = rows[i]
+                    for k in range(width):
+                        row[k] -= factor * pivot_row[k]
+        factor = reduced[entering]
+        if factor != 0.0:
+            for k in range(width):
+                reduced[k] -= factor * pivot_row[k]
+
+    solution = [upper[j] if at_upper[j] else 0.0 for j in range(n)]
+    for i in range(m):
+        if basis[i] < n:
+            solution[basis[i]] = max(0.0, rhs[i])
+    return solution
@@ -1,15 +1,362 @@
+import contextlib
+import functools
 import os
+import threading
+import time
 import dotenv
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy import create_engine, event, exc, MetaData, Table, Column, Integer, Text, DateTime, func
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+from starlette.concurrency import run_in_threadpool
+from src import shop_state
 
 def database_connection_url():
     dotenv.load_dotenv()
 
     return os.environ.get("POSTGRES_URI")
 
-engine = create_engine(database_connection_url(), pool_pre_ping=True)
+def async_database_connection_url():
+    """ POSTGRES_URI with its driver swapped for asyncpg. """
+    return make_url(database_connection_url()).set(drivername="postgresql+asyncpg")
+
+def async_enabled():
+    """ DATABASE_ASYNC=1 runs requests on an asyncpg engine instead of psycopg2 in the threadpool. """
+    dotenv.load_dotenv()
+
+    return os.environ.get("DATABASE_ASYNC", "").lower() in ("1", "true", "yes")
+
+
+# The tables are declared here rather than reflected, so importing this module
+# (and with it every router) doesn't need a database connection. Only the
+# columns the code uses are listed; the database itself is the source of truth.
+# The tables with a run_id are partitioned by it (see src/runs.py); their
+# run_id defaults to the current run, so inserts leave it out.
 metadata = MetaData()
-metadata.reflect(bind=engine)
-carts = metadata.tables['carts']
-cart_items = metadata.tables['cart_items']
-potion_inventory = metadata.tables['potion_inventory']
\ No newline at end of file
+
+carts = Table(
+    "carts", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("run_id", Integer),
+    Column("name", Text),
+    Column("class", Text),
+    Column("level", Integer),
+    Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+)
+
+cart_items = Table(
+    "cart_items", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("run_id", Integer),
+    Column("cart_id", Integer),
+    Column("potion_id", Integer),
+    Column("item_sku", Text),
+    Column("quantity", Integer),
+    Column("price", Integer),
+    Column("day", Text),
+    Column("hour", Integer),
+    Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+)
+
+# Sold line items, denormalized for /carts/search/ (see src/order_search.py)
+order_search = Table(
+    "order_search", metadata,
+    Column("run_id", Integer, primary_key=True),
+    Column("line_item_id", Integer, primary_key=True),
+    Column("cart_id", Integer),
+    Column("customer_name", Text),
+    Column("item_sku", Text),
+    Column("line_item_total", Integer),
+    Column("created_at", DateTime(timezone=True), nullable=False),
+)
+
+potion_inventory = Table(
+    "potion_inventory", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("sku", Text),
+    Column("name", Text),
+    Column("price", Integer),
+    Column("red_ml", Integer),
+    Column("green_ml", Integer),
+    Column("blue_ml", Integer),
+    Column("dark_ml", Integer),
+)
+
+gold_ledger = Table(
+    "gold_ledger", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("run_id", Integer),
+    Column("net_change", Integer),
+    Column("function", Text),
+    Column("transaction", Text),
+    Column("day", Text),
+    Column("hour", Integer),
+    Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+)
+
+ml_ledger = Table(
+    "ml_ledger", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("run_id", Integer),
+    Column("net_change", Integer),
+    Column("barrel_type", Text),
+    Column("function", Text),
+    Column("transaction", Text),
+    Column("day", Text),
+    Column("hour", Integer),
+    Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+)
+
+potion_ledger = Table(
+    "potion_ledger", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("run_id", Integer),
+    Column("potion_id", Integer),
+    Column("quantity", Integer),
+    Column("function", Text),
+    Column("transaction", Text),
+    Column("cost", Integer),
+    Column("day", Text),
+    Column("hour", Integer),
+    Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+)
+
+capacity_ledger = Table(
+    "capacity_ledger", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("run_id", Integer),
+    Column("ml_capacity", Integer),
+    Column("potion_capacity", Integer),
+    Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+)
+
+time_table = Table(
+    "time_table", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("run_id", Integer),
+    Column("day", Text),
+    Column("hour", Integer),
+    Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+)
+
+dark_order_tracker = Table(
+    "dark_order_tracker", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("day", Text),
+    Column("hour", Integer),
+    Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+)
+
+
+# Engines are built on first use instead of at import. db.engine and
+# db.async_engine still read like module attributes (see __getattr__).
+#
+# How they pool connections depends on where the app runs, set by DATABASE_POOL:
+#
+#   queue      (default) a pool of DATABASE_POOL_SIZE connections kept open, plus
+#              up to DATABASE_MAX_OVERFLOW more under load. A request waits up to
+#              DATABASE_POOL_TIMEOUT seconds for one, and connections are replaced
+#              after DATABASE_POOL_RECYCLE seconds. DATABASE_POOL_PRE_PING=0 skips
+#              the liveness check on every checkout.
+#   null       no pool: every transaction opens and closes its own connection. For
+#              serverless deploys, where a pool would outlive the request and every
+#              instance would hold its own.
+#   pgbouncer  no pool either, since pgbouncer does the pooling, and nothing that
+#              needs a session: asyncpg's statement cache is off and the statement
+#              timeout is set per transaction. asyncpg still prepares each statement,
+#              which in transaction mode needs pgbouncer 1.21+ (max_prepared_statements);
+#              on older versions leave DATABASE_ASYNC off.
+#
+# DATABASE_STATEMENT_TIMEOUT (milliseconds, 0 = none) cancels statements that run
+# longer, so a stuck query gives its connection back instead of holding it.
+_engine_lock = threading.Lock()
+_engine = None
+_async_engine = None
+_async_checked = False
+
+POOL_PROFILES = ("queue", "null", "pgbouncer")
+
+
+def pool_profile():
+    dotenv.load_dotenv()
+
+    profile = os.environ.get("DATABASE_POOL", "queue").lower()
+    if profile not in POOL_PROFILES:
+        raise ValueError(f"DATABASE_POOL must be one of {', '.join(POOL_PROFILES)}, not {profile!r}")
+    return profile
+
+def statement_timeout():
+    """ DATABASE_STATEMENT_TIMEOUT in milliseconds, 0 if unset. """
+    dotenv.load_dotenv()
+
+    return int(os.environ.get("DATABASE_STATEMENT_TIMEOUT", "0"))
+
+def engine_options(driver, pool_size, max_overflow):
+    """ create_engine keyword arguments for the configured pool profile and statement timeout. """
+    profile = pool_profile()
+    timeout = statement_timeout()
+
+    if profile == "queue":
+        options = {
+            "pool_size": int(os.environ.get("DATABASE_POOL_SIZE", pool_size)),
+            "max_overflow": int(os.environ.get("DATABASE_MAX_OVERFLOW", max_overflow)),
+            "pool_timeout": float(os.environ.get("DATABASE_POOL_TIMEOUT", "30")),
+            "pool_recycle": int(os.environ.get("DATABASE_POOL_RECYCLE", "1800")),
+            "pool_pre_ping": os.environ.get("DATABASE_POOL_PRE_PING", "1").lower() in ("1", "true", "yes"),
+        }
+    else:
+        options = {"poolclass": NullPool}
+
+    connect_args = {}
+    if profile == "pgbouncer":
+        if driver == "asyncpg":
+            connect_args.update(statement_cache_size=0, prepared_statement_cache_size=0)
+    elif timeout:
+        # Set once per connection, as a startup parameter, so it costs no extra round trip
+        if driver == "asyncpg":
+            connect_args["server_settings"] = {"statement_timeout": str(timeout)}
+        else:
+            connect_args["options"] = f"-c statement_timeout={timeout}"
+    if connect_args:
+        options["connect_args"] = connect_args
+    return options
+
+@functools.lru_cache(maxsize=None)
+def _transaction_settings():
+    """ Statements to run at the start of every request transaction (pgbouncer keeps no session state). """
+    timeout = statement_timeout()
+    if pool_profile() == "pgbouncer" and timeout:
+        return (f"SET LOCAL statement_timeout = {timeout}",)
+    return ()
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine(database_connection_url(), **engine_options("psycopg2", 5, 10))
+                _track_pool(_engine.pool, _pool_stats["sync"])
+    return _engine
+
+def get_async_engine():
+    """ The asyncpg engine, or None unless DATABASE_ASYNC is set. """
+    global _async_engine, _async_checked
+    if not _async_checked:
+        with _engine_lock:
+            if not _async_checked:
+                if async_enabled():
+                    from sqlalchemy.ext.asyncio import create_async_engine
+
+                    # Nothing sits in a threadpool in front of this engine, so by default it keeps more
+                    # connections busy than the sync path (capped by the threadpool's 40 threads)
+                    _async_engine = create_async_engine(async_database_connection_url(),
+                                                        **engine_options("asyncpg", 20, 40))
+                    _track_pool(_async_engine.sync_engine.pool, _pool_stats["async"])
+                _async_checked = True
+    return _async_engine
+
+
+class PoolStats:
+    """ What a request transaction went through to get a connection, for /metrics. """
+    __slots__ = ("checked_out", "waiting", "wait_seconds", "timeouts")
+
+    def __init__(self):
+        self.checked_out = 0
+        self.waiting = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+
+_pool_stats_lock = threading.Lock()
+_pool_stats = {"sync": PoolStats(), "async": PoolStats()}
+
+def _track_pool(pool, stats):
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        with _pool_stats_lock:
+            stats.checked_out += 1
+
+    def checkin(dbapi_connection, connection_record):
+        with _pool_stats_lock:
+            stats.checked_out -= 1
+
+    event.listen(pool, "checkout", checkout)
+    event.listen(pool, "checkin", checkin)
+
+@contextlib.contextmanager
+def _waiting_for_connection(stats):
+    with _pool_stats_lock:
+        stats.waiting += 1
+    start = time.perf_counter()
+    try:
+        yield
+    except exc.TimeoutError:
+        with _pool_stats_lock:
+            stats.timeouts += 1
+        raise
+    finally:
+        with _pool_stats_lock:
+            stats.waiting -= 1
+            stats.wait_seconds += time.perf_counter() - start
+
+def pool_stats():
+    """ {"sync"/"async": {size, checked_out, overflow, waiting, wait_seconds, timeouts}} for the engines built so far. """
+    engines = {"sync": _engine, "async": _async_engine.sync_engine if _async_engine is not None else None}
+    result = {}
+    for name, engine in engines.items():
+        if engine is None:
+            continue
+        pool = engine.pool
+        stats = _pool_stats[name]
+        with _pool_stats_lock:
+            result[name] = {
+                "size": pool.size() if isinstance(pool, QueuePool) else 0,
+                "checked_out": stats.checked_out,
+                "overflow": max(0, pool.overflow()) if isinstance(pool, QueuePool) else 0,
+                "waiting": stats.waiting,
+                "wait_seconds": stats.wait_seconds,
+                "timeouts": stats.timeouts,
+            }
+    return result
+
+def __getattr__(name):
+    if name == "engine":
+        return get_engine()
+    if name == "async_engine":
+        return get_async_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+async def run_in_transaction(fn, *args, **kwargs):
+    """
+    Runs fn(connection, *args, **kwargs) inside one transaction and returns its
+    result, without blocking the event loop. With the async engine the sync
+    code runs on an asyncpg connection (AsyncConnection.run_sync), so waiting on
+    Postgres yields to other requests; otherwise it falls back to psycopg2 on
+    the threadpool, which is what sync endpoints did before.
+    """
+    async_engine = get_async_engine()
+    if async_engine is not None:
+        with _waiting_for_connection(_pool_stats["async"]):
+            connection = await async_engine.connect()
+        try:
+            async with connection.begin():
+                for statement in _transaction_settings():
+                    await connection.exec_driver_sql(statement)
+                result = await connection.run_sync(fn, *args, **kwargs)
+            shop_state.publish(connection.sync_connection)
+            return result
+        finally:
+            await connection.close()
+
+    return await run_in_threadpool(_run_sync, fn, *args, **kwargs)
+
+def _run_sync(fn, *args, **kwargs):
+    with _waiting_for_connection(_pool_stats["sync"]):
+        connection = get_engine().connect()
+    with connection:
+        with connection.begin():
+            for statement in _transaction_settings():
+                connection.exec_driver_sql(statement)
+            result = fn(connection, *args, **kwargs)
+        # Only now that the commit went through
+        shop_state.publish(connection)
+        return result
@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+import sqlalchemy
+
+# Expected demand per potion per game (day, hour), learned from sales.
+#
+# Every time a new tick arrives, observe_tick() folds the sales of the tick
+# that just ended into an exponential moving average in demand_forecast: one
+# statement, whatever the size of the sales history. The sales come from
+# potion_sales_rollup (see src/analytics.py), which adds up every week of a
+# run under the same (day, hour), so each forecast row remembers the run total
+# it last saw (run_id, run_quantity) and only the difference counts. Potions
+# that weren't in the catalog during the tick and didn't sell are left alone,
+# since nobody could have bought them; a potion that was offered and didn't
+# sell counts as zero demand. What was offered is recorded with record_offers()
+# when the tick ends (src/api/info.py), from the catalog at that point, so
+# serving the catalog never writes.
+#
+# Readers (the catalog and the bottling plan) look estimates up in a
+# process-wide copy of the table, reloaded after FORECAST_TTL seconds so
+# other workers' updates are picked up. Until a (day, hour) has been seen
+# MIN_OBSERVATIONS times there is no forecast for it and callers fall back to
+# their hard-coded rules.
+
+WEEKDAYS = ['Hearthday', 'Crownday', 'Blesseday', 'Soulday', 'Edgeday', 'Bloomday', 'Arcanaday']
+
+ALPHA = float(os.environ.get("FORECAST_ALPHA", "0.3"))
+MIN_OBSERVATIONS = int(os.environ.get("FORECAST_MIN_OBSERVATIONS", "2"))
+TTL_SECONDS = float(os.environ.get("FORECAST_TTL", "60"))
+
+
+_lock = threading.Lock()
+_table = None  # (day, hour) -> {potion_id: (expected, observations)}
+_loaded_at = 0.0
+
+
+def invalidate():
+    """ Forgets this process's copy; the next lookup reloads it. """
+    global _table
+    with _lock:
+        _table = None
+
+
+def _load(connection):
+    global _table, _loaded_at
+    with _lock:
+        if _table is not None and time.monotonic() - _loaded_at < TTL_SECONDS:
+            return _table
+
+    table = {}
+    for row in connection.execute(sqlalchemy.text(
+            "SELECT potion_id, day, hour, expected, observations FROM demand_forecast")):
+        table.setdefault((row.day, row.hour), {})[row.potion_id] = (row.expected, row.observations)
+
+    with _lock:
+        _table = table
+        _loaded_at = time.monotonic()
+    return table
+
+
+def demand(connection, day, hour):
+    """ {potion_id: expected potions sold} for one tick, or None if there isn't enough history for it yet. """
+    estimates = _load(connection).get((day, hour))
+    if not estimates or max(observations for _, observations in estimates.values()) < MIN_OBSERVATIONS:
+        return None
+    return {potion_id: expected for potion_id, (expected, _) in estimates.items()}
+
+
+def upcoming_demand(connection, day, hour, hours=24):
+    """
+    {potion_id: expected potions sold} over the ticks in the `hours` game hours
+    after (day, hour), or None if none of those ticks has a forecast yet.
+    """
+    if day not in WEEKDAYS:
+        return None
+
+    total = {}
+    found = False
+    slot = WEEKDAYS.index(day) * 24 + hour
+    for step in range(1, hours + 1):
+        next_day, next_hour = divmod((slot + step) % (len(WEEKDAYS) * 24), 24)
+        estimates = demand(connection, WEEKDAYS[next_day], next_hour)
+        if estimates is None:
+            continue
+        found = True
+        for potion_id, expected in estimates.items():
+            total[potion_id] = total.get(potion_id, 0.0) + expected
+    return total if found else None
+
+
+def record_offers(connection, day, hour, potion_ids):
+    """ Notes that these potions were in the catalog during (day, hour). Call before observe_tick(). """
+    if not potion_ids:
+        return
+    connection.execute(sqlalchemy.text("""
+        INSERT INTO catalog_offers (potion_id, run_id, day, hour)
+        SELECT potion_id, current_run_id(), :day, :hour
+        FROM unnest(CAST(:potion_ids AS integer[])) AS potion_id
+        ON CONFLICT (potion_id) DO UPDATE SET run_id = EXCLUDED.run_id, day = EXCLUDED.day, hour = EXCLUDED.hour
+    """), {"day": day, "hour": hour, "potion_ids": potion_ids})
+
+
+def observe_tick(connection, day, hour):
+    """
+    Folds the current run's sales during (day, hour) into the forecast. Call
+    once per tick, when the next one arrives, and invalidate() after commit.
+    """
+    return connection.execute(sqlalchemy.text("""
+        WITH tick AS (
+            SELECT pi.id AS potion_id,
+                   COALESCE(sales.quantity, 0) AS run_quantity,
+                   COALESCE(sales.quantity, 0)
+                       - CASE WHEN f.run_id = current_run_id() THEN f.run_quantity ELSE 0 END AS sold,
+                   o.potion_id IS NOT NULL AS offered
+            FROM potion_inventory pi
+            LEFT JOIN potion_sales_rollup sales
+                ON sales.run_id = current_run_id() AND sales.potion_id = pi.id
+               AND sales.day = :day AND sales.hour = :hour
+            LEFT JOIN demand_forecast f ON f.potion_id = pi.id AND f.day = :day AND f.hour = :hour
+            LEFT JOIN catalog_offers o
+                ON o.potion_id = pi.id AND o.run_id = current_run_id() AND o.day = :day AND o.hour = :hour
+        )
+        INSERT INTO demand_forecast (potion_id, day, hour, expected, observations, run_id, run_quantity)
+        SELECT potion_id, :day, :hour, sold, 1, current_run_id(), run_quantity
+        FROM tick
+        WHERE sold > 0 OR offered
+        ON CONFLICT (potion_id, day, hour) DO UPDATE SET
+            expected = demand_forecast.expected + :alpha * (EXCLUDED.expected - demand_forecast.expected),
+            observations = demand_forecast.observations + 1,
+            run_id = EXCLUDED.run_id,
+            run_quantity = EXCLUDED.run_quantity
+    """), {"day": day, "hour": hour, "alpha": ALPHA}).rowcount
+
@@ -0,0 +1,68 @@
+import os
+import threading
+import time
+from typing import NamedTuple, Optional
+import sqlalchemy
+
+# The current game day/hour, shared by every router. /info/current_time feeds it
+# on each tick, so normally nothing has to ask time_table "what time is it?".
+# The cached value also expires after GAME_CLOCK_TTL seconds so that a process
+# that didn't receive the tick (several workers, serverless instances) picks up
+# the latest row from time_table instead of serving a stale hour for long.
+
+TTL_SECONDS = float(os.environ.get("GAME_CLOCK_TTL", "10"))
+
+
+class GameTime(NamedTuple):
+    day: str
+    hour: int
+
+
+_lock = threading.Lock()
+_current: Optional[GameTime] = None
+_loaded_at = 0.0
+
+
+def set_time(day, hour):
+    """ Called after a new tick is recorded in time_table. """
+    global _current, _loaded_at
+    with _lock:
+        _current = GameTime(day, hour)
+        _loaded_at = time.monotonic()
+
+
+def invalidate():
+    """ Forgets the cached time; the next now() reloads it from time_table. """
+    global _current, _loaded_at
+    with _lock:
+        _current = None
+        _loaded_at = 0.0
+
+
+def cached():
+    """ Returns the cached GameTime if it is still fresh, without touching the database. """
+    with _lock:
+        if _current is not None and time.monotonic() - _loaded_at < TTL_SECONDS:
+            return _current
+    return None
+
+
+def now(connection):
+    """
+    Returns the current GameTime, or None if no tick has been recorded yet.
+    Only touches the database (through the given connection) when the cached
+    value is missing or older than TTL_SECONDS.
+    """
+    current = cached()
+    if current is not None:
+        return current
+
+    latest = connection.execute(sqlalchemy.text("""
+        SELECT day, hour FROM time_table WHERE run_id = current_run_id() ORDER BY created_at DESC LIMIT 1;
+    """)).first()
+
+    if latest is None:
+        return None
+
+    set_time(latest.day, latest.hour)
+    return GameTime(latest.day, latest.hour)
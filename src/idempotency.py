@@ -0,0 +1,52 @@
+import json
+import logging
+import sqlalchemy
+
+# The exchange retries a delivery when it doesn't hear back in time, with the
+# same order_id. run_once() makes the retry a lookup: the first request claims
+# (run, endpoint, order_id) in delivery_orders in the same transaction that
+# writes the ledgers, and stores its result there; a later one finds the claim
+# and gets the stored result back without recording anything.
+#
+# Two copies of the same order arriving together are serialized by the primary
+# key: the second INSERT waits for the first transaction, then sees its row if
+# it committed or takes the claim itself if it rolled back.
+
+logger = logging.getLogger(__name__)
+
+
+def run_once(connection, endpoint, order_id, fn, *args, **kwargs):
+    """
+    Runs fn(connection, *args, **kwargs) the first time an order is delivered
+    to endpoint in the current run, and returns (result, replayed). For a
+    repeated order fn isn't called; the first delivery's result comes back
+    with replayed=True.
+    """
+    claimed = connection.execute(sqlalchemy.text("""
+        INSERT INTO delivery_orders (endpoint, order_id)
+        VALUES (:endpoint, :order_id)
+        ON CONFLICT DO NOTHING
+    """), {"endpoint": endpoint, "order_id": order_id}).rowcount
+
+    if not claimed:
+        result = connection.execute(sqlalchemy.text("""
+            SELECT result
+            FROM delivery_orders
+            WHERE run_id = current_run_id() AND endpoint = :endpoint AND order_id = :order_id
+        """), {"endpoint": endpoint, "order_id": order_id}).scalar_one()
+        logger.info("Order %s was already delivered to %s; replaying its result", order_id, endpoint)
+        return result, True
+
+    result = fn(connection, *args, **kwargs)
+
+    # If fn rolled the transaction back, the claim went with it: leave the order unclaimed
+    if not connection.in_transaction():
+        return result, False
+
+    connection.execute(sqlalchemy.text("""
+        UPDATE delivery_orders
+        SET result = CAST(:result AS jsonb)
+        WHERE run_id = current_run_id() AND endpoint = :endpoint AND order_id = :order_id
+    """), {"endpoint": endpoint, "order_id": order_id, "result": json.dumps(result)})
+    return result, False
+
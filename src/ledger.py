@@ -0,0 +1,242 @@
+import sys
+import sqlalchemy
+from src import analytics
+from src import database as db
+from src import shop_state
+
+# Running balances that mirror the ledgers. Every ledger insert goes through the
+# record_* helpers below, which apply the same change to the balance tables on the
+# same connection, so both commit (or roll back) together. Readers then get the
+# current state from a handful of primary-key rows instead of summing the history,
+# or, in the app, from the in-process copy in src/shop_state.py, which the same
+# helpers write through to.
+
+COLORS = ['red', 'green', 'blue', 'dark']
+
+
+def rebuild_balances(connection):
+    """ Recomputes every balance from the current run's ledgers. Only needed for repairs. """
+    # Block ledger writers for the rest of the transaction so nothing lands between the sums
+    connection.execute(sqlalchemy.text(
+        "LOCK TABLE gold_ledger, ml_ledger, potion_ledger, capacity_ledger IN SHARE MODE"))
+
+    clear_balances(connection)
+
+    connection.execute(sqlalchemy.text("""
+        INSERT INTO shop_balance (id, gold, ml_capacity, potion_capacity)
+        SELECT 1,
+               (SELECT COALESCE(SUM(net_change), 0) FROM gold_ledger WHERE run_id = current_run_id()),
+               COALESCE(SUM(ml_capacity), 0),
+               COALESCE(SUM(potion_capacity), 0)
+        FROM capacity_ledger
+        WHERE run_id = current_run_id()
+    """))
+
+    connection.execute(sqlalchemy.text("""
+        INSERT INTO ml_balance (barrel_type, ml)
+        SELECT barrel_type, SUM(net_change)
+        FROM ml_ledger
+        WHERE run_id = current_run_id()
+        GROUP BY barrel_type
+    """))
+
+    # reserved isn't in the ledgers; it's the total of the potion's stock holds (src/reservations.py)
+    connection.execute(sqlalchemy.text("""
+        INSERT INTO potion_balance (potion_id, quantity, reserved)
+        SELECT l.potion_id, SUM(l.quantity),
+               COALESCE((SELECT SUM(h.quantity) FROM stock_holds h
+                         WHERE h.run_id = current_run_id() AND h.potion_id = l.potion_id), 0)
+        FROM potion_ledger l
+        WHERE l.run_id = current_run_id()
+        GROUP BY l.potion_id
+    """))
+
+
+def clear_balances(connection):
+    connection.execute(sqlalchemy.text("DELETE FROM shop_balance;"))
+    connection.execute(sqlalchemy.text("DELETE FROM ml_balance;"))
+    connection.execute(sqlalchemy.text("DELETE FROM potion_balance;"))
+    shop_state.stage_reload(connection)
+
+
+def reconcile(connection):
+    """
+    Compares every balance with the sum of its ledger in the current run.
+    Returns a list of (account, ledger_total, balance) for each account that
+    disagrees, so an empty list means the balances are exact. Runs as one
+    statement so both sides are read from the same snapshot.
+    """
+    return connection.execute(sqlalchemy.text("""
+        WITH expected AS (
+            SELECT 'gold' AS account, COALESCE(SUM(net_change), 0) AS total FROM gold_ledger
+            WHERE run_id = current_run_id()
+            UNION ALL
+            SELECT 'ml_capacity', COALESCE(SUM(ml_capacity), 0) FROM capacity_ledger
+            WHERE run_id = current_run_id()
+            UNION ALL
+            SELECT 'potion_capacity', COALESCE(SUM(potion_capacity), 0) FROM capacity_ledger
+            WHERE run_id = current_run_id()
+            UNION ALL
+            SELECT 'ml:' || barrel_type, SUM(net_change) FROM ml_ledger
+            WHERE run_id = current_run_id() GROUP BY barrel_type
+            UNION ALL
+            SELECT 'potion:' || potion_id, SUM(quantity) FROM potion_ledger
+            WHERE run_id = current_run_id() GROUP BY potion_id
+        ),
+        actual AS (
+            SELECT 'gold' AS account, gold AS total FROM shop_balance
+            UNION ALL
+            SELECT 'ml_capacity', ml_capacity FROM shop_balance
+            UNION ALL
+            SELECT 'potion_capacity', potion_capacity FROM shop_balance
+            UNION ALL
+            SELECT 'ml:' || barrel_type, ml FROM ml_balance
+            UNION ALL
+            SELECT 'potion:' || potion_id, quantity FROM potion_balance
+        )
+        SELECT account, COALESCE(e.total, 0) AS ledger_total, COALESCE(a.total, 0) AS balance
+        FROM expected e
+        FULL OUTER JOIN actual a USING (account)
+        WHERE COALESCE(e.total, 0) <> COALESCE(a.total, 0)
+        ORDER BY account
+    """)).fetchall()
+
+
+# ---------------------------------------------------------------------------
+# Writers. Each takes a list of ledger rows (dicts keyed by column name);
+# day and hour are optional and stored as NULL when missing. The ledger rows
+# go out as one multi-row INSERT (SQLAlchemy's insertmanyvalues, 1000 rows
+# per statement) and the balance changes as one unnest() upsert, so the
+# number of statements doesn't grow with the number of rows.
+# ---------------------------------------------------------------------------
+
+def record_gold(connection, rows):
+    """ Inserts gold_ledger rows and adds their net_change to the gold balance. """
+    if not rows:
+        return
+
+    connection.execute(db.gold_ledger.insert(), [_with_time(row) for row in rows])
+
+    # The daily gold rollup rides along in the balance statement
+    days, day_changes = analytics.daily_gold_changes(rows)
+    connection.execute(sqlalchemy.text("""
+        WITH daily AS (
+            INSERT INTO daily_gold_rollup (real_day, day, gold)
+            SELECT CAST(now() - interval '18 hours' AS date), changes.day, changes.gold
+            FROM unnest(CAST(:days AS text[]), CAST(:day_changes AS bigint[])) AS changes (day, gold)
+            ON CONFLICT (run_id, real_day, day) DO UPDATE SET gold = daily_gold_rollup.gold + EXCLUDED.gold
+        )
+        INSERT INTO shop_balance (id, gold) VALUES (1, :gold)
+        ON CONFLICT (id) DO UPDATE SET gold = shop_balance.gold + EXCLUDED.gold;
+    """), {'gold': sum(row['net_change'] for row in rows), 'days': days, 'day_changes': day_changes})
+    shop_state.stage(connection, gold=sum(row['net_change'] for row in rows))
+
+
+def record_ml(connection, rows):
+    """ Inserts ml_ledger rows and applies their net_change to the per-color balances. """
+    if not rows:
+        return
+
+    connection.execute(db.ml_ledger.insert(), [_with_time(row) for row in rows])
+
+    changes = {}
+    for row in rows:
+        changes[row['barrel_type']] = changes.get(row['barrel_type'], 0) + row['net_change']
+
+    connection.execute(sqlalchemy.text("""
+        INSERT INTO ml_balance (barrel_type, ml)
+        SELECT * FROM unnest(CAST(:barrel_types AS text[]), CAST(:changes AS bigint[]))
+        ON CONFLICT (barrel_type) DO UPDATE SET ml = ml_balance.ml + EXCLUDED.ml;
+    """), {'barrel_types': list(changes), 'changes': list(changes.values())})
+    shop_state.stage(connection, ml=changes)
+
+
+def record_potions(connection, rows):
+    """ Inserts potion_ledger rows and applies their quantity to the per-potion balances. """
+    if not rows:
+        return
+
+    connection.execute(db.potion_ledger.insert(), [_with_time(row) for row in rows])
+
+    changes = {}
+    for row in rows:
+        changes[row['potion_id']] = changes.get(row['potion_id'], 0) + row['quantity']
+
+    connection.execute(sqlalchemy.text("""
+        INSERT INTO potion_balance (potion_id, quantity)
+        SELECT * FROM unnest(CAST(:potion_ids AS integer[]), CAST(:changes AS bigint[]))
+        ON CONFLICT (potion_id) DO UPDATE SET quantity = potion_balance.quantity + EXCLUDED.quantity;
+    """), {'potion_ids': list(changes), 'changes': list(changes.values())})
+    shop_state.stage(connection, potions=changes)
+
+
+def record_capacity(connection, ml_capacity, potion_capacity):
+    """ Inserts a capacity_ledger row and adds it to the capacity balances. """
+    connection.execute(sqlalchemy.text("""
+        INSERT INTO capacity_ledger (ml_capacity, potion_capacity)
+        VALUES (:ml_capacity, :potion_capacity);
+    """), {'ml_capacity': ml_capacity, 'potion_capacity': potion_capacity})
+
+    connection.execute(sqlalchemy.text("""
+        INSERT INTO shop_balance (id, ml_capacity, potion_capacity) VALUES (1, :ml_capacity, :potion_capacity)
+        ON CONFLICT (id) DO UPDATE SET
+            ml_capacity = shop_balance.ml_capacity + EXCLUDED.ml_capacity,
+            potion_capacity = shop_balance.potion_capacity + EXCLUDED.potion_capacity;
+    """), {'ml_capacity': ml_capacity, 'potion_capacity': potion_capacity})
+    shop_state.stage(connection, ml_capacity=ml_capacity, potion_capacity=potion_capacity)
+
+
+def _with_time(row):
+    return {'day': None, 'hour': None, **row}
+
+
+# ---------------------------------------------------------------------------
+# Readers
+# ---------------------------------------------------------------------------
+
+def get_shop_balance(connection):
+    """ Returns (gold, ml_capacity, potion_capacity), all 0 before the first reset. """
+    balance = connection.execute(sqlalchemy.text(
+        "SELECT gold, ml_capacity, potion_capacity FROM shop_balance WHERE id = 1"
+    )).first()
+
+    if balance is None:
+        return 0, 0, 0
+    return tuple(balance)
+
+
+def get_ml(connection):
+    """ Returns {'red': ml, 'green': ml, 'blue': ml, 'dark': ml}. """
+    ml_counts = {color: 0 for color in COLORS}
+    for record in connection.execute(sqlalchemy.text("SELECT barrel_type, ml FROM ml_balance")):
+        ml_counts[record.barrel_type] = record.ml
+    return ml_counts
+
+
+def get_potions(connection):
+    """ Returns {potion_id: quantity} for every potion that has ever been stocked. """
+    return {
+        record.potion_id: record.quantity
+        for record in connection.execute(sqlalchemy.text("SELECT potion_id, quantity FROM potion_balance"))
+    }
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "reconcile"
+
+    if command == "rebuild":
+        with db.engine.begin() as connection:
+            rebuild_balances(connection)
+            analytics.rebuild_rollups(connection)
+        print("Balances and rollups rebuilt from the ledgers.")
+    elif command == "reconcile":
+        with db.engine.begin() as connection:
+            mismatches = reconcile(connection)
+        for account, ledger_total, balance in mismatches:
+            print(f"MISMATCH {account}: ledger says {ledger_total}, balance says {balance}")
+        if mismatches:
+            sys.exit(1)
+        print("All balances match their ledgers.")
+    else:
+        print("usage: python -m src.ledger [rebuild|reconcile]")
+        sys.exit(2)
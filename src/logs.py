@@ -0,0 +1,103 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import dotenv
+
+# Logging for the src.* modules. Each module logs through
+# logging.getLogger(__name__); configure() hangs a QueueHandler off the "src"
+# logger, so a request only pays for putting the record on a queue, and a
+# QueueListener thread does the formatting and the stdout write. Records below
+# a logger's level are dropped before their message is ever formatted.
+#
+#   LOG_LEVEL=INFO                             level of every src.* logger
+#   LOG_LEVELS=src.api.catalog=DEBUG,src.purchasing=WARNING
+#                                              per-module overrides
+#   LOG_FORMAT=json                            one JSON object per line, or "text"
+
+ROOT_LOGGER = "src"
+
+_configure_lock = threading.Lock()
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per record. Fields passed with extra={...} are included as-is. """
+
+    # Attributes every LogRecord has; anything else came in through extra=
+    _STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self._STANDARD and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Merge the message with its args and render any traceback now, while the
+        # arguments still hold what they held when the call was made, but leave
+        # the final formatting (JSON or text) to the listener thread.
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_levels(spec):
+    """ "src.api.catalog=DEBUG,src.purchasing=warning" -> {"src.api.catalog": "DEBUG", ...} """
+    levels = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, level = item.partition("=")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure():
+    """ Sets up the src.* loggers from the environment. Safe to call more than once. """
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            return
+
+        dotenv.load_dotenv()
+        if os.environ.get("LOG_FORMAT", "json").lower() == "text":
+            formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        else:
+            formatter = JsonFormatter()
+
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(formatter)
+
+        records = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(records, stream, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        root = logging.getLogger(ROOT_LOGGER)
+        root.addHandler(_QueueHandler(records))
+        root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+        root.propagate = False
+
+        for name, level in parse_levels(os.environ.get("LOG_LEVELS", "")).items():
+            logging.getLogger(name).setLevel(level)
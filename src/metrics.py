@@ -0,0 +1,183 @@
+import bisect
+import contextvars
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from src import database as db
+
+# Request metrics in the Prometheus text format, served at /metrics. The HTTP
+# middleware times each request and labels it with its route template (so
+# /carts/12/checkout and /carts/13/checkout count as one route), and the
+# engine hooks below add up the SQL statements and database time spent while
+# that request is being handled. The connection pool gauges come from
+# db.pool_stats().
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestStats:
+    """ What the current request has done against the database so far. """
+    __slots__ = ("statements", "db_seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_seconds = 0.0
+
+
+_lock = threading.Lock()
+_requests = {}      # (method, route, status) -> count
+_errors = {}        # (method, route) -> count
+_latency = {}       # (method, route) -> Histogram of seconds
+_statements = {}    # (method, route) -> Histogram of statements per request
+_db_seconds = {}    # (method, route) -> total seconds spent in the database
+_unattributed = RequestStats()  # statements run outside any request (startup, background threads)
+
+_current = contextvars.ContextVar("request_stats", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # One slot per connection, not a stack: a statement that raises never gets to
+    # after_cursor_execute, and its start time is simply overwritten by the next one
+    conn.info["metrics_started"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info.pop("metrics_started")
+    stats = _current.get()
+    if stats is None:
+        with _lock:
+            _unattributed.statements += 1
+            _unattributed.db_seconds += elapsed
+        return
+    stats.statements += 1
+    stats.db_seconds += elapsed
+
+
+async def middleware(request, call_next):
+    stats = RequestStats()
+    token = _current.set(stats)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        elapsed = time.perf_counter() - start
+        _current.reset(token)
+        record(request.method, route_template(request), status, elapsed, stats)
+
+
+_route_paths = {}  # endpoint function -> route path template
+
+
+def route_template(request):
+    """ The path template of the route that handled the request, e.g. /carts/{cart_id}/checkout. """
+    endpoint = request.scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    if endpoint not in _route_paths:
+        for route in request.app.routes:
+            if getattr(route, "endpoint", None) is endpoint:
+                _route_paths[endpoint] = route.path
+                break
+        else:
+            _route_paths[endpoint] = request.url.path
+    return _route_paths[endpoint]
+
+
+def record(method, route, status, seconds, stats):
+    key = (method, route)
+    with _lock:
+        _requests[(method, route, status)] = _requests.get((method, route, status), 0) + 1
+        if status >= 500:
+            _errors[key] = _errors.get(key, 0) + 1
+        _latency.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(seconds)
+        _statements.setdefault(key, Histogram(STATEMENT_BUCKETS)).observe(stats.statements)
+        _db_seconds[key] = _db_seconds.get(key, 0.0) + stats.db_seconds
+
+
+def render():
+    """ Every metric in the Prometheus text exposition format. """
+    lines = []
+    with _lock:
+        lines.append("# HELP http_requests_total Requests handled, by route and status code.")
+        lines.append("# TYPE http_requests_total counter")
+        for (method, route, status), count in sorted(_requests.items()):
+            lines.append(f'http_requests_total{{method="{method}",route="{_escape(route)}",status="{status}"}} {count}')
+
+        lines.append("# HELP http_request_errors_total Requests that failed with a 5xx or an exception.")
+        lines.append("# TYPE http_request_errors_total counter")
+        for (method, route), count in sorted(_errors.items()):
+            lines.append(f'http_request_errors_total{{method="{method}",route="{_escape(route)}"}} {count}')
+
+        _render_histograms(lines, "http_request_duration_seconds", "Request latency.", _latency)
+        _render_histograms(lines, "db_statements_per_request", "SQL statements issued per request.", _statements)
+
+        lines.append("# HELP db_seconds_total Time spent executing SQL statements, by route.")
+        lines.append("# TYPE db_seconds_total counter")
+        for (method, route), seconds in sorted(_db_seconds.items()):
+            lines.append(f'db_seconds_total{{method="{method}",route="{_escape(route)}"}} {seconds:.6f}')
+
+        lines.append("# HELP db_unattributed_statements_total SQL statements issued outside of any request.")
+        lines.append("# TYPE db_unattributed_statements_total counter")
+        lines.append(f"db_unattributed_statements_total {_unattributed.statements}")
+
+    _render_pools(lines)
+
+    return "\n".join(lines) + "\n"
+
+
+def _render_histograms(lines, name, description, histograms):
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} histogram")
+    for (method, route), histogram in sorted(histograms.items()):
+        labels = f'method="{method}",route="{_escape(route)}"'
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+        lines.append(f"{name}_sum{{{labels}}} {histogram.sum:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+
+POOL_METRICS = [
+    ("db_pool_size", "gauge", "size", "Connections the pool keeps open (0 without a pool)."),
+    ("db_pool_checked_out", "gauge", "checked_out", "Connections in use."),
+    ("db_pool_overflow", "gauge", "overflow", "Connections in use beyond the pool size."),
+    ("db_pool_waiting", "gauge", "waiting", "Request transactions waiting for a connection."),
+    ("db_pool_wait_seconds_total", "counter", "wait_seconds", "Time request transactions spent getting a connection."),
+    ("db_pool_timeouts_total", "counter", "timeouts", "Request transactions that gave up waiting for a connection."),
+]
+
+
+def _render_pools(lines):
+    pools = db.pool_stats()
+    for name, kind, key, description in POOL_METRICS:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for engine, stats in sorted(pools.items()):
+            value = f"{stats[key]:.6f}" if isinstance(stats[key], float) else stats[key]
+            lines.append(f'{name}{{engine="{engine}"}} {value}')
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
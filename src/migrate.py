@@ -0,0 +1,127 @@
+import importlib.util
+import logging
+import os
+import sys
+from typing import NamedTuple
+import sqlalchemy
+from src import database as db
+
+# Versioned schema migrations. Each file in migrations/ (at the repo root) is
+# one step, named <version>_<name>.sql or <version>_<name>.py and applied in
+# version order:
+#
+# - .sql files are run as they are.
+# - .py files define upgrade(connection), for steps that need to look at the
+#   database first (which tables are already partitioned, whether pg_trgm is
+#   available).
+#
+# Either way a migration holds its own copy of the SQL and imports nothing
+# from src/, so changing application code can't change what an old migration
+# does to a fresh database.
+#
+# schema_migrations records the versions already applied. Each migration runs in
+# its own transaction together with its schema_migrations row, so a failed one
+# leaves nothing behind and is retried on the next `up`. A transaction-level
+# advisory lock serializes concurrent runs (two deploys starting at once): the
+# second waits, then sees the version as applied and skips it.
+#
+# Migrations are never edited once merged; a change to the schema is a new file.
+#
+#   python -m src.migrate          apply every pending migration
+#   python -m src.migrate status   list migrations and when they were applied
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations")
+
+# pg_advisory_xact_lock key, any constant shared by every run of the migrator
+LOCK_KEY = 7230917
+
+logger = logging.getLogger(__name__)
+
+
+class Migration(NamedTuple):
+    version: str
+    name: str
+    path: str
+
+
+def create_tables(connection):
+    connection.execute(sqlalchemy.text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version text PRIMARY KEY,
+            name text NOT NULL,
+            applied_at timestamp with time zone NOT NULL DEFAULT now()
+        )
+    """))
+
+
+def available(directory=MIGRATIONS_DIR):
+    """ Every migration in directory, in version order. """
+    migrations = []
+    for filename in sorted(os.listdir(directory)):
+        stem, extension = os.path.splitext(filename)
+        if extension not in (".sql", ".py") or "_" not in stem:
+            continue
+        version, name = stem.split("_", 1)
+        migrations.append(Migration(version, name, os.path.join(directory, filename)))
+
+    versions = [migration.version for migration in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError(f"Duplicate migration versions in {directory}: {versions}")
+    return migrations
+
+
+def applied(connection):
+    """ {version: applied_at} for the migrations already applied. """
+    create_tables(connection)
+    return {row.version: row.applied_at for row in connection.execute(sqlalchemy.text(
+        "SELECT version, applied_at FROM schema_migrations"))}
+
+
+def apply(connection, migration):
+    """ Runs one migration on connection, inside the caller's transaction. """
+    if migration.path.endswith(".sql"):
+        with open(migration.path) as file:
+            # Passed to the driver as is, so % and : in the SQL need no escaping
+            connection.exec_driver_sql(file.read())
+    else:
+        spec = importlib.util.spec_from_file_location(f"migrations.m{migration.version}", migration.path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.upgrade(connection)
+
+
+def upgrade(engine=None, directory=MIGRATIONS_DIR):
+    """ Applies every pending migration in order. Returns the ones applied. """
+    engine = engine if engine is not None else db.engine
+    done = []
+    for migration in available(directory):
+        with engine.begin() as connection:
+            connection.execute(sqlalchemy.text("SELECT pg_advisory_xact_lock(:key)"), {"key": LOCK_KEY})
+            if migration.version in applied(connection):
+                continue
+            logger.info("Applying migration %s_%s", migration.version, migration.name)
+            apply(connection, migration)
+            connection.execute(sqlalchemy.text(
+                "INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                {"version": migration.version, "name": migration.name})
+        done.append(migration)
+    return done
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "up"
+
+    if command == "up":
+        migrations = upgrade()
+        for migration in migrations:
+            print(f"applied {migration.version}_{migration.name}")
+        print(f"{len(migrations)} migration(s) applied; the schema is up to date.")
+    elif command == "status":
+        with db.engine.begin() as connection:
+            done = applied(connection)
+        for migration in available():
+            applied_at = done.get(migration.version)
+            print(f"{migration.version}_{migration.name:<30} {applied_at or 'pending'}")
+    else:
+        print("usage: python -m src.migrate [up|status]")
+        sys.exit(2)
@@ -0,0 +1,41 @@
+import sqlalchemy
+
+# What /carts/search/ reads: one row per sold line item, with the customer's
+# name and the line total copied in, so a search is a scan of one table instead
+# of a join of cart_items and carts. The checkout statement (carts.sell_cart)
+# adds the lines it sold through RECORD_LINES_SQL, in the same transaction.
+#
+# Customers search by substring of their name or the sku (ILIKE '%...%'),
+# which a B-tree can't answer. With pg_trgm the name and sku columns get
+# trigram GIN indexes that can (migrations/0012_order_search.py adds them when
+# the extension can be installed); without it search still works, reading the
+# run's lines in sort order.
+# The B-tree indexes match carts.search_sort_keys, so every sort order and
+# keyset page is a range scan.
+#
+# Like the cart tables, order_search is partitioned by run (see src/runs.py).
+
+TRIGRAM_INDEXES = {
+    "order_search_customer_name_trgm_idx": "customer_name",
+    "order_search_item_sku_trgm_idx": "item_sku",
+}
+
+
+def trigram_indexed(connection):
+    """ Whether substring search on name and sku is backed by the trigram indexes. """
+    return connection.execute(sqlalchemy.text("""
+        SELECT COUNT(*) FROM pg_class WHERE relname = ANY(CAST(:names AS text[])) AND relkind IN ('i', 'I')
+    """), {"names": list(TRIGRAM_INDEXES)}).scalar_one() == len(TRIGRAM_INDEXES)
+
+
+# A CTE for the checkout statement in carts.sell_cart: copies the cart's lines
+# for the potions in its `sold` CTE. Uses its :cart_id parameter.
+RECORD_LINES_SQL = """
+    INSERT INTO order_search (line_item_id, cart_id, customer_name, item_sku, line_item_total, created_at)
+    SELECT ci.id, ci.cart_id, c.name, ci.item_sku, ci.quantity * ci.price, ci.created_at
+    FROM sold
+    JOIN cart_items ci ON ci.run_id = current_run_id() AND ci.cart_id = :cart_id AND ci.potion_id = sold.potion_id
+    JOIN carts c ON c.run_id = ci.run_id AND c.id = ci.cart_id
+    ON CONFLICT (run_id, line_item_id) DO NOTHING
+"""
+
@@ -0,0 +1,146 @@
+import logging
+import os
+import select
+import threading
+from typing import NamedTuple
+import dotenv
+import psycopg2
+import sqlalchemy
+from src import database as db
+
+# Process-wide copy of potion_inventory. The recipes, names and prices almost
+# never change, so they are loaded once (on first use, through whatever
+# connection the caller has open) and then looked up by sku, id or recipe
+# vector without a query. refresh() reloads it on demand (POST
+# /admin/potions/refresh), and start_listener() reloads it whenever the
+# potion_inventory trigger (migrations/0009_potion_inventory_trigger.sql)
+# NOTIFYs on CHANNEL.
+
+CHANNEL = "potion_inventory_changed"
+
+logger = logging.getLogger(__name__)
+
+
+class Potion(NamedTuple):
+    id: int
+    sku: str
+    name: str
+    price: int
+    red_ml: int
+    green_ml: int
+    blue_ml: int
+    dark_ml: int
+
+    @property
+    def recipe(self):
+        return (self.red_ml, self.green_ml, self.blue_ml, self.dark_ml)
+
+
+_lock = threading.Lock()
+_potions = None  # every Potion, ordered by id
+_by_sku = {}
+_by_id = {}
+_by_recipe = {}
+
+
+def refresh(connection):
+    """ Reloads the registry from potion_inventory. """
+    global _potions, _by_sku, _by_id, _by_recipe
+    loaded = [Potion(*row) for row in connection.execute(sqlalchemy.text("""
+        SELECT id, sku, name, price, red_ml, green_ml, blue_ml, dark_ml
+        FROM potion_inventory ORDER BY id
+    """))]
+
+    by_recipe = {}
+    for potion in loaded:
+        # Duplicate recipes resolve to the lowest id
+        by_recipe.setdefault(potion.recipe, potion)
+
+    with _lock:
+        _potions = loaded
+        _by_sku = {potion.sku: potion for potion in loaded}
+        _by_id = {potion.id: potion for potion in loaded}
+        _by_recipe = by_recipe
+    return loaded
+
+
+def invalidate():
+    """ Forgets the registry; the next lookup reloads it. """
+    global _potions
+    with _lock:
+        _potions = None
+
+
+def all_potions(connection):
+    """ Every potion, ordered by id. """
+    with _lock:
+        loaded = _potions
+    if loaded is None:
+        loaded = refresh(connection)
+    return loaded
+
+
+def by_sku(connection, sku):
+    all_potions(connection)
+    with _lock:
+        return _by_sku.get(sku)
+
+
+def by_id(connection, potion_id):
+    all_potions(connection)
+    with _lock:
+        return _by_id.get(potion_id)
+
+
+def by_recipe(connection, recipe):
+    """ The potion bottled from [red, green, blue, dark] ml, or None. """
+    all_potions(connection)
+    with _lock:
+        return _by_recipe.get(tuple(recipe))
+
+
+def listener_enabled():
+    """ POTION_REGISTRY_LISTEN=1 starts the change listener along with the app. """
+    dotenv.load_dotenv()
+
+    return os.environ.get("POTION_REGISTRY_LISTEN", "").lower() in ("1", "true", "yes")
+
+
+def start_listener(on_change=None, poll_seconds=30.0):
+    """
+    Starts a daemon thread that LISTENs on CHANNEL and invalidates the registry
+    (then calls on_change) on every notification. The connection is re-opened
+    if it drops; since notifications sent meanwhile are lost, the registry is
+    also invalidated on every reconnect.
+    """
+    thread = threading.Thread(target=_listen, args=(on_change, poll_seconds), name="potion-registry", daemon=True)
+    thread.start()
+    return thread
+
+
+def _listen(on_change, poll_seconds):
+    while True:
+        try:
+            connection = psycopg2.connect(db.database_connection_url())
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANNEL};")
+            _changed(on_change)
+
+            while True:
+                if select.select([connection], [], [], poll_seconds) == ([], [], []):
+                    continue
+                connection.poll()
+                if connection.notifies:
+                    connection.notifies.clear()
+                    _changed(on_change)
+        except psycopg2.Error as e:
+            logger.warning("Potion registry listener lost its connection: %s", e)
+            threading.Event().wait(poll_seconds)
+
+
+def _changed(on_change):
+    invalidate()
+    if on_change is not None:
+        on_change()
+
@@ -0,0 +1,172 @@
+import math
+
+# Wholesale purchase planner. Picks how many of each offered barrel to buy so
+# that we get as much ml as possible for our gold, without buying more of a
+# color than it needs to reach the target mix or more ml than we have room for:
+#
+#     maximize    sum(ml[j] * x[j])                (ties: spend less gold)
+#     subject to  sum(price[j] * x[j]) <= gold
+#                 sum(ml[j] * x[j] for j of color c) <= deficit[c]   for each color
+#                 0 <= x[j] <= quantity[j], x[j] integer
+#
+# This is a bounded knapsack per color. Each color is solved with a min-cost DP
+# over ml (in units of the gcd of the barrel sizes, coarsened so there are at
+# most MAX_CELLS cells in total, which bounds the run time however long the
+# catalog is), then the per-color cost curves are merged under the gold budget.
+
+COLORS = ['red', 'green', 'blue', 'dark']
+
+MAX_CELLS = 800
+
+
+def plan_barrels(offers, ml_counts, gold, ml_capacity, target_mix, max_cells=MAX_CELLS):
+    """
+    offers: the wholesale catalog (anything with sku, ml_per_barrel, potion_type,
+        price and quantity). Barrels that aren't a single pure color are skipped.
+    ml_counts: {'red': ml, 'green': ml, 'blue': ml, 'dark': ml} currently in stock.
+    gold: how much we can spend.
+    ml_capacity: the total ml we are allowed to hold.
+    target_mix: {color: share of ml_capacity}; the shares should add up to at most 1.
+
+    Returns a list of (offer, quantity) with quantity > 0, in catalog order.
+    """
+    deficits = target_deficits(ml_counts, ml_capacity, target_mix)
+
+    by_color = [[] for _ in COLORS]
+    for index, offer in enumerate(offers):
+        color = barrel_color(offer.potion_type)
+        if color is None or offer.ml_per_barrel <= 0 or offer.quantity <= 0 or offer.price < 0:
+            continue
+        if deficits[color] >= offer.ml_per_barrel and offer.price <= gold:
+            by_color[color].append(index)
+
+    sizes = [offers[index].ml_per_barrel for indexes in by_color for index in indexes]
+    if not sizes:
+        return []
+
+    # Exact ml units when they fit in max_cells, otherwise coarser ones. Barrel
+    # weights round up, so a plan never really uses more ml than the DP thinks.
+    unit = math.gcd(*sizes)
+    if sum(deficit // unit for deficit in deficits) > max_cells:
+        unit = math.ceil(sum(deficits) / max_cells)
+
+    curves = []
+    for color in range(len(COLORS)):
+        cells = deficits[color] // unit
+        items = _split_offers(offers, by_color[color], unit, cells)
+        curves.append(_color_curve(items, cells))
+
+    units_per_color = _merge_curves([cost for cost, _ in curves], gold)
+
+    quantities = {}
+    for color, units in enumerate(units_per_color):
+        _, taken = curves[color]
+        for index, count in _backtrack(taken, units):
+            quantities[index] = quantities.get(index, 0) + count
+
+    return [(offers[index], quantities[index]) for index in sorted(quantities)]
+
+
+def target_deficits(ml_counts, ml_capacity, target_mix):
+    """
+    How much ml of each color (in COLORS order) we still want. Each color's
+    target is its share of ml_capacity; if the gaps add up to more room than we
+    have left, they are scaled down together so the mix stays the same.
+    """
+    available = max(0, ml_capacity - sum(ml_counts.values()))
+    deficits = [
+        max(0, math.floor(target_mix.get(color, 0) * ml_capacity) - ml_counts.get(color, 0))
+        for color in COLORS
+    ]
+    wanted = sum(deficits)
+    if wanted > available:
+        deficits = [deficit * available // wanted for deficit in deficits]
+    return deficits
+
+
+def barrel_color(potion_type):
+    """ Index into COLORS of a single-color barrel, or None for mixed/empty ones. """
+    colors = [color for color, share in enumerate(potion_type) if share]
+    if len(colors) != 1 or colors[0] >= len(COLORS):
+        return None
+    return colors[0]
+
+
+def _split_offers(offers, indexes, unit, cells):
+    """
+    Binary-splits each offer's quantity (1, 2, 4, ..., rest) into 0/1 items of
+    (weight in units, price, offer index, count), so a bounded knapsack becomes a
+    0/1 knapsack with O(log quantity) items per offer.
+    """
+    items = []
+    for index in indexes:
+        offer = offers[index]
+        weight = math.ceil(offer.ml_per_barrel / unit)
+        remaining = min(offer.quantity, cells // weight)
+        count = 1
+        while remaining > 0:
+            chunk = min(count, remaining)
+            items.append((weight * chunk, offer.price * chunk, index, chunk))
+            remaining -= chunk
+            count *= 2
+    return items
+
+
+def _color_curve(items, cells):
+    """
+    0/1 knapsack DP: cost[v] is the least gold that buys exactly v units of this
+    color (math.inf if impossible). taken keeps, per item, which v it improved,
+    for the backtrack.
+    """
+    cost = [math.inf] * (cells + 1)
+    cost[0] = 0
+    taken = []
+    for weight, price, index, count in items:
+        improved = bytearray(cells + 1)
+        for v in range(cells, weight - 1, -1):
+            candidate = cost[v - weight] + price
+            if candidate < cost[v]:
+                cost[v] = candidate
+                improved[v] = 1
+        taken.append((weight, index, count, improved))
+    return cost, taken
+
+
+def _backtrack(taken, units):
+    chosen = []
+    for weight, index, count, improved in reversed(taken):
+        if units >= weight and improved[units]:
+            chosen.append((index, count))
+            units -= weight
+    return chosen
+
+
+def _merge_curves(costs, gold):
+    """
+    Min-plus merge of the per-color cost curves: finds how many units to take of
+    each color so the total is as large as possible within gold (least gold on
+    ties). Returns the units per color.
+    """
+    total = [0]
+    choices = []
+    for cost in costs:
+        merged = [math.inf] * (len(total) + len(cost) - 1)
+        choice = [0] * len(merged)
+        for v, spent in enumerate(total):
+            if spent > gold:
+                continue
+            for units, price in enumerate(cost):
+                candidate = spent + price
+                if candidate < merged[v + units]:
+                    merged[v + units] = candidate
+                    choice[v + units] = units
+        total = merged
+        choices.append(choice)
+
+    best = max(v for v, spent in enumerate(total) if spent <= gold)
+
+    units_per_color = [0] * len(costs)
+    for color in range(len(costs) - 1, -1, -1):
+        units_per_color[color] = choices[color][best]
+        best -= units_per_color[color]
+    return units_per_color
@@ -0,0 +1,217 @@
+import logging
+import os
+import threading
+import sqlalchemy
+from src import database as db
+from src import shop_state
+
+# Stock held for carts. Setting a cart's quantity of a potion (carts.set_cart_items)
+# holds that many for RESERVATION_TTL seconds; checkout turns the cart's holds
+# into a sale; holds that expire are handed back by reclaim(). That happens in
+# the requests themselves, since the app may run where nothing runs between
+# requests (Vercel): hold() and checkout first reclaim the expired holds on the
+# potions they lock, and every new tick (POST /info/current_time) reclaims the
+# rest, so the catalog lists them again. Where the app does keep running, a
+# background thread can also sweep every RESERVATION_RECLAIM_SECONDS.
+#
+# Every hold is a stock_holds row, and potion_balance.reserved is the sum of the
+# holds on each potion. Holding and selling both update the potion's
+# potion_balance row with a condition on what's still free (quantity -
+# reserved), so they're serialized by that row's lock and can't promise or sell
+# the same potion twice. The catalog only lists what's free.
+#
+# hold(), checkout (release() then the sale) and reclaim() all lock the
+# potion_balance rows before they touch stock_holds, and take more than one
+# of them in potion_id order (lock_stock()). That keeps the three from
+# waiting on each other in opposite orders; anything else that locks these
+# rows, such as a bottling delivery, can still deadlock with them, and
+# Postgres then aborts one of the transactions.
+#
+# An expired hold still counts until reclaim() removes it. A cart that checks
+# out after its hold ran out gets its potions if they're still free: checkout
+# reclaims and sells under the same row locks, so nobody can take the stock
+# in between. Neither a hold nor reserved can go negative (migration 0015),
+# so a reserved total that has drifted from the holds fails the statement
+# instead of freeing stock other carts hold. `python -m src.ledger rebuild`
+# sets reserved from the holds.
+
+TTL_SECONDS = float(os.environ.get("RESERVATION_TTL", "600"))
+RECLAIM_SECONDS = float(os.environ.get("RESERVATION_RECLAIM_SECONDS", "0"))
+
+logger = logging.getLogger(__name__)
+
+_stop = threading.Event()  # set by stop_reclaimer()
+
+
+def hold(connection, cart_id, quantities, ttl=None):
+    """
+    Sets the cart's holds to quantities ({potion_id: quantity}), renewing them
+    for ttl seconds (TTL_SECONDS by default). Raising a hold takes from the free
+    stock. Returns {potion_id: free quantity} for the potions that didn't have
+    enough free to raise their hold. The caller should then roll back: the
+    other holds in quantities have already been set.
+    """
+    if not quantities:
+        return {}
+    reclaim(connection, lock_stock(connection, list(quantities)))
+
+    rows = connection.execute(sqlalchemy.text("""
+        WITH wanted AS (
+            SELECT * FROM unnest(CAST(:potion_ids AS integer[]), CAST(:quantities AS bigint[]))
+                AS wanted(potion_id, quantity)
+        ),
+        changes AS (
+            SELECT wanted.potion_id, wanted.quantity, wanted.quantity - COALESCE(h.quantity, 0) AS change
+            FROM wanted
+            LEFT JOIN stock_holds h
+                ON h.run_id = current_run_id() AND h.cart_id = :cart_id AND h.potion_id = wanted.potion_id
+        ),
+        reserved AS (
+            UPDATE potion_balance pb
+            SET reserved = pb.reserved + changes.change
+            FROM changes
+            WHERE pb.potion_id = changes.potion_id
+              AND (changes.change <= 0 OR pb.quantity - pb.reserved >= changes.change)
+            RETURNING changes.potion_id, changes.quantity, changes.change
+        ),
+        held AS (
+            INSERT INTO stock_holds (cart_id, potion_id, quantity, expires_at)
+            SELECT :cart_id, potion_id, quantity, now() + make_interval(secs => CAST(:ttl AS double precision))
+            FROM reserved
+            ON CONFLICT (run_id, cart_id, potion_id) DO UPDATE SET
+                quantity = EXCLUDED.quantity,
+                expires_at = EXCLUDED.expires_at
+        )
+        SELECT changes.potion_id, changes.change,
+               reserved.potion_id IS NOT NULL OR changes.change <= 0 AS held,
+               (SELECT GREATEST(pb.quantity - pb.reserved, 0) FROM potion_balance pb
+                WHERE pb.potion_id = changes.potion_id) AS free
+        FROM changes
+        LEFT JOIN reserved ON reserved.potion_id = changes.potion_id
+    """), {
+        "cart_id": cart_id,
+        "potion_ids": list(quantities),
+        "quantities": list(quantities.values()),
+        "ttl": float(TTL_SECONDS if ttl is None else ttl),
+    }).fetchall()
+
+    shop_state.stage(connection, reserved={row.potion_id: row.change for row in rows if row.held and row.change})
+    return {row.potion_id: row.free or 0 for row in rows if not row.held}
+
+
+def lock_stock(connection, potion_ids=None, cart_id=None):
+    """
+    Locks the balance rows of potion_ids, or of every potion in the cart, in
+    potion_id order, and returns the ids locked. A statement that updates
+    several balances locks them in whatever order its plan reads them, so two
+    of them with potions in common can deadlock; taking the locks in one order
+    first makes them queue instead.
+    """
+    return connection.execute(sqlalchemy.text("""
+        SELECT potion_id
+        FROM potion_balance
+        WHERE potion_id = ANY(CAST(:potion_ids AS integer[]))
+           OR potion_id IN (SELECT potion_id FROM cart_items
+                            WHERE run_id = current_run_id() AND cart_id = :cart_id)
+        ORDER BY potion_id
+        FOR UPDATE
+    """), {"potion_ids": potion_ids or [], "cart_id": cart_id}).scalars().all()
+
+
+def release(connection, cart_id):
+    """ Drops every hold the cart has, giving the stock back. Returns {potion_id: quantity released}. """
+    released = {row.potion_id: row.quantity for row in connection.execute(sqlalchemy.text("""
+        WITH released AS (
+            DELETE FROM stock_holds
+            WHERE run_id = current_run_id() AND cart_id = :cart_id
+            RETURNING potion_id, quantity
+        )
+        UPDATE potion_balance pb
+        SET reserved = pb.reserved - released.quantity
+        FROM released
+        WHERE pb.potion_id = released.potion_id
+        RETURNING pb.potion_id, released.quantity
+    """), {"cart_id": cart_id})}
+
+    shop_state.stage(connection, reserved={potion_id: -quantity for potion_id, quantity in released.items()})
+    return released
+
+
+def reclaim(connection, potion_ids=None):
+    """
+    Hands back the stock of every expired hold, or only of those on potion_ids,
+    whose balance rows the caller has locked (lock_stock()). Returns
+    {potion_id: quantity reclaimed}.
+    """
+    if potion_ids is None:
+        potion_ids = connection.execute(sqlalchemy.text("""
+            SELECT DISTINCT potion_id FROM stock_holds WHERE run_id = current_run_id() AND expires_at < now()
+        """)).scalars().all()
+        if not potion_ids:
+            return {}
+        # Balances before holds, like checkout; holds on other potions that expire meanwhile wait for the next round
+        lock_stock(connection, potion_ids)
+    elif not potion_ids:
+        return {}
+
+    reclaimed = {row.potion_id: row.quantity for row in connection.execute(sqlalchemy.text("""
+        WITH expired AS (
+            DELETE FROM stock_holds
+            WHERE run_id = current_run_id() AND expires_at < now()
+              AND potion_id = ANY(CAST(:potion_ids AS integer[]))
+            RETURNING potion_id, quantity
+        ),
+        totals AS (
+            SELECT potion_id, SUM(quantity) AS quantity FROM expired GROUP BY potion_id
+        )
+        UPDATE potion_balance pb
+        SET reserved = pb.reserved - totals.quantity
+        FROM totals
+        WHERE pb.potion_id = totals.potion_id
+        RETURNING pb.potion_id, totals.quantity
+    """), {"potion_ids": potion_ids})}
+
+    shop_state.stage(connection, reserved={potion_id: -quantity for potion_id, quantity in reclaimed.items()})
+    return reclaimed
+
+
+def clear(connection):
+    """ Drops every hold. For a reset, which starts the balances over anyway. """
+    connection.execute(sqlalchemy.text("DELETE FROM stock_holds"))
+
+
+def start_reclaimer(on_reclaim=None, interval=None):
+    """
+    Starts a daemon thread that runs reclaim() every interval seconds
+    (RECLAIM_SECONDS by default) and calls on_reclaim after it gave anything
+    back, until stop_reclaimer(). An interval of 0 or less doesn't start it.
+    """
+    interval = RECLAIM_SECONDS if interval is None else interval
+    if interval <= 0:
+        return None
+    _stop.clear()
+    thread = threading.Thread(target=_reclaim_forever, args=(on_reclaim, interval), name="stock-reclaimer",
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def stop_reclaimer():
+    """ Stops the thread start_reclaimer() started, after its current round. """
+    _stop.set()
+
+
+def _reclaim_forever(on_reclaim, interval):
+    while not _stop.wait(interval):
+        try:
+            with db.engine.connect() as connection:
+                with connection.begin():
+                    reclaimed = reclaim(connection)
+                shop_state.publish(connection)
+            if reclaimed:
+                logger.info("Reclaimed expired holds: %s", reclaimed)
+                if on_reclaim is not None:
+                    on_reclaim()
+        except Exception:
+            logger.exception("Reclaiming expired stock holds failed")
+
@@ -0,0 +1,101 @@
+import sys
+import sqlalchemy
+from src import database as db
+
+# Every game run (everything between two /admin/reset calls) gets a row in
+# `runs`, and the ledgers, carts, cart_items, time_table and order_search are
+# partitioned by LIST (run_id), one partition per run. New rows pick up the
+# current run from their run_id default (current_run_id(), the newest run), and
+# queries filter on run_id = current_run_id() so Postgres only opens the
+# current partition.
+#
+# A reset is then just a new runs row plus empty partitions for it, no matter
+# how much history there is. Earlier runs stay in place and can be queried by
+# run_id, until `python -m src.runs prune` detaches (and by default drops)
+# the partitions of all but the newest few runs. The runs table, current_run_id()
+# and the partitioning itself are set up by migrations/0002_runs.py.
+
+RUN_TABLES = ['gold_ledger', 'ml_ledger', 'potion_ledger', 'capacity_ledger', 'carts', 'cart_items', 'time_table',
+              'order_search']
+
+
+def current_run(connection):
+    return connection.execute(sqlalchemy.text("SELECT current_run_id()")).scalar_one()
+
+
+def start_run(connection):
+    """
+    Starts a new run and creates its partitions. Returns the new run id. Rows
+    written later in the same transaction already land in the new run; every
+    other transaction switches over when this one commits.
+    """
+    # One reset at a time, so two resets can't both think they created the newest run
+    connection.execute(sqlalchemy.text("LOCK TABLE runs IN SHARE ROW EXCLUSIVE MODE"))
+    run_id = connection.execute(sqlalchemy.text(
+        "INSERT INTO runs DEFAULT VALUES RETURNING id")).scalar_one()
+
+    for table in RUN_TABLES:
+        connection.execute(sqlalchemy.text(f"""
+            CREATE TABLE IF NOT EXISTS {table}_run_{run_id} PARTITION OF {table} FOR VALUES IN ({run_id})
+        """))
+    return run_id
+
+
+def list_runs(connection):
+    """ (run id, start time, partitions still attached) for every run, oldest first. """
+    return connection.execute(sqlalchemy.text("""
+        SELECT r.id, r.started_at, (
+            SELECT COUNT(*)
+            FROM pg_inherits i
+            JOIN pg_class child ON child.oid = i.inhrelid
+            JOIN pg_class parent ON parent.oid = i.inhparent
+            WHERE CAST(parent.relname AS text) = ANY(CAST(:parents AS text[]))
+              AND child.relname = parent.relname || '_run_' || r.id
+        ) AS partitions
+        FROM runs r
+        ORDER BY r.id
+    """), {"parents": RUN_TABLES}).fetchall()
+
+
+def prune(connection, keep, drop=True):
+    """
+    Detaches the partitions of every run except the newest `keep`, and drops
+    them unless drop is False (then they are left as standalone tables named
+    <table>_run_<id>, e.g. to archive them). Returns the pruned run ids.
+    """
+    newest = current_run(connection)
+    pruned = []
+    for run_id in connection.execute(sqlalchemy.text(
+            "SELECT id FROM runs WHERE id <= :last ORDER BY id"), {"last": newest - keep}).scalars().all():
+        found = False
+        for table in RUN_TABLES:
+            partition = f"{table}_run_{run_id}"
+            attached = connection.execute(sqlalchemy.text("""
+                SELECT 1 FROM pg_inherits
+                WHERE inhrelid = to_regclass(:partition) AND inhparent = to_regclass(:table)
+            """), {"partition": partition, "table": table}).first() is not None
+            if not attached:
+                continue
+            found = True
+            connection.execute(sqlalchemy.text(f"ALTER TABLE {table} DETACH PARTITION {partition}"))
+            if drop:
+                connection.execute(sqlalchemy.text(f"DROP TABLE {partition}"))
+        if found:
+            pruned.append(run_id)
+    return pruned
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "list"
+
+    if command == "list":
+        with db.engine.begin() as connection:
+            for run_id, started_at, partitions in list_runs(connection):
+                print(f"run {run_id}  started {started_at:%Y-%m-%d %H:%M:%S}  {partitions} partitions")
+    elif command in ("prune", "detach") and len(sys.argv) == 3:
+        with db.engine.begin() as connection:
+            pruned = prune(connection, int(sys.argv[2]), drop=command == "prune")
+        print(f"{'Dropped' if command == 'prune' else 'Detached'} the partitions of runs {pruned}.")
+    else:
+        print("usage: python -m src.runs [list|prune <runs to keep>|detach <runs to keep>]")
+        sys.exit(2)
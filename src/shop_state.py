@@ -0,0 +1,208 @@
+import logging
+import os
+import threading
+import time
+from array import array
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# The shop's current gold, capacities, ml per color and stock per potion, kept
+# in this process so the planners, the catalog and the audit read it without a
+# query. It mirrors the balance tables (see src/ledger.py):
+#
+# - Loaded from them in one statement on first use.
+# - Written through: whatever changes a balance (the ledger.record_* helpers,
+#   the checkout statement and the stock holds in src/reservations.py) also
+#   calls stage() with the same change. The change is applied here by
+#   publish() once the transaction has committed (db.run_in_transaction calls
+#   it), and dropped if the transaction rolls back or its commit fails. Code
+#   that rewrites the balances wholesale (clear or rebuild) stages a reload.
+# - Reconciled every SHOP_STATE_TTL seconds: the next read reloads from the
+#   balance tables, which picks up other workers' writes, and logs when this
+#   process's copy had drifted.
+#
+# Only reads use it. Checkout still checks and takes stock in the database,
+# under row locks, so a stale copy can't oversell.
+
+TTL_SECONDS = float(os.environ.get("SHOP_STATE_TTL", "30"))
+
+COLORS = ['red', 'green', 'blue', 'dark']
+
+logger = logging.getLogger(__name__)
+
+
+class ShopState:
+    """
+    Gold, capacities, ml per color (in COLORS order), and stock and the part of
+    it held for carts per potion (indexed by potion id, see src/reservations.py).
+    """
+    __slots__ = ("gold", "ml_capacity", "potion_capacity", "ml", "potions", "reserved")
+
+    def __init__(self, gold=0, ml_capacity=0, potion_capacity=0, ml=None, potions=None, reserved=None):
+        self.gold = gold
+        self.ml_capacity = ml_capacity
+        self.potion_capacity = potion_capacity
+        self.ml = array('q', ml if ml is not None else [0] * len(COLORS))
+        self.potions = array('q', potions if potions is not None else [])
+        self.reserved = array('q', reserved if reserved is not None else [])
+
+    def copy(self):
+        return ShopState(self.gold, self.ml_capacity, self.potion_capacity, self.ml, self.potions, self.reserved)
+
+    def potion(self, potion_id):
+        return self.potions[potion_id] if 0 <= potion_id < len(self.potions) else 0
+
+    def available(self, potion_id):
+        """ Stock not held for a cart. """
+        held = self.reserved[potion_id] if 0 <= potion_id < len(self.reserved) else 0
+        return max(self.potion(potion_id) - held, 0)
+
+    def ml_counts(self):
+        """ {'red': ml, 'green': ml, 'blue': ml, 'dark': ml} """
+        return dict(zip(COLORS, self.ml))
+
+    def potion_quantities(self):
+        """ {potion_id: quantity} for every potion with a nonzero balance. """
+        return {potion_id: quantity for potion_id, quantity in enumerate(self.potions) if quantity}
+
+    def reserved_quantities(self):
+        """ {potion_id: quantity held} for every potion with holds. """
+        return {potion_id: quantity for potion_id, quantity in enumerate(self.reserved) if quantity}
+
+    def apply(self, gold=0, ml_capacity=0, potion_capacity=0, ml=None, potions=None, reserved=None):
+        self.gold += gold
+        self.ml_capacity += ml_capacity
+        self.potion_capacity += potion_capacity
+        for color, change in (ml or {}).items():
+            self.ml[COLORS.index(color)] += change
+        for potion_id, change in (potions or {}).items():
+            if potion_id >= len(self.potions):
+                self.potions.extend([0] * (potion_id + 1 - len(self.potions)))
+            self.potions[potion_id] += change
+        for potion_id, change in (reserved or {}).items():
+            if potion_id >= len(self.reserved):
+                self.reserved.extend([0] * (potion_id + 1 - len(self.reserved)))
+            self.reserved[potion_id] += change
+
+    def __eq__(self, other):
+        return (isinstance(other, ShopState)
+                and (self.gold, self.ml_capacity, self.potion_capacity, self.ml) ==
+                    (other.gold, other.ml_capacity, other.potion_capacity, other.ml)
+                and self.potion_quantities() == other.potion_quantities()
+                and self.reserved_quantities() == other.reserved_quantities())
+
+    def __repr__(self):
+        return (f"ShopState(gold={self.gold}, ml_capacity={self.ml_capacity}, "
+                f"potion_capacity={self.potion_capacity}, ml={self.ml_counts()}, "
+                f"potions={self.potion_quantities()}, reserved={self.reserved_quantities()})")
+
+
+_lock = threading.Lock()
+_state = None
+_loaded_at = 0.0
+_version = 0  # bumped by every change applied, so a load that raced one isn't kept
+
+_PENDING = "shop_state_pending"
+_RELOAD = object()
+
+
+def load(connection):
+    """ Reads the balance tables into a new ShopState. """
+    state = ShopState()
+    for row in connection.execute(sqlalchemy.text("""
+        SELECT 'shop' AS kind, NULL AS key, gold AS amount, ml_capacity, potion_capacity, CAST(NULL AS bigint) AS reserved
+        FROM shop_balance
+        UNION ALL
+        SELECT 'ml', barrel_type, ml, NULL, NULL, NULL FROM ml_balance
+        UNION ALL
+        SELECT 'potion', CAST(potion_id AS text), quantity, NULL, NULL, reserved FROM potion_balance
+    """)):
+        if row.kind == 'shop':
+            state.apply(gold=row.amount, ml_capacity=row.ml_capacity, potion_capacity=row.potion_capacity)
+        elif row.kind == 'ml' and row.key in COLORS:
+            state.apply(ml={row.key: row.amount})
+        elif row.kind == 'potion':
+            state.apply(potions={int(row.key): row.amount}, reserved={int(row.key): row.reserved})
+    return state
+
+
+def get(connection):
+    """
+    A snapshot of the shop state. Only queries (through the given connection)
+    on first use and every TTL_SECONDS after that.
+    """
+    global _state, _loaded_at
+    with _lock:
+        if _state is not None and time.monotonic() - _loaded_at < TTL_SECONDS:
+            return _state.copy()
+        previous = _state
+        version = _version
+
+    state = load(connection)
+
+    with _lock:
+        if previous is not None and _version == version and previous != state:
+            logger.info("Shop state differed from the balance tables: had %s, the tables say %s", previous, state)
+        # Keep it only if nothing was applied meanwhile; otherwise the next read loads again
+        if _version == version:
+            _state = state
+            _loaded_at = time.monotonic()
+    return state.copy()
+
+
+def invalidate():
+    """ Drops this process's copy; the next read reloads it. """
+    global _state
+    with _lock:
+        _state = None
+
+
+def stage(connection, gold=0, ml_capacity=0, potion_capacity=0, ml=None, potions=None, reserved=None):
+    """
+    Records a change the current transaction is making to the balances
+    (ml: {color: change}, potions and reserved: {potion_id: change}). It
+    reaches the shared copy when publish() is called after the commit.
+    """
+    connection.info.setdefault(_PENDING, []).append(
+        {"gold": gold, "ml_capacity": ml_capacity, "potion_capacity": potion_capacity, "ml": ml, "potions": potions,
+         "reserved": reserved})
+
+
+def stage_reload(connection):
+    """ The current transaction rewrites the balances wholesale: reload them after it commits. """
+    connection.info.setdefault(_PENDING, []).append(_RELOAD)
+
+
+@event.listens_for(Engine, "begin")
+def _begin(conn):
+    conn.info.pop(_PENDING, None)
+
+
+@event.listens_for(Engine, "rollback")
+def _rollback(conn):
+    conn.info.pop(_PENDING, None)
+
+
+def publish(connection):
+    """
+    Applies the changes staged on connection to the shared copy. Call once its
+    transaction has committed. (The Engine "commit" event fires before the
+    database commits, so changes applied there would stay applied if the
+    commit then failed.) Changes a transaction staged but never published are
+    dropped when the connection begins its next one.
+    """
+    global _state, _version
+    changes = connection.info.pop(_PENDING, None)
+    if not changes:
+        return
+
+    with _lock:
+        _version += 1
+        for change in changes:
+            if _state is None:
+                break
+            if change is _RELOAD:
+                _state = None
+            else:
+                _state.apply(**change)
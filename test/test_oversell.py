@@ -0,0 +1,206 @@
+"""
+Oversell checks: many threads filling carts and checking out the same few
+potions at once, against a small stock.
+
+Each cart asks for 1-3 of one or two of the stocked potions: it is created,
+filled through carts.set_cart_items (which holds the stock, or turns the cart
+away with a 409 when there isn't enough free) and checked out through
+carts.sell_cart, each step in its own transaction like the endpoints run
+them, THREADS carts at a time.
+
+Skipped unless POSTGRES_URI is set. Each test starts a new run
+(admin.reset_ledgers), so point it at a scratch database.
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import sqlalchemy
+from fastapi import HTTPException
+from bench.deliveries import bench_recipes
+from src import database as db
+from src import ledger
+from src import migrate
+from src import potions
+from src import reservations
+from src import shop_state
+from src.api import admin
+from src.api import carts
+
+if not db.database_connection_url():
+    pytest.skip("POSTGRES_URI isn't set", allow_module_level=True)
+
+THREADS = 16
+CARTS = 300
+STOCK = 50
+POTIONS = 3
+TTL = 1.0
+
+
+class Outcome:
+    __slots__ = ("accepted", "turned_away", "short", "errors", "sold")
+
+    def __init__(self):
+        self.accepted = 0
+        self.turned_away = 0
+        self.short = 0      # accepted carts that didn't get everything at checkout
+        self.errors = []
+        self.sold = {}
+
+
+@pytest.fixture
+def stocked():
+    """ Starts a new run with STOCK of each of POTIONS bench potions and returns those potions. """
+    migrate.upgrade()
+    vectors = bench_recipes(POTIONS)
+    with db.engine.begin() as connection:
+        admin.reset_ledgers(connection)
+        connection.execute(sqlalchemy.text("INSERT INTO time_table (day, hour) VALUES ('Hearthday', 12)"))
+        potions.refresh(connection)
+        stocked = [potions.by_recipe(connection, vector) for vector in vectors]
+        ledger.record_potions(connection, [{
+            'potion_id': potion.id, 'quantity': STOCK, 'function': 'bench', 'transaction': 'oversell stock', 'cost': 0
+        } for potion in stocked])
+    return stocked
+
+
+def shop(outcome, lock, stocked, seed):
+    """ One customer: create a cart, set its items, check out. """
+    rng = random.Random(seed)
+    wanted = {potion.sku: rng.randint(1, 3) for potion in rng.sample(stocked, rng.randint(1, min(2, len(stocked))))}
+    try:
+        with db.engine.begin() as connection:
+            cart_id = carts.insert_cart(connection, carts.Customer(
+                customer_name=f"oversell-{seed}", character_class="Rogue", level=1))
+        try:
+            with db.engine.begin() as connection:
+                carts.set_cart_items(connection, cart_id, list(wanted.items()))
+        except HTTPException as e:
+            if e.status_code != 409:
+                raise
+            with lock:
+                outcome.turned_away += 1
+            return
+
+        with db.engine.begin() as connection:
+            result = carts.sell_cart(connection, cart_id)
+        with lock:
+            outcome.accepted += 1
+            if result.potions_bought != sum(wanted.values()):
+                outcome.short += 1
+            for sku, quantity in wanted.items():
+                outcome.sold[sku] = outcome.sold.get(sku, 0) + quantity
+    except Exception as e:
+        with lock:
+            outcome.errors.append(f"{type(e).__name__}: {e}")
+
+
+def balance_problems(stocked):
+    """ Problems with the stocked potions' balances, ledgers and holds. """
+    problems = []
+    with db.engine.begin() as connection:
+        for row in connection.execute(sqlalchemy.text("""
+            SELECT pb.potion_id, pb.quantity, pb.reserved,
+                   (SELECT COALESCE(SUM(quantity), 0) FROM potion_ledger pl
+                    WHERE pl.run_id = current_run_id() AND pl.potion_id = pb.potion_id) AS ledger_total,
+                   (SELECT COALESCE(SUM(quantity), 0) FROM stock_holds h
+                    WHERE h.run_id = current_run_id() AND h.potion_id = pb.potion_id) AS held
+            FROM potion_balance pb
+            WHERE pb.potion_id = ANY(CAST(:potion_ids AS integer[]))
+        """), {"potion_ids": [potion.id for potion in stocked]}):
+            if row.quantity < 0:
+                problems.append(f"potion {row.potion_id} oversold: balance {row.quantity}")
+            if row.quantity != row.ledger_total:
+                problems.append(f"potion {row.potion_id}: balance {row.quantity} but ledger {row.ledger_total}")
+            if row.reserved != row.held:
+                problems.append(f"potion {row.potion_id}: {row.reserved} reserved but {row.held} held")
+            if row.quantity > STOCK:
+                problems.append(f"potion {row.potion_id}: balance {row.quantity} above the {STOCK} stocked")
+    return problems
+
+
+def available(stocked):
+    with db.engine.begin() as connection:
+        state = shop_state.load(connection)
+    return {potion.id: state.available(potion.id) for potion in stocked}
+
+
+def test_concurrent_checkouts_never_oversell(stocked):
+    outcome = Outcome()
+    lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        for seed in range(CARTS):
+            pool.submit(shop, outcome, lock, stocked, seed)
+
+    assert outcome.errors == []
+    assert outcome.short == 0, "accepted carts came up short at checkout"
+    # Enough carts for the stock to run out, and none sold past it
+    assert outcome.turned_away > 0
+    assert all(outcome.sold.get(potion.sku, 0) <= STOCK for potion in stocked), outcome.sold
+    assert balance_problems(stocked) == []
+
+
+def test_expired_holds_are_reclaimed(stocked):
+    free = available(stocked)
+    with db.engine.begin() as connection:
+        cart_id = carts.insert_cart(connection, carts.Customer(
+            customer_name="oversell-abandoned", character_class="Rogue", level=1))
+        assert reservations.hold(connection, cart_id, free, ttl=TTL) == {}
+
+    assert available(stocked) == {potion.id: 0 for potion in stocked}
+    with db.engine.begin() as connection:
+        assert reservations.reclaim(connection) == {}, "reclaimed holds before they expired"
+
+    time.sleep(TTL + 0.1)
+    with db.engine.begin() as connection:
+        assert reservations.reclaim(connection) == free
+    assert available(stocked) == free
+    assert balance_problems(stocked) == []
+
+
+def test_expired_holds_dont_block_other_carts(stocked):
+    free = available(stocked)
+    with db.engine.begin() as connection:
+        abandoned = carts.insert_cart(connection, carts.Customer(
+            customer_name="oversell-abandoned", character_class="Rogue", level=1))
+        buyer = carts.insert_cart(connection, carts.Customer(
+            customer_name="oversell-buyer", character_class="Rogue", level=1))
+        assert reservations.hold(connection, abandoned, free, ttl=TTL) == {}
+
+    # Nothing sweeps the holds here; the next cart's own requests hand them back
+    time.sleep(TTL + 0.1)
+    with db.engine.begin() as connection:
+        carts.set_cart_items(connection, buyer, [(potion.sku, STOCK) for potion in stocked])
+    with db.engine.begin() as connection:
+        result = carts.sell_cart(connection, buyer)
+    assert result.potions_bought == STOCK * len(stocked)
+    assert available(stocked) == {potion.id: 0 for potion in stocked}
+    assert balance_problems(stocked) == []
+
+
+def test_reclaimer_survives_errors_and_stops(stocked):
+    free = available(stocked)
+    rounds = []
+
+    def on_reclaim():
+        rounds.append(True)
+        raise RuntimeError("on_reclaim failed")
+
+    thread = reservations.start_reclaimer(on_reclaim=on_reclaim, interval=TTL / 10)
+    try:
+        for attempt in range(2):
+            with db.engine.begin() as connection:
+                cart_id = carts.insert_cart(connection, carts.Customer(
+                    customer_name=f"oversell-abandoned-{attempt}", character_class="Rogue", level=1))
+                assert reservations.hold(connection, cart_id, free, ttl=TTL) == {}
+            time.sleep(TTL + 0.5)
+            assert available(stocked) == free, f"holds weren't reclaimed on attempt {attempt}"
+    finally:
+        reservations.stop_reclaimer()
+        thread.join(timeout=5)
+
+    assert len(rounds) == 2
+    assert not thread.is_alive()
+    assert balance_problems(stocked) == []
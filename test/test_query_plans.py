@@ -0,0 +1,299 @@
+"""
+Query plan checks: every endpoint is called once against a seeded database and
+each statement it sends is EXPLAINed; a plan that reads a large table with a
+sequential scan fails its endpoint's test.
+
+The module migrates the schema (src/migrate.py), starts a new run with POST
+/admin/reset, adds RECIPES bench recipes (bench.deliveries.bench_recipes) and
+fills that run's carts, cart_items, ledgers and time_table with EXPLAIN_ROWS
+rows each (generate_series, so it takes seconds), then ANALYZEs. Each endpoint is called in-process, with the in-process caches
+(game clock, shop state, potion registry, forecast, catalog) emptied first so
+the queries behind them run too. Every SELECT, INSERT, UPDATE, DELETE or WITH
+it sent is EXPLAINed (without ANALYZE, so nothing runs twice) with the same
+parameters, and any Seq Scan of a table Postgres estimates at
+EXPLAIN_MIN_ROWS rows or more is a failure. Endpoints that read all of a run
+by design (FULL_SCANS) only have to succeed, and so do the substring searches
+when the server has no pg_trgm.
+
+Skipped unless POSTGRES_URI is set. Writes to the database, so point it at a
+scratch one.
+"""
+import asyncio
+import json
+import os
+
+import httpx
+import pytest
+import sqlalchemy
+from bench.deliveries import bench_recipes
+from src import database as db
+from src import forecast
+from src import game_clock
+from src import ledger
+from src import migrate
+from src import order_search
+from src import potions
+from src import shop_state
+from src.api import catalog
+
+if not db.database_connection_url():
+    pytest.skip("POSTGRES_URI isn't set", allow_module_level=True)
+
+ROWS = int(os.environ.get("EXPLAIN_ROWS", "50000"))
+MIN_ROWS = int(os.environ.get("EXPLAIN_MIN_ROWS", "10000"))
+RECIPES = 8
+
+EXPLAINED = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+# Sums every ledger row of the run to check the balances, so it reads them all
+FULL_SCANS = {"GET /admin/reconcile"}
+
+# Substring filters, which only an index when pg_trgm is installed can answer
+SUBSTRING_SEARCHES = {
+    "GET /carts/search/ customer_name filter": "customer_name=tomer-1234&sort_col=timestamp",
+    "GET /carts/search/ potion_sku filter": "potion_sku=green&sort_col=customer_name&sort_order=asc",
+    "GET /carts/search/ both filters": "customer_name=99&potion_sku=red&sort_col=line_item_total",
+}
+
+
+def seed(rows, potion_ids):
+    """ Fills the current run's tables with `rows` rows each, spread over potion_ids, then ANALYZEs. """
+    with db.engine.begin() as connection:
+        connection.execute(sqlalchemy.text("""
+            INSERT INTO time_table (day, hour, created_at)
+            SELECT (ARRAY['Hearthday', 'Crownday', 'Blesseday', 'Soulday', 'Edgeday', 'Bloomday', 'Arcanaday'])[1 + n % 7],
+                   (n * 2) % 24, now() - make_interval(secs => :rows - n)
+            FROM generate_series(1, :rows) AS n
+        """), {"rows": rows})
+        connection.execute(sqlalchemy.text("""
+            INSERT INTO carts (name, class, level, created_at)
+            SELECT 'customer-' || n, 'Warrior', 1 + n % 20, now() - make_interval(secs => :rows - n)
+            FROM generate_series(1, :rows) AS n
+        """), {"rows": rows})
+        connection.execute(sqlalchemy.text("""
+            INSERT INTO cart_items (cart_id, potion_id, item_sku, quantity, price, day, hour, created_at)
+            SELECT c.id, p.id, p.sku, 1 + c.id % 3, p.price, 'Hearthday', 0, c.created_at
+            FROM carts c
+            JOIN potion_inventory p ON p.id = (CAST(:potion_ids AS integer[]))[1 + c.id % :count]
+            WHERE c.run_id = current_run_id()
+        """), {"potion_ids": potion_ids, "count": len(potion_ids)})
+        connection.execute(sqlalchemy.text("""
+            INSERT INTO order_search (line_item_id, cart_id, customer_name, item_sku, line_item_total, created_at)
+            SELECT ci.id, ci.cart_id, c.name, ci.item_sku, ci.quantity * ci.price, ci.created_at
+            FROM cart_items ci
+            JOIN carts c ON c.run_id = ci.run_id AND c.id = ci.cart_id
+            WHERE ci.run_id = current_run_id()
+        """))
+        # Net-zero pairs, so the balances and the audit come out the same as before seeding
+        connection.execute(sqlalchemy.text("""
+            INSERT INTO gold_ledger (net_change, function, transaction, day, hour)
+            SELECT CASE WHEN n % 2 = 0 THEN 10 ELSE -10 END, 'bench', 'seed', 'Hearthday', 0
+            FROM generate_series(1, :rows) AS n
+        """), {"rows": rows - rows % 2})
+        connection.execute(sqlalchemy.text("""
+            INSERT INTO ml_ledger (net_change, barrel_type, function, transaction, day, hour)
+            SELECT CASE WHEN n % 2 = 0 THEN 100 ELSE -100 END,
+                   (ARRAY['red', 'green', 'blue', 'dark'])[1 + (n / 2) % 4], 'bench', 'seed', 'Hearthday', 0
+            FROM generate_series(1, :rows) AS n
+        """), {"rows": rows - rows % 2})
+        connection.execute(sqlalchemy.text("""
+            INSERT INTO potion_ledger (potion_id, quantity, function, transaction, cost, day, hour)
+            SELECT p.id, CASE WHEN n % 2 = 0 THEN 1 ELSE -1 END, 'bench', 'seed', 0, 'Hearthday', 0
+            FROM generate_series(1, :rows) AS n
+            JOIN potion_inventory p ON p.id = (CAST(:potion_ids AS integer[]))[1 + (n / 2) % :count]
+        """), {"rows": rows - rows % 2, "potion_ids": potion_ids, "count": len(potion_ids)})
+        ledger.rebuild_balances(connection)
+
+    with db.engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT").exec_driver_sql("ANALYZE")
+
+
+def endpoints(sku, skus, recipe):
+    """ (name, method, path, body) for one call to each endpoint, in tick order. """
+    wholesale = [{"sku": f"SMALL_{color}_BARREL", "ml_per_barrel": 500,
+                  "potion_type": [int(color == other) for other in ["RED", "GREEN", "BLUE", "DARK"]],
+                  "price": 100, "quantity": 5} for color in ["RED", "GREEN", "BLUE", "DARK"]]
+    starter = [{**barrel, "price": 0, "quantity": 10} for barrel in wholesale]
+    customer = {"customer_name": "explain", "character_class": "Mage", "level": 3}
+    calls = [
+        ("POST /info/current_time", "POST", "/info/current_time", {"day": "Crownday", "hour": 4}),
+        ("POST /barrels/deliver/{order_id}", "POST", "/barrels/deliver/900001", starter),
+        ("POST /bottler/plan", "POST", "/bottler/plan", None),
+        ("POST /bottler/deliver/{order_id}", "POST", "/bottler/deliver/900002",
+         [{"potion_type": recipe, "quantity": 5}]),
+        ("GET /catalog/", "GET", "/catalog/", None),
+        ("POST /carts/visits/{visit_id}", "POST", "/carts/visits/1", [customer]),
+        ("POST /carts/", "POST", "/carts/", customer),
+        ("POST /carts/{cart_id}/items/{item_sku}", "POST", "/carts/{cart_id}/items/" + sku, {"quantity": 1}),
+        ("POST /carts/{cart_id}/items", "POST", "/carts/{cart_id}/items",
+         [{"item_sku": item, "quantity": 1} for item in skus]),
+        ("POST /carts/{cart_id}/checkout", "POST", "/carts/{cart_id}/checkout", {"payment": "gold"}),
+        ("POST /barrels/plan", "POST", "/barrels/plan", wholesale),
+        ("GET /inventory/audit", "GET", "/inventory/audit", None),
+        ("POST /inventory/plan", "POST", "/inventory/plan", None),
+        ("POST /inventory/deliver/{order_id}", "POST", "/inventory/deliver/900003",
+         {"potion_capacity": 0, "ml_capacity": 0}),
+        ("GET /analytics/sales", "GET", "/analytics/sales", None),
+        ("GET /analytics/sales?day", "GET", "/analytics/sales?day=Hearthday", None),
+        ("GET /analytics/daily_gold", "GET", "/analytics/daily_gold", None),
+        ("POST /admin/potions/refresh", "POST", "/admin/potions/refresh", None),
+        ("GET /admin/reconcile", "GET", "/admin/reconcile", None),
+    ]
+    for sort_col in ["timestamp", "customer_name", "item_sku", "line_item_total"]:
+        for sort_order in ["desc", "asc"]:
+            calls.append((f"GET /carts/search/ {sort_col} {sort_order}", "GET",
+                          f"/carts/search/?sort_col={sort_col}&sort_order={sort_order}", None))
+    for name, query in SUBSTRING_SEARCHES.items():
+        calls.append((name, "GET", "/carts/search/?" + query, None))
+    return calls
+
+
+def invalidate_caches():
+    game_clock.invalidate()
+    shop_state.invalidate()
+    potions.invalidate()
+    forecast.invalidate()
+    catalog.invalidate()
+
+
+def scans(plan):
+    """ Every (node type, relation) in a JSON plan tree. """
+    if "Relation Name" in plan:
+        yield plan["Node Type"], plan["Relation Name"]
+    for child in plan.get("Plans", []):
+        yield from scans(child)
+
+
+def explain(connection, statement, parameters):
+    """ The plan of one captured statement, as EXPLAIN (FORMAT JSON) returns it. """
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+        plan = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    return (json.loads(plan) if isinstance(plan, str) else plan)[0]["Plan"]
+
+
+def table_sizes(connection):
+    """ {table: estimated rows}, from the statistics ANALYZE left in pg_class. """
+    return {row.relname: row.reltuples for row in connection.execute(sqlalchemy.text("""
+        SELECT c.relname, c.reltuples
+        FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = current_schema() AND c.relkind IN ('r', 'p')
+    """))}
+
+
+class Capture:
+    """ Collects the statements sent on db.engine while it's on. """
+
+    def __init__(self):
+        self.statements = None
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if self.statements is not None:
+            # A batched multi-row INSERT (insertmanyvalues) arrives as one dict of parameters
+            parameters = parameters[0] if executemany and isinstance(parameters, (list, tuple)) else parameters
+            self.statements.append((statement, parameters))
+
+    async def call(self, client, method, path, body=None):
+        invalidate_caches()
+        self.statements = []
+        response = await client.request(method, path, json=body)
+        statements, self.statements = self.statements, None
+        return response, statements
+
+
+async def call_all(capture, client, calls):
+    """ Calls each endpoint; returns {name: (status, statements sent)}. """
+    results = {}
+    cart_id = None
+    search_next = {}
+    for name, method, path, body in calls:
+        path = path.replace("{cart_id}", str(cart_id))
+        response, statements = await capture.call(client, method, path, body)
+        results[name] = (response.status_code, statements)
+
+        if name == "POST /carts/" and response.status_code == 200:
+            cart_id = response.json()["cart_id"]
+        if name.startswith("GET /carts/search/") and response.status_code == 200 and response.json()["next"]:
+            search_next[name] = path + "&search_page=" + response.json()["next"]
+
+    # Second pages, which add the keyset condition
+    for name, path in search_next.items():
+        response, statements = await capture.call(client, "GET", path)
+        results[name + " page 2"] = (response.status_code, statements)
+    return results
+
+
+async def run(capture):
+    from src.api.server import app
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://explain",
+                                 headers={"access_token": os.environ.get("API_KEY", "")}) as client:
+        response = await client.post("/admin/reset")
+        response.raise_for_status()
+
+        vectors = bench_recipes(RECIPES)
+        with db.engine.begin() as connection:
+            potions.refresh(connection)
+            recipes = [potions.by_recipe(connection, vector) for vector in vectors]
+        seed(ROWS, [potion.id for potion in recipes])
+
+        # Stock the potions the cart calls ask for, since adding to a cart holds stock
+        stocked = recipes[:3]
+        with db.engine.begin() as connection:
+            ledger.record_potions(connection, [{
+                'potion_id': potion.id, 'quantity': 10, 'function': 'bench', 'transaction': 'explain stock', 'cost': 0
+            } for potion in stocked])
+        skus = [potion.sku for potion in stocked]
+        return await call_all(capture, client, endpoints(skus[0], skus, vectors[0]))
+
+
+@pytest.fixture(scope="module")
+def calls():
+    """ {endpoint name: (status, statements sent)} for one call to every endpoint. """
+    if db.get_async_engine() is not None:
+        pytest.skip("statements are captured on the psycopg2 engine; unset DATABASE_ASYNC")
+
+    migrate.upgrade()
+    capture = Capture()
+    sqlalchemy.event.listen(db.engine, "before_cursor_execute", capture)
+    try:
+        return asyncio.run(run(capture))
+    finally:
+        sqlalchemy.event.remove(db.engine, "before_cursor_execute", capture)
+
+
+@pytest.fixture(scope="module")
+def plans(calls):
+    """ A function from an endpoint name to the large-table Seq Scans in its statements' plans. """
+    with db.engine.begin() as connection:
+        sizes = table_sizes(connection)
+        trigram = order_search.trigram_indexed(connection)
+        found = {}
+        for name, (_, statements) in calls.items():
+            found[name] = sorted({
+                f"Seq Scan on {relation} ({sizes.get(relation, 0):.0f} rows)"
+                for statement, parameters in statements
+                if statement.lstrip().upper().startswith(EXPLAINED)
+                for node_type, relation in scans(explain(connection, statement, parameters))
+                if node_type == "Seq Scan" and sizes.get(relation, 0) >= MIN_ROWS
+            })
+    return found, trigram
+
+
+@pytest.mark.parametrize("name", [name for name, *_ in endpoints("SKU", ["SKU"], [0, 0, 100, 0])])
+def test_no_large_sequential_scans(calls, plans, name):
+    found, trigram = plans
+    pages = [name] + ([name + " page 2"] if name + " page 2" in calls else [])
+    for page in pages:
+        status_code, _ = calls[page]
+        assert status_code < 400, f"{page} returned {status_code}"
+
+    if name in FULL_SCANS:
+        return
+    if name in SUBSTRING_SEARCHES and not trigram:
+        pytest.skip("pg_trgm isn't installed, so substring search can't use an index")
+    assert [scan for page in pages for scan in found[page]] == []